@@ -104,10 +104,27 @@ resolutionPoseDetection = '1x736'
 # reprocessing a session that you collected, data will get written to the database
 # regardless of your selection. If True, the local copy will be deleted.
 deleteLocalFolder = False
+
+# Number of trials processed in parallel. Trials of different sessions run in
+# parallel, trials of a session run one after the other (calibration, then
+# static, then dynamic trials). Each parallel trial needs its own share of CPU
+# and, for pose estimation, GPU memory.
+nWorkers = 1
+
+# The status of each trial (queued, running, done, failed, with errors and
+# timings) is saved in a ledger. To resume an interrupted batch, enter the
+# path of its ledger (printed when the batch starts); trials already done are
+# skipped. Set retryFailed to True to also process failed trials again.
+ledgerPath = None
+retryFailed = False
       
 
 # %% Process data.
-batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,
-               poseDetector=poseDetector,
-               resolutionPoseDetection=resolutionPoseDetection,
-               deleteLocalFolder=deleteLocalFolder)
+# The guard is needed since worker processes import this script.
+if __name__ == '__main__':
+    batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,
+                   poseDetector=poseDetector,
+                   resolutionPoseDetection=resolutionPoseDetection,
+                   deleteLocalFolder=deleteLocalFolder,
+                   nWorkers=nWorkers, ledgerPath=ledgerPath,
+                   retryFailed=retryFailed)
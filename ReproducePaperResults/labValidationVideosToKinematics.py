@@ -107,46 +107,47 @@ augmenter_model = 'v0.2'
 # flip the flag to True.
 overwriteRestructuring = False
 subjects = ['subject' + str(i) for i in range(2,12)]
-for subject in subjects:
-    pathSubject = os.path.join(dataDir, subject)
-    pathVideos = os.path.join(pathSubject, 'VideoData')    
-    for session in os.listdir(pathVideos):
-        if 'Session' not in session:
-            continue
-        pathSession = os.path.join(pathVideos, session)
-        pathSessionNew = os.path.join(dataDir, 'Data', subject + '_' + session)
-        if os.path.exists(pathSessionNew) and not overwriteRestructuring:
-            continue
-        os.makedirs(pathSessionNew, exist_ok=True)
-        # Copy metadata
-        pathMetadata = os.path.join(pathSubject, 'sessionMetadata.yaml')
-        shutil.copy2(pathMetadata, pathSessionNew)
-        pathMetadataNew = os.path.join(pathSessionNew, 'sessionMetadata.yaml')
-        # Adjust model name
-        sessionMetadata = importMetadata(pathMetadataNew)
-        sessionMetadata['openSimModel'] = (
-            'LaiUhlrich2022')
-        with open(pathMetadataNew, 'w') as file:
-                yaml.dump(sessionMetadata, file)        
-        for cam in os.listdir(pathSession):
-            if "Cam" not in cam:
-                continue            
-            pathCam = os.path.join(pathSession, cam)
-            pathCamNew = os.path.join(pathSessionNew, 'Videos', cam)
-            pathInputMediaNew = os.path.join(pathCamNew, 'InputMedia')
-            # Copy videos.
-            for trial in os.listdir(pathCam):
-                pathTrial = os.path.join(pathCam, trial)
-                if not os.path.isdir(pathTrial):
-                    continue
-                pathVideo = os.path.join(pathTrial, trial + '.avi')
-                pathTrialNew = os.path.join(pathInputMediaNew, trial)
-                os.makedirs(pathTrialNew, exist_ok=True)
-                shutil.copy2(pathVideo, pathTrialNew)
-            # Copy camera parameters
-            pathParameters = os.path.join(pathCam, 
-                                          'cameraIntrinsicsExtrinsics.pickle')
-            shutil.copy2(pathParameters, pathCamNew)
+if __name__ == '__main__':
+    for subject in subjects:
+        pathSubject = os.path.join(dataDir, subject)
+        pathVideos = os.path.join(pathSubject, 'VideoData')    
+        for session in os.listdir(pathVideos):
+            if 'Session' not in session:
+                continue
+            pathSession = os.path.join(pathVideos, session)
+            pathSessionNew = os.path.join(dataDir, 'Data', subject + '_' + session)
+            if os.path.exists(pathSessionNew) and not overwriteRestructuring:
+                continue
+            os.makedirs(pathSessionNew, exist_ok=True)
+            # Copy metadata
+            pathMetadata = os.path.join(pathSubject, 'sessionMetadata.yaml')
+            shutil.copy2(pathMetadata, pathSessionNew)
+            pathMetadataNew = os.path.join(pathSessionNew, 'sessionMetadata.yaml')
+            # Adjust model name
+            sessionMetadata = importMetadata(pathMetadataNew)
+            sessionMetadata['openSimModel'] = (
+                'LaiUhlrich2022')
+            with open(pathMetadataNew, 'w') as file:
+                    yaml.dump(sessionMetadata, file)        
+            for cam in os.listdir(pathSession):
+                if "Cam" not in cam:
+                    continue            
+                pathCam = os.path.join(pathSession, cam)
+                pathCamNew = os.path.join(pathSessionNew, 'Videos', cam)
+                pathInputMediaNew = os.path.join(pathCamNew, 'InputMedia')
+                # Copy videos.
+                for trial in os.listdir(pathCam):
+                    pathTrial = os.path.join(pathCam, trial)
+                    if not os.path.isdir(pathTrial):
+                        continue
+                    pathVideo = os.path.join(pathTrial, trial + '.avi')
+                    pathTrialNew = os.path.join(pathInputMediaNew, trial)
+                    os.makedirs(pathTrialNew, exist_ok=True)
+                    shutil.copy2(pathVideo, pathTrialNew)
+                # Copy camera parameters
+                pathParameters = os.path.join(pathCam, 
+                                              'cameraIntrinsicsExtrinsics.pickle')
+                shutil.copy2(pathParameters, pathCamNew)
 
 # %% Fixed settings.
 # The dataset contains 5 videos per trial. The 5 videos are taken from cameras
@@ -179,89 +180,92 @@ def process_trial(trial_name=None, session_name=None, isDocker=False,
     return
 
 # %% Process trials.
-for count, sessionName in enumerate(sessionNames):    
-    # Get trial names.
-    pathCam0 = os.path.join(dataDir, 'Data', sessionName, 'Videos', 'Cam0',
-                            'InputMedia')    
-    # Work around to re-order trials and have the extrinsics trial firs, and
-    # the static second (if available).
-    trials_tmp = os.listdir(pathCam0)
-    trials_tmp = [t for t in trials_tmp if
-                  os.path.isdir(os.path.join(pathCam0, t))]
-    session_with_static = False
-    for trial in trials_tmp:
-        if 'extrinsics' in trial.lower():                    
-            extrinsics_idx = trials_tmp.index(trial) 
-        if 'static' in trial.lower():                    
-            static_idx = trials_tmp.index(trial) 
-            session_with_static = True            
-    trials = [trials_tmp[extrinsics_idx]]
-    if session_with_static:
-        trials.append(trials_tmp[static_idx])
+# Guarded, since inverse kinematics is solved in spawned processes that
+# import this script (see runIKToolChunked in utilsOpenSim).
+if __name__ == '__main__':
+    for count, sessionName in enumerate(sessionNames):    
+        # Get trial names.
+        pathCam0 = os.path.join(dataDir, 'Data', sessionName, 'Videos', 'Cam0',
+                                'InputMedia')    
+        # Work around to re-order trials and have the extrinsics trial firs, and
+        # the static second (if available).
+        trials_tmp = os.listdir(pathCam0)
+        trials_tmp = [t for t in trials_tmp if
+                      os.path.isdir(os.path.join(pathCam0, t))]
+        session_with_static = False
         for trial in trials_tmp:
-            if ('static' not in trial.lower() and 
-                'extrinsics' not in trial.lower()):
-                trials.append(trial)
-    else:
-        for trial in trials_tmp:
-            if 'extrinsics' not in trial.lower():
-                trials.append(trial)
+            if 'extrinsics' in trial.lower():                    
+                extrinsics_idx = trials_tmp.index(trial) 
+            if 'static' in trial.lower():                    
+                static_idx = trials_tmp.index(trial) 
+                session_with_static = True            
+        trials = [trials_tmp[extrinsics_idx]]
+        if session_with_static:
+            trials.append(trials_tmp[static_idx])
+            for trial in trials_tmp:
+                if ('static' not in trial.lower() and 
+                    'extrinsics' not in trial.lower()):
+                    trials.append(trial)
+        else:
+            for trial in trials_tmp:
+                if 'extrinsics' not in trial.lower():
+                    trials.append(trial)
     
-    for poseDetector in poseDetectors:
-        for cameraSetup in cameraSetups:
-            cam2Use = cam2sUse[cameraSetup]
+        for poseDetector in poseDetectors:
+            for cameraSetup in cameraSetups:
+                cam2Use = cam2sUse[cameraSetup]
             
-            # The second sessions (<>_1) have no static trial for scaling the
-            # model. The static trials were collected as part of the first
-            # session for each subject (<>_0). We here copy the Model folder
-            # from the first session to the second session.
-            if sessionName[-1] == '1':
-                sessionDir = os.path.join(dataDir, 'Data', sessionName)
-                sessionDir_0 = sessionDir[:-1] + '0'
-                camDir_0 = os.path.join(
-                    sessionDir_0, 'OpenSimData', 
-                    poseDetector + '_' + resolutionPoseDetection, cameraSetup)
-                modelDir_0 = os.path.join(camDir_0, 'Model')
-                camDir_1 = os.path.join(
-                    sessionDir, 'OpenSimData', 
-                    poseDetector + '_' + resolutionPoseDetection, cameraSetup)
-                modelDir_1 = os.path.join(camDir_1, 'Model')
-                os.makedirs(modelDir_1, exist_ok=True)
-                for file in os.listdir(modelDir_0):
-                    pathFile = os.path.join(modelDir_0, file)
-                    pathFileEnd = os.path.join(modelDir_1, file)
-                    shutil.copy2(pathFile, pathFileEnd)
+                # The second sessions (<>_1) have no static trial for scaling the
+                # model. The static trials were collected as part of the first
+                # session for each subject (<>_0). We here copy the Model folder
+                # from the first session to the second session.
+                if sessionName[-1] == '1':
+                    sessionDir = os.path.join(dataDir, 'Data', sessionName)
+                    sessionDir_0 = sessionDir[:-1] + '0'
+                    camDir_0 = os.path.join(
+                        sessionDir_0, 'OpenSimData', 
+                        poseDetector + '_' + resolutionPoseDetection, cameraSetup)
+                    modelDir_0 = os.path.join(camDir_0, 'Model')
+                    camDir_1 = os.path.join(
+                        sessionDir, 'OpenSimData', 
+                        poseDetector + '_' + resolutionPoseDetection, cameraSetup)
+                    modelDir_1 = os.path.join(camDir_1, 'Model')
+                    os.makedirs(modelDir_1, exist_ok=True)
+                    for file in os.listdir(modelDir_0):
+                        pathFile = os.path.join(modelDir_0, file)
+                        pathFileEnd = os.path.join(modelDir_1, file)
+                        shutil.copy2(pathFile, pathFileEnd)
                     
-            # Process trial.
-            for trial in trials:                
-                print('Processing {}'.format(trial))
+                # Process trial.
+                for trial in trials:                
+                    print('Processing {}'.format(trial))
                 
-                # Detect if extrinsics trial to compute extrinsic parameters. 
-                if 'extrinsics' in trial.lower():                    
-                    extrinsicsTrial = True
-                else:
-                    extrinsicsTrial = False
+                    # Detect if extrinsics trial to compute extrinsic parameters. 
+                    if 'extrinsics' in trial.lower():                    
+                        extrinsicsTrial = True
+                    else:
+                        extrinsicsTrial = False
                 
-                # Detect if static trial with neutral pose to scale model.
-                if 'static' in trial.lower():                    
-                    scaleModel = True
-                else:
-                    scaleModel = False
+                    # Detect if static trial with neutral pose to scale model.
+                    if 'static' in trial.lower():                    
+                        scaleModel = True
+                    else:
+                        scaleModel = False
                 
-                # Session specific intrinsic parameters
-                if 'subject2' in sessionName or 'subject3' in sessionName:
-                    intrinsicsFinalFolder = 'Deployed_720_240fps'
-                else:
-                    intrinsicsFinalFolder = 'Deployed_720_60fps'                    
+                    # Session specific intrinsic parameters
+                    if 'subject2' in sessionName or 'subject3' in sessionName:
+                        intrinsicsFinalFolder = 'Deployed_720_240fps'
+                    else:
+                        intrinsicsFinalFolder = 'Deployed_720_60fps'                    
                     
-                process_trial(trial,
-                              session_name=sessionName,
-                              cam2Use=cam2Use, 
-                              intrinsicsFinalFolder=intrinsicsFinalFolder,
-                              extrinsicsTrial=extrinsicsTrial,
-                              markerDataFolderNameSuffix=cameraSetup,
-                              poseDetector=poseDetector,
-                              resolutionPoseDetection=resolutionPoseDetection,
-                              scaleModel=scaleModel, 
-                              augmenter_model=augmenter_model,
-                              dataDir=dataDir)
\ No newline at end of file
+                    process_trial(trial,
+                                  session_name=sessionName,
+                                  cam2Use=cam2Use, 
+                                  intrinsicsFinalFolder=intrinsicsFinalFolder,
+                                  extrinsicsTrial=extrinsicsTrial,
+                                  markerDataFolderNameSuffix=cameraSetup,
+                                  poseDetector=poseDetector,
+                                  resolutionPoseDetection=resolutionPoseDetection,
+                                  scaleModel=scaleModel, 
+                                  augmenter_model=augmenter_model,
+                                  dataDir=dataDir)
\ No newline at end of file
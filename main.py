@@ -18,6 +18,7 @@ logging.basicConfig(level=logging.INFO)
 
 from utils import importMetadata, loadCameraParameters, getVideoExtension
 from utils import getDataDirectory, getOpenPoseDirectory, getMMposeDirectory
+from utils import getVisualizerBinaryPath
 from utilsChecker import saveCameraParameters
 from utilsChecker import calcExtrinsicsFromVideo
 from utilsChecker import isCheckerboardUpsideDown
@@ -27,9 +28,14 @@ from utilsChecker import triangulateMultiviewVideo
 from utilsChecker import writeTRCfrom3DKeypoints
 from utilsChecker import popNeutralPoseImages
 from utilsChecker import rotateIntrinsics
-from utilsDetector  import runPoseDetector
-from utilsAugmenter import augmentTRC
-from utilsOpenSim import runScaleTool, getScaleTimeRange, runIKTool, generateVisualizerJson
+from utilsDetector  import runPoseDetector, getPosePklPath, removePoseOutputs
+from utilsAugmenter import augmentTRC, getAugmenterMarkers
+from utilsOpenSim import runScaleTool, getScaleTimeRange, runIKToolChunked, generateVisualizerJson
+from utilsProfiler import StageProfiler, getProfilePath
+from utilsAPI import getVisualizerSettings
+from utilsPoseStore import getPoseArraysPath
+from utilsStageCache import (StageCache, hashInputs, hashFiles, getCodeVersion,
+                             listFiles)
 
 def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
          intrinsicsFinalFolder='Deployed', isDocker=False,
@@ -42,8 +48,16 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
          dataDir=None, overwriteAugmenterModel=False,
          filter_frequency='default', overwriteFilterFrequency=False,
          scaling_setup='upright_standing_pose', overwriteScalingSetup=False,
-         overwriteCamerasToUse=False):
+         overwriteCamerasToUse=False, poseDetectionOnly=False,
+         profiler=None, useStageCache=True):
 
+    # %% Profiling.
+    # Timing and resource usage of each stage are written to
+    # Profile_<trial_id>.json in the output folder. Pass a profiler to
+    # accumulate stages across calls (eg poseDetectionOnly then full run).
+    if profiler is None:
+        profiler = StageProfiler()
+    
     # %% High-level settings.
     # Camera calibration.
     runCameraCalibration = True
@@ -165,450 +179,621 @@ def main(sessionName, trialName, trial_id, cameras_to_use=['all'],
             sessionDir, markerDataFolderName, 
             'PostAugmentation_{}'.format(augmenterModel))
     os.makedirs(postAugmentationDir, exist_ok=True)
+    pathProfile = getProfilePath(postAugmentationDir, trial_id)
+    
+    try:
+        # %% Stage cache.
+        # Stages are skipped when their inputs did not change since the last run
+        # (see utilsStageCache), eg when reprocessing after an OpenSim change.
+        stageCache = StageCache(
+            os.path.join(sessionDir, markerDataFolderName, 'StageCache'),
+            sessionDir, prefix=trial_id + '_', enabled=useStageCache)
         
-    # %% Dump settings in yaml.
-    if not extrinsicsTrial:
-        pathSettings = os.path.join(postAugmentationDir,
-                                    'Settings_' + trial_id + '.yaml')
-        settings = {
-            'poseDetector': poseDetector, 
-            'augmenter_model': augmenterModel, 
-            'imageUpsampleFactor': imageUpsampleFactor,
-            'openSimModel': sessionMetadata['openSimModel'],
-            'scalingSetup': scalingSetup,
-            'filterFrequency': filterfrequency,
-            }
-        if poseDetector == 'OpenPose':
-            settings['resolutionPoseDetection'] = resolutionPoseDetection
-        elif poseDetector == 'mmpose':
-            settings['bbox_thr'] = bbox_thr
-        with open(pathSettings, 'w') as file:
-            yaml.dump(settings, file)
+        # %% Dump settings in yaml.
+        if not extrinsicsTrial:
+            pathSettings = os.path.join(postAugmentationDir,
+                                        'Settings_' + trial_id + '.yaml')
+            settings = {
+                'poseDetector': poseDetector, 
+                'augmenter_model': augmenterModel, 
+                'imageUpsampleFactor': imageUpsampleFactor,
+                'openSimModel': sessionMetadata['openSimModel'],
+                'scalingSetup': scalingSetup,
+                'filterFrequency': filterfrequency,
+                }
+            if poseDetector == 'OpenPose':
+                settings['resolutionPoseDetection'] = resolutionPoseDetection
+            elif poseDetector == 'mmpose':
+                settings['bbox_thr'] = bbox_thr
+            with open(pathSettings, 'w') as file:
+                yaml.dump(settings, file)
 
-    # %% Camera calibration.
-    if runCameraCalibration:    
-        # Get checkerboard parameters from metadata.
-        CheckerBoardParams = {
-            'dimensions': (
-                sessionMetadata['checkerBoard']['black2BlackCornersWidth_n'],
-                sessionMetadata['checkerBoard']['black2BlackCornersHeight_n']),
-            'squareSize': 
-                sessionMetadata['checkerBoard']['squareSideLength_mm']}       
-        # Camera directories and models.
-        cameraDirectories = {}
-        cameraModels = {}
-        for pathCam in glob.glob(os.path.join(sessionDir, 'Videos', 'Cam*')):
-            if os.name == 'nt': # windows
-                camName = pathCam.split('\\')[-1]
-            elif os.name == 'posix': # ubuntu
-                camName = pathCam.split('/')[-1]
-            cameraDirectories[camName] = os.path.join(sessionDir, 'Videos',
-                                                      pathCam)
-            cameraModels[camName] = sessionMetadata['iphoneModel'][camName]        
+        # %% Camera calibration.
+        if runCameraCalibration:    
+            with profiler.stage('calibration'):
+                # Get checkerboard parameters from metadata.
+                CheckerBoardParams = {
+                    'dimensions': (
+                        sessionMetadata['checkerBoard']['black2BlackCornersWidth_n'],
+                        sessionMetadata['checkerBoard']['black2BlackCornersHeight_n']),
+                    'squareSize': 
+                        sessionMetadata['checkerBoard']['squareSideLength_mm']}       
+                # Camera directories and models.
+                cameraDirectories = {}
+                cameraModels = {}
+                for pathCam in glob.glob(os.path.join(sessionDir, 'Videos', 'Cam*')):
+                    if os.name == 'nt': # windows
+                        camName = pathCam.split('\\')[-1]
+                    elif os.name == 'posix': # ubuntu
+                        camName = pathCam.split('/')[-1]
+                    cameraDirectories[camName] = os.path.join(sessionDir, 'Videos',
+                                                              pathCam)
+                    cameraModels[camName] = sessionMetadata['iphoneModel'][camName]        
         
-        # Get cameras' intrinsics and extrinsics.     
-        # Load parameters if saved, compute and save them if not.
-        CamParamDict = {}
-        loadedCamParams = {}
-        for camName in cameraDirectories:
-            camDir = cameraDirectories[camName]
-            # Intrinsics ######################################################
-            # Intrinsics and extrinsics already exist for this session.
-            if os.path.exists(
-                    os.path.join(camDir,"cameraIntrinsicsExtrinsics.pickle")):
-                logging.info("Load extrinsics for {} - already existing".format(
-                    camName))
-                CamParams = loadCameraParameters(
-                    os.path.join(camDir, "cameraIntrinsicsExtrinsics.pickle"))
-                loadedCamParams[camName] = True
+                # Get cameras' intrinsics and extrinsics.     
+                # Load parameters if saved, compute and save them if not.
+                CamParamDict = {}
+                loadedCamParams = {}
+                for camName in cameraDirectories:
+                    with profiler.stage('calibration', camName):
+                        camDir = cameraDirectories[camName]
+                        # Intrinsics ######################################################
+                        # Intrinsics and extrinsics already exist for this session.
+                        if os.path.exists(
+                                os.path.join(camDir,"cameraIntrinsicsExtrinsics.pickle")):
+                            logging.info("Load extrinsics for {} - already existing".format(
+                                camName))
+                            CamParams = loadCameraParameters(
+                                os.path.join(camDir, "cameraIntrinsicsExtrinsics.pickle"))
+                            loadedCamParams[camName] = True
                 
-            # Extrinsics do not exist for this session.
-            else:
-                logging.info("Compute extrinsics for {} - not yet existing".format(camName))
-                # Intrinsics ##################################################
-                # Intrinsics directories.
-                intrinsicDir = os.path.join(baseDir, 'CameraIntrinsics',
-                                            cameraModels[camName])
-                permIntrinsicDir = os.path.join(intrinsicDir, 
-                                                intrinsicsFinalFolder)            
-                # Intrinsics exist.
-                if os.path.exists(permIntrinsicDir):
-                    CamParams = loadCameraParameters(
-                        os.path.join(permIntrinsicDir,
-                                      'cameraIntrinsics.pickle'))                    
-                # Intrinsics do not exist throw an error. Eventually the
-                # webapp will give you the opportunity to compute them.
+                        # Extrinsics do not exist for this session.
+                        else:
+                            logging.info("Compute extrinsics for {} - not yet existing".format(camName))
+                            # Intrinsics ##################################################
+                            # Intrinsics directories.
+                            intrinsicDir = os.path.join(baseDir, 'CameraIntrinsics',
+                                                        cameraModels[camName])
+                            permIntrinsicDir = os.path.join(intrinsicDir, 
+                                                            intrinsicsFinalFolder)            
+                            # Intrinsics exist.
+                            if os.path.exists(permIntrinsicDir):
+                                CamParams = loadCameraParameters(
+                                    os.path.join(permIntrinsicDir,
+                                                  'cameraIntrinsics.pickle'))                    
+                            # Intrinsics do not exist throw an error. Eventually the
+                            # webapp will give you the opportunity to compute them.
                 
-                else:
-                    exception = "Intrinsics don't exist for your camera model. OpenCap supports all iOS devices released in 2018 or later: https://www.opencap.ai/get-started."
-                    raise Exception(exception, exception)
+                            else:
+                                exception = "Intrinsics don't exist for your camera model. OpenCap supports all iOS devices released in 2018 or later: https://www.opencap.ai/get-started."
+                                raise Exception(exception, exception)
                         
-                # Extrinsics ##################################################
-                # Compute extrinsics from images popped out of this trial.
-                # Hopefully you get a clean shot of the checkerboard in at
-                # least one frame of each camera.
-                useSecondExtrinsicsSolution = (
-                    alternateExtrinsics is not None and 
-                    camName in alternateExtrinsics)
-                pathVideoWithoutExtension = os.path.join(
-                    camDir, 'InputMedia', trialName, trial_id)
-                extension = getVideoExtension(pathVideoWithoutExtension)
-                extrinsicPath = os.path.join(camDir, 'InputMedia', trialName, 
-                                             trial_id + extension) 
+                            # Extrinsics ##################################################
+                            # Compute extrinsics from images popped out of this trial.
+                            # Hopefully you get a clean shot of the checkerboard in at
+                            # least one frame of each camera.
+                            useSecondExtrinsicsSolution = (
+                                alternateExtrinsics is not None and 
+                                camName in alternateExtrinsics)
+                            pathVideoWithoutExtension = os.path.join(
+                                camDir, 'InputMedia', trialName, trial_id)
+                            extension = getVideoExtension(pathVideoWithoutExtension)
+                            extrinsicPath = os.path.join(camDir, 'InputMedia', trialName, 
+                                                         trial_id + extension) 
                                               
-                # Modify intrinsics if camera view is rotated
-                CamParams = rotateIntrinsics(CamParams,extrinsicPath)
+                            # Modify intrinsics if camera view is rotated
+                            CamParams = rotateIntrinsics(CamParams,extrinsicPath)
                 
-                # for 720p, imageUpsampleFactor=4 is best for small board
-                try:
-                    CamParams = calcExtrinsicsFromVideo(
-                        extrinsicPath,CamParams, CheckerBoardParams, 
-                        visualize=False, imageUpsampleFactor=imageUpsampleFactor,
-                        useSecondExtrinsicsSolution = useSecondExtrinsicsSolution)
-                except Exception as e:
-                    if len(e.args) == 2: # specific exception
-                        raise Exception(e.args[0], e.args[1])
-                    elif len(e.args) == 1: # generic exception
-                        exception = "Camera calibration failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about camera calibration and https://www.opencap.ai/troubleshooting for potential causes for a failed calibration."
-                        raise Exception(exception, traceback.format_exc())
-                loadedCamParams[camName] = False
+                            # for 720p, imageUpsampleFactor=4 is best for small board
+                            try:
+                                CamParams = calcExtrinsicsFromVideo(
+                                    extrinsicPath,CamParams, CheckerBoardParams, 
+                                    visualize=False, imageUpsampleFactor=imageUpsampleFactor,
+                                    useSecondExtrinsicsSolution = useSecondExtrinsicsSolution)
+                            except Exception as e:
+                                if len(e.args) == 2: # specific exception
+                                    raise Exception(e.args[0], e.args[1])
+                                elif len(e.args) == 1: # generic exception
+                                    exception = "Camera calibration failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about camera calibration and https://www.opencap.ai/troubleshooting for potential causes for a failed calibration."
+                                    raise Exception(exception, traceback.format_exc())
+                            loadedCamParams[camName] = False
                 
        
-            # Append camera parameters.
-            if CamParams is not None:
-                CamParamDict[camName] = CamParams.copy()
-            else:
-                CamParamDict[camName] = None
+                        # Append camera parameters.
+                        if CamParams is not None:
+                            CamParamDict[camName] = CamParams.copy()
+                        else:
+                            CamParamDict[camName] = None
 
-        # Save parameters if not existing yet.
-        if not all([loadedCamParams[i] for i in loadedCamParams]):
-            for camName in CamParamDict:
-                saveCameraParameters(
-                    os.path.join(cameraDirectories[camName],
-                                 "cameraIntrinsicsExtrinsics.pickle"), 
-                    CamParamDict[camName])
+                # Save parameters if not existing yet.
+                if not all([loadedCamParams[i] for i in loadedCamParams]):
+                    for camName in CamParamDict:
+                        saveCameraParameters(
+                            os.path.join(cameraDirectories[camName],
+                                         "cameraIntrinsicsExtrinsics.pickle"), 
+                            CamParamDict[camName])
             
-    # %% 3D reconstruction
+        # %% 3D reconstruction
     
-    # Set output file name.
-    pathOutputFiles = {}
-    if benchmark:
-        pathOutputFiles[trialName] = os.path.join(preAugmentationDir,
-                                                  trialName + ".trc")
-    else:
-        pathOutputFiles[trialName] = os.path.join(preAugmentationDir,
-                                                  trial_id + ".trc")
+        # Set output file name.
+        pathOutputFiles = {}
+        if benchmark:
+            pathOutputFiles[trialName] = os.path.join(preAugmentationDir,
+                                                      trialName + ".trc")
+        else:
+            pathOutputFiles[trialName] = os.path.join(preAugmentationDir,
+                                                      trial_id + ".trc")
     
-    # Trial relative path
-    trialRelativePath = os.path.join('InputMedia', trialName, trial_id)
+        # Trial relative path
+        trialRelativePath = os.path.join('InputMedia', trialName, trial_id)
     
-    if runPoseDetection:
-        # Get rotation angles from motion capture environment to OpenSim.
-        # Space-fixed are lowercase, Body-fixed are uppercase. 
-        checkerBoardMount = sessionMetadata['checkerBoard']['placement']
-        if checkerBoardMount == 'backWall' or checkerBoardMount == 'Perpendicular':
-            # Detect if checkerboard is upside down.
-            upsideDownChecker = isCheckerboardUpsideDown(CamParamDict)
-            if upsideDownChecker:
-                rotationAngles = {'y':-90}
+        if runPoseDetection:
+            # Get rotation angles from motion capture environment to OpenSim.
+            # Space-fixed are lowercase, Body-fixed are uppercase. 
+            checkerBoardMount = sessionMetadata['checkerBoard']['placement']
+            if checkerBoardMount == 'backWall' or checkerBoardMount == 'Perpendicular':
+                # Detect if checkerboard is upside down.
+                upsideDownChecker = isCheckerboardUpsideDown(CamParamDict)
+                if upsideDownChecker:
+                    rotationAngles = {'y':-90}
+                else:
+                    rotationAngles = {'y':90, 'z':180}
+            elif checkerBoardMount == 'ground' or checkerBoardMount == 'Lying':
+                rotationAngles = {'x':90, 'y':90}
             else:
-                rotationAngles = {'y':90, 'z':180}
-        elif checkerBoardMount == 'ground' or checkerBoardMount == 'Lying':
-            rotationAngles = {'x':90, 'y':90}
-        else:
-            raise Exception('checkerBoard placement value in\
-             sessionMetadata.yaml is not currently supported')
+                raise Exception('checkerBoard placement value in\
+                 sessionMetadata.yaml is not currently supported')
              
-        # Detect all available cameras (ie, cameras with existing videos).
-        cameras_available = []
-        for camName in cameraDirectories:
-            camDir = cameraDirectories[camName]
-            pathVideoWithoutExtension = os.path.join(camDir, 'InputMedia', trialName, trial_id)
-            if len(glob.glob(pathVideoWithoutExtension + '*')) == 0:
-                print(f"Camera {camName} does not have a video for trial {trial_id}")
-            else:
-                if os.path.exists(os.path.join(pathVideoWithoutExtension + getVideoExtension(pathVideoWithoutExtension))):
-                    cameras_available.append(camName)
-                else:
+            # Detect all available cameras (ie, cameras with existing videos).
+            cameras_available = []
+            for camName in cameraDirectories:
+                camDir = cameraDirectories[camName]
+                pathVideoWithoutExtension = os.path.join(camDir, 'InputMedia', trialName, trial_id)
+                if len(glob.glob(pathVideoWithoutExtension + '*')) == 0:
                     print(f"Camera {camName} does not have a video for trial {trial_id}")
+                else:
+                    if os.path.exists(os.path.join(pathVideoWithoutExtension + getVideoExtension(pathVideoWithoutExtension))):
+                        cameras_available.append(camName)
+                    else:
+                        print(f"Camera {camName} does not have a video for trial {trial_id}")
 
-        if camerasToUse[0] == 'all':
-            cameras_all = list(cameraDirectories.keys())
-            if not all([cam in cameras_available for cam in cameras_all]):
-                exception = 'Not all cameras have uploaded videos; one or more cameras might have turned off or lost connection'
-                raise Exception(exception, exception)
-            else:
-                camerasToUse_c = camerasToUse
-        elif camerasToUse[0] == 'all_available':
-            camerasToUse_c = cameras_available
-            print(f"Using available cameras: {camerasToUse_c}")
-        else:
-            if not all([cam in cameras_available for cam in camerasToUse]):
-                raise Exception('Not all specified cameras in camerasToUse have videos; verify the camera names or consider setting camerasToUse to ["all_available"]')
+            if camerasToUse[0] == 'all':
+                cameras_all = list(cameraDirectories.keys())
+                if not all([cam in cameras_available for cam in cameras_all]):
+                    exception = 'Not all cameras have uploaded videos; one or more cameras might have turned off or lost connection'
+                    raise Exception(exception, exception)
+                else:
+                    camerasToUse_c = camerasToUse
+            elif camerasToUse[0] == 'all_available':
+                camerasToUse_c = cameras_available
+                print(f"Using available cameras: {camerasToUse_c}")
             else:
-                camerasToUse_c = camerasToUse
-                print(f"Using cameras: {camerasToUse_c}")
-        settings['camerasToUse'] = camerasToUse_c
-        if camerasToUse_c[0] != 'all' and len(camerasToUse_c) < 2:
-            exception = 'At least two videos are required for 3D reconstruction, video upload likely failed for one or more cameras.'
-            raise Exception(exception, exception)
-            
-        # For neutral, we do not allow reprocessing with not all cameras.
-        # The reason is that it affects extrinsics selection, and then you can only process
-        # dynamic trials with the same camera selection (ie, potentially not all cameras). 
-        # This might be addressable, but I (Antoine) do not see an immediate need + this
-        # would be a significant change in the code base. In practice, a data collection
-        # will not go through neutral if not all cameras are available.
-        if scaleModel:
-            if camerasToUse_c[0] != 'all' and len(camerasToUse_c) < len(cameraDirectories):
-                exception = 'All cameras are required for calibration and neutral pose.'
+                if not all([cam in cameras_available for cam in camerasToUse]):
+                    raise Exception('Not all specified cameras in camerasToUse have videos; verify the camera names or consider setting camerasToUse to ["all_available"]')
+                else:
+                    camerasToUse_c = camerasToUse
+                    print(f"Using cameras: {camerasToUse_c}")
+            settings['camerasToUse'] = camerasToUse_c
+            if camerasToUse_c[0] != 'all' and len(camerasToUse_c) < 2:
+                exception = 'At least two videos are required for 3D reconstruction, video upload likely failed for one or more cameras.'
                 raise Exception(exception, exception)
+            
+            # For neutral, we do not allow reprocessing with not all cameras.
+            # The reason is that it affects extrinsics selection, and then you can only process
+            # dynamic trials with the same camera selection (ie, potentially not all cameras). 
+            # This might be addressable, but I (Antoine) do not see an immediate need + this
+            # would be a significant change in the code base. In practice, a data collection
+            # will not go through neutral if not all cameras are available.
+            if scaleModel:
+                if camerasToUse_c[0] != 'all' and len(camerasToUse_c) < len(cameraDirectories):
+                    exception = 'All cameras are required for calibration and neutral pose.'
+                    raise Exception(exception, exception)
         
-        # Run pose detection algorithm.
-        try:        
-            videoExtension = runPoseDetector(
-                    cameraDirectories, trialRelativePath, poseDetectorDirectory,
-                    trialName, CamParamDict=CamParamDict, 
-                    resolutionPoseDetection=resolutionPoseDetection, 
-                    generateVideo=generateVideo, cams2Use=camerasToUse_c,
-                    poseDetector=poseDetector, bbox_thr=bbox_thr)
-            trialRelativePath += videoExtension
-        except Exception as e:
-            if len(e.args) == 2: # specific exception
-                raise Exception(e.args[0], e.args[1])
-            elif len(e.args) == 1: # generic exception
-                exception = """Pose detection failed. Verify your setup and try again. 
+            # Pose outputs of other videos or settings (eg re-uploaded videos)
+            # are removed, such that pose detection runs again.
+            if camerasToUse_c[0] == 'all':
+                camerasPose = list(cameraDirectories.keys())
+            else:
+                camerasPose = camerasToUse_c
+            pathVideos = []
+            pathPosePkls = {}
+            for camName in camerasPose:
+                pathVideoWithoutExtension = os.path.join(
+                    cameraDirectories[camName], trialRelativePath)
+                pathVideos.append(pathVideoWithoutExtension + 
+                                  getVideoExtension(pathVideoWithoutExtension))
+                pathPosePkls[camName] = getPosePklPath(
+                    cameraDirectories[camName], trialName, trial_id,
+                    poseDetector=poseDetector, 
+                    resolutionPoseDetection=resolutionPoseDetection,
+                    bbox_thr=bbox_thr)
+            if poseDetector == 'OpenPose':
+                poseSettings = resolutionPoseDetection
+            elif poseDetector == 'mmpose':
+                poseSettings = bbox_thr
+            poseKey = hashInputs(hashFiles(pathVideos), poseDetector, poseSettings,
+                                 getCodeVersion(['utilsDetector', 'utilsMMpose']))
+            if stageCache.isStale('poseDetection', poseKey):
+                logging.info('Pose detection inputs changed - removing outputs.')
+                for camName in camerasPose:
+                    removePoseOutputs(cameraDirectories[camName], 
+                                      trialRelativePath, pathPosePkls[camName])
+        
+            # Run pose detection algorithm.
+            with profiler.stage('poseDetection'):
+                try:        
+                    videoExtension = runPoseDetector(
+                            cameraDirectories, trialRelativePath, poseDetectorDirectory,
+                            trialName, CamParamDict=CamParamDict, 
+                            resolutionPoseDetection=resolutionPoseDetection, 
+                            generateVideo=generateVideo, cams2Use=camerasToUse_c,
+                            poseDetector=poseDetector, bbox_thr=bbox_thr,
+                            profiler=profiler)
+                    trialRelativePath += videoExtension
+                except Exception as e:
+                    if len(e.args) == 2: # specific exception
+                        raise Exception(e.args[0], e.args[1])
+                    elif len(e.args) == 1: # generic exception
+                        exception = """Pose detection failed. Verify your setup and try again. 
                     Visit https://www.opencap.ai/best-pratices to learn more about data collection
                     and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."""
-                raise Exception(exception, traceback.format_exc())
+                        raise Exception(exception, traceback.format_exc())
+                stageCache.put('poseDetection', poseKey, 
+                               [p for p in pathPosePkls.values() if os.path.exists(p)])
+    
+        # Only run camera calibration and pose detection, eg to run pose
+        # detection of a trial while another trial is being post-processed.
+        # Running main again then reuses the pose detection outputs.
+        if poseDetectionOnly:
+            return
+    
+        # Skip synchronization and triangulation if the pose outputs, camera
+        # parameters and settings did not change. Not for the neutral pose when
+        # the extrinsics are selected from the synchronized keypoints, since that
+        # also updates the camera parameters.
+        autoSelectExtrinsics = (scaleModel and calibrationOptions is not None and 
+                                alternateExtrinsics is None)
+        triangulationKey = None
+        markerSet = None
+        if runSynchronization and runTriangulation and not autoSelectExtrinsics:
+            pathCamParams = [
+                os.path.join(cameraDirectories[camName], 
+                             "cameraIntrinsicsExtrinsics.pickle") 
+                for camName in camerasPose]
+            pathPoseOutputs = [p for camName in camerasPose for p in 
+                               [pathPosePkls[camName], 
+                                getPoseArraysPath(pathPosePkls[camName])]]
+            triangulationKey = hashInputs(
+                hashFiles(pathPoseOutputs), hashFiles(pathCamParams), 
+                camerasToUse_c, filtFreqs, rotationAngles, trialName,
+                getCodeVersion(['utilsChecker', 'utilsCameraPy3', 'utils']))
+            triangulationCached = stageCache.get('triangulation', triangulationKey)
+            if triangulationCached is not None:
+                logging.info('Synchronization and triangulation - inputs unchanged.')
+                cameras2Use = triangulationCached['cameras2Use']
+                runSynchronization = False
+                runTriangulation = False
       
-    if runSynchronization:
-        # Synchronize videos.
-        try:
-            keypoints2D, confidence, keypointNames, frameRate, nansInOut, startEndFrames, cameras2Use = (
-                synchronizeVideos( 
-                    cameraDirectories, trialRelativePath, poseDetectorDirectory,
-                    undistortPoints=True, CamParamDict=CamParamDict,
-                    filtFreqs=filtFreqs, confidenceThreshold=0.4,
-                    imageBasedTracker=False, cams2Use=camerasToUse_c, 
-                    poseDetector=poseDetector, trialName=trialName,
-                    resolutionPoseDetection=resolutionPoseDetection))
-        except Exception as e:
-            if len(e.args) == 2: # specific exception
-                raise Exception(e.args[0], e.args[1])
-            elif len(e.args) == 1: # generic exception
-                exception = """Video synchronization failed. Verify your setup and try again. 
+        if runSynchronization:
+            # Synchronize videos.
+            with profiler.stage('synchronization'):
+                try:
+                    keypoints2D, confidence, keypointNames, frameRate, nansInOut, startEndFrames, cameras2Use = (
+                        synchronizeVideos( 
+                            cameraDirectories, trialRelativePath, poseDetectorDirectory,
+                            undistortPoints=True, CamParamDict=CamParamDict,
+                            filtFreqs=filtFreqs, confidenceThreshold=0.4,
+                            imageBasedTracker=False, cams2Use=camerasToUse_c, 
+                            poseDetector=poseDetector, trialName=trialName,
+                            resolutionPoseDetection=resolutionPoseDetection))
+                except Exception as e:
+                    if len(e.args) == 2: # specific exception
+                        raise Exception(e.args[0], e.args[1])
+                    elif len(e.args) == 1: # generic exception
+                        exception = """Video synchronization failed. Verify your setup and try again. 
                     A fail-safe synchronization method is for the participant to
                     quickly raise one hand above their shoulders, then bring it back down. 
                     Visit https://www.opencap.ai/best-pratices to learn more about 
                     data collection and https://www.opencap.ai/troubleshooting for 
                     potential causes for a failed trial."""
-                raise Exception(exception, traceback.format_exc())
+                        raise Exception(exception, traceback.format_exc())
                 
-    # Note: this should not be necessary, because we prevent reprocessing the neutral trial
-    # with not all cameras, but keeping it in there in case we would want to.
-    if calibrationOptions is not None:
-        allCams = list(calibrationOptions.keys())
-        for cam_t in allCams:
-            if not cam_t in cameras2Use:
-                calibrationOptions.pop(cam_t)
+        # Note: this should not be necessary, because we prevent reprocessing the neutral trial
+        # with not all cameras, but keeping it in there in case we would want to.
+        if calibrationOptions is not None:
+            allCams = list(calibrationOptions.keys())
+            for cam_t in allCams:
+                if not cam_t in cameras2Use:
+                    calibrationOptions.pop(cam_t)
                 
-    if scaleModel and calibrationOptions is not None and alternateExtrinsics is None:
-        # Automatically select the camera calibration to use
-        CamParamDict = autoSelectExtrinsicSolution(sessionDir,keypoints2D,confidence,calibrationOptions)
+        if autoSelectExtrinsics:
+            # Automatically select the camera calibration to use
+            CamParamDict = autoSelectExtrinsicSolution(sessionDir,keypoints2D,confidence,calibrationOptions)
      
-    if runTriangulation:
-        # Triangulate.
-        try:
-            keypoints3D, confidence3D = triangulateMultiviewVideo(
-                CamParamDict, keypoints2D, ignoreMissingMarkers=False, 
-                cams2Use=cameras2Use, confidenceDict=confidence,
-                spline3dZeros = True, splineMaxFrames=int(frameRate/5), 
-                nansInOut=nansInOut,CameraDirectories=cameraDirectories,
-                trialName=trialName,startEndFrames=startEndFrames,trialID=trial_id,
-                outputMediaFolder=outputMediaFolder)
-        except Exception as e:
-            if len(e.args) == 2: # specific exception
-                raise Exception(e.args[0], e.args[1])
-            elif len(e.args) == 1: # generic exception
-                exception = "Triangulation failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."
-                raise Exception(exception, traceback.format_exc())
+        if runTriangulation:
+            # Triangulate.
+            with profiler.stage('triangulation'):
+                try:
+                    keypoints3D, confidence3D = triangulateMultiviewVideo(
+                        CamParamDict, keypoints2D, ignoreMissingMarkers=False, 
+                        cams2Use=cameras2Use, confidenceDict=confidence,
+                        spline3dZeros = True, splineMaxFrames=int(frameRate/5), 
+                        nansInOut=nansInOut,CameraDirectories=cameraDirectories,
+                        trialName=trialName,startEndFrames=startEndFrames,trialID=trial_id,
+                        outputMediaFolder=outputMediaFolder)
+                except Exception as e:
+                    if len(e.args) == 2: # specific exception
+                        raise Exception(e.args[0], e.args[1])
+                    elif len(e.args) == 1: # generic exception
+                        exception = "Triangulation failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."
+                        raise Exception(exception, traceback.format_exc())
         
-        # Throw an error if not enough data
-        if keypoints3D.shape[2] < 10:
-            e1 = 'Error - less than 10 good frames of triangulated data.'
-            raise Exception(e1,e1)
+                # Throw an error if not enough data
+                if keypoints3D.shape[2] < 10:
+                    e1 = 'Error - less than 10 good frames of triangulated data.'
+                    raise Exception(e1,e1)
     
-        # Write TRC.
-        writeTRCfrom3DKeypoints(keypoints3D, pathOutputFiles[trialName],
-                                keypointNames, frameRate=frameRate, 
-                                rotationAngles=rotationAngles)
+                # Write TRC. The markers are kept in memory for augmentation.
+                markerSet = writeTRCfrom3DKeypoints(keypoints3D, pathOutputFiles[trialName],
+                                        keypointNames, frameRate=frameRate, 
+                                        rotationAngles=rotationAngles)
+                if triangulationKey is not None:
+                    pathSyncVideos = listFiles(
+                        os.path.join(sessionDir, 'VisualizerVideos', trialName))
+                    stageCache.put('triangulation', triangulationKey,
+                                   [pathOutputFiles[trialName]] + pathSyncVideos,
+                                   {'cameras2Use': cameras2Use})
     
-    # %% Augmentation.
+        # %% Augmentation.
     
-    # Get augmenter model.
-    augmenterModelName = (
-        sessionMetadata['markerAugmentationSettings']['markerAugmenterModel'])
+        # Get augmenter model.
+        augmenterModelName = (
+            sessionMetadata['markerAugmentationSettings']['markerAugmenterModel'])
     
-    # Set output file name.
-    pathAugmentedOutputFiles = {}
-    if genericFolderNames:
-        pathAugmentedOutputFiles[trialName] = os.path.join(
-                postAugmentationDir, trial_id + ".trc")
-    else:
-        if benchmark:
+        # Set output file name.
+        pathAugmentedOutputFiles = {}
+        if genericFolderNames:
             pathAugmentedOutputFiles[trialName] = os.path.join(
-                    postAugmentationDir, trialName + "_" + augmenterModelName +".trc")
+                    postAugmentationDir, trial_id + ".trc")
         else:
-            pathAugmentedOutputFiles[trialName] = os.path.join(
-                    postAugmentationDir, trial_id + "_" + augmenterModelName +".trc")
+            if benchmark:
+                pathAugmentedOutputFiles[trialName] = os.path.join(
+                        postAugmentationDir, trialName + "_" + augmenterModelName +".trc")
+            else:
+                pathAugmentedOutputFiles[trialName] = os.path.join(
+                        postAugmentationDir, trial_id + "_" + augmenterModelName +".trc")
     
-    if runMarkerAugmentation:
-        os.makedirs(postAugmentationDir, exist_ok=True)    
-        augmenterDir = os.path.join(baseDir, "MarkerAugmenter")
-        logging.info('Augmenting marker set')
-        try:
-            vertical_offset = augmentTRC(
-                pathOutputFiles[trialName],sessionMetadata['mass_kg'], 
-                sessionMetadata['height_m'], pathAugmentedOutputFiles[trialName],
-                augmenterDir, augmenterModelName=augmenterModelName,
-                augmenter_model=augmenterModel, offset=offset)
-        except Exception as e:
-            if len(e.args) == 2: # specific exception
-                raise Exception(e.args[0], e.args[1])
-            elif len(e.args) == 1: # generic exception
-                exception = "Marker augmentation failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."
-                raise Exception(exception, traceback.format_exc())
-        if offset:
+        # Skip augmentation if the input markers, subject, augmenter model and
+        # code did not change.
+        augmentationCached = None
+        if runMarkerAugmentation:
+            augmenterDir = os.path.join(baseDir, "MarkerAugmenter")
+            augmenterModelTypes, _, _ = getAugmenterMarkers(augmenterModel)
+            augmentationKey = hashInputs(
+                hashFiles([pathOutputFiles[trialName]]),
+                sessionMetadata['mass_kg'], sessionMetadata['height_m'],
+                augmenterModelName, augmenterModel, offset,
+                [hashFiles(listFiles(os.path.join(augmenterDir, augmenterModelName, 
+                                                  augmenterModelType)))
+                 for augmenterModelType in augmenterModelTypes],
+                getCodeVersion(['utilsAugmenter', 'utilsDataman', 'utils']))
+            augmentationCached = stageCache.get('augmentation', augmentationKey)
+            if augmentationCached is not None:
+                logging.info('Marker augmentation - inputs unchanged.')
+                vertical_offset = augmentationCached['verticalOffset']
+                runMarkerAugmentation = False
+    
+        if runMarkerAugmentation:
+            os.makedirs(postAugmentationDir, exist_ok=True)    
+            logging.info('Augmenting marker set')
+            with profiler.stage('augmentation'):
+                try:
+                    vertical_offset = augmentTRC(
+                        pathOutputFiles[trialName],sessionMetadata['mass_kg'], 
+                        sessionMetadata['height_m'], pathAugmentedOutputFiles[trialName],
+                        augmenterDir, augmenterModelName=augmenterModelName,
+                        augmenter_model=augmenterModel, offset=offset,
+                        markerSet=markerSet)
+                except Exception as e:
+                    if len(e.args) == 2: # specific exception
+                        raise Exception(e.args[0], e.args[1])
+                    elif len(e.args) == 1: # generic exception
+                        exception = "Marker augmentation failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."
+                        raise Exception(exception, traceback.format_exc())
+                stageCache.put('augmentation', augmentationKey, 
+                               [pathAugmentedOutputFiles[trialName]],
+                               {'verticalOffset': float(vertical_offset)})
+        if (runMarkerAugmentation or augmentationCached is not None) and offset:
             # If offset, no need to offset again for the webapp visualization.
             # (0.01 so that there is no overall offset, see utilsOpenSim).
             vertical_offset_settings = float(np.copy(vertical_offset)-0.01)
             vertical_offset = 0.01   
         
-    # %% OpenSim pipeline.
-    if runOpenSimPipeline:
-        openSimPipelineDir = os.path.join(baseDir, "opensimPipeline")        
+        # %% OpenSim pipeline.
+        if runOpenSimPipeline:
+            openSimPipelineDir = os.path.join(baseDir, "opensimPipeline")        
         
-        if genericFolderNames:
-            openSimFolderName = 'OpenSimData'
-        else:
-            openSimFolderName = os.path.join('OpenSimData', 
-                                             poseDetector + suff_pd)
-            if not markerDataFolderNameSuffix is None:
-                openSimFolderName = os.path.join(openSimFolderName,
-                                                 markerDataFolderNameSuffix)
+            if genericFolderNames:
+                openSimFolderName = 'OpenSimData'
+            else:
+                openSimFolderName = os.path.join('OpenSimData', 
+                                                 poseDetector + suff_pd)
+                if not markerDataFolderNameSuffix is None:
+                    openSimFolderName = os.path.join(openSimFolderName,
+                                                     markerDataFolderNameSuffix)
         
-        openSimDir = os.path.join(sessionDir, openSimFolderName)        
-        outputScaledModelDir = os.path.join(openSimDir, 'Model')
+            openSimDir = os.path.join(sessionDir, openSimFolderName)        
+            outputScaledModelDir = os.path.join(openSimDir, 'Model')
 
-        # Check if shoulder model.
-        if 'shoulder' in sessionMetadata['openSimModel']:
-            suffix_model = '_shoulder'
-        else:
-            suffix_model = ''
+            # Check if shoulder model.
+            if 'shoulder' in sessionMetadata['openSimModel']:
+                suffix_model = '_shoulder'
+            else:
+                suffix_model = ''
         
-        # Scaling.    
-        if scaleModel:
-            os.makedirs(outputScaledModelDir, exist_ok=True)
-            # Path setup file.
-            if scalingSetup == 'any_pose':
-                genericSetupFile4ScalingName = 'Setup_scaling_LaiUhlrich2022_any_pose.xml'
-            else: # by default, use upright_standing_pose
-                genericSetupFile4ScalingName = 'Setup_scaling_LaiUhlrich2022.xml'
+            # Scaling.    
+            if scaleModel:
+                with profiler.stage('scaling'):
+                    os.makedirs(outputScaledModelDir, exist_ok=True)
+                    # Path setup file.
+                    if scalingSetup == 'any_pose':
+                        genericSetupFile4ScalingName = 'Setup_scaling_LaiUhlrich2022_any_pose.xml'
+                    else: # by default, use upright_standing_pose
+                        genericSetupFile4ScalingName = 'Setup_scaling_LaiUhlrich2022.xml'
 
-            pathGenericSetupFile4Scaling = os.path.join(
-                openSimPipelineDir, 'Scaling', genericSetupFile4ScalingName)
-            # Path model file.
-            pathGenericModel4Scaling = os.path.join(
-                openSimPipelineDir, 'Models', 
-                sessionMetadata['openSimModel'] + '.osim')            
-            # Path TRC file.
-            pathTRCFile4Scaling = pathAugmentedOutputFiles[trialName]
-            # Get time range.
-            try:
-                thresholdPosition = 0.003
-                maxThreshold = 0.015
-                increment = 0.001
-                success = False
-                while thresholdPosition <= maxThreshold and not success:
-                    try:
-                        timeRange4Scaling = getScaleTimeRange(
-                            pathTRCFile4Scaling,
-                            thresholdPosition=thresholdPosition,
-                            thresholdTime=0.1, removeRoot=True)
-                        success = True
-                    except Exception as e:
-                        logging.info(f"Attempt identifying scaling time range with thresholdPosition {thresholdPosition} failed: {e}")
-                        thresholdPosition += increment  # Increase the threshold for the next iteration
+                    pathGenericSetupFile4Scaling = os.path.join(
+                        openSimPipelineDir, 'Scaling', genericSetupFile4ScalingName)
+                    # Path model file.
+                    pathGenericModel4Scaling = os.path.join(
+                        openSimPipelineDir, 'Models', 
+                        sessionMetadata['openSimModel'] + '.osim')            
+                    # Path TRC file.
+                    pathTRCFile4Scaling = pathAugmentedOutputFiles[trialName]
+                    # Skip scaling if the markers, models, setup and subject did not
+                    # change.
+                    staticImagesFolderDir = os.path.join(sessionDir, 
+                                                         'NeutralPoseImages')
+                    scalingKey = hashInputs(
+                        hashFiles([pathTRCFile4Scaling, pathGenericSetupFile4Scaling]),
+                        hashFiles(listFiles(os.path.join(openSimPipelineDir, 'Models'))),
+                        sessionMetadata['mass_kg'], sessionMetadata['height_m'],
+                        suffix_model, cameras2Use, 
+                        getCodeVersion(['utilsOpenSim', 'utilsDataman', 'utilsChecker']))
+                    scalingCached = stageCache.get('scaling', scalingKey)
+                    if scalingCached is not None:
+                        logging.info('Scaling - inputs unchanged.')
+                        pathScaledModel = os.path.join(sessionDir, 
+                                                       scalingCached['pathScaledModel'])
+                        pathOutputIK = pathScaledModel[:-5] + '.mot'
+                        pathModelIK = pathScaledModel
+                    else:
+                        # Get time range.
+                        try:
+                            # Thresholds are relaxed until a static phase is detected;
+                            # all are evaluated in one pass over the markers.
+                            thresholdPosition = 0.003
+                            maxThreshold = 0.015
+                            increment = 0.001
+                            thresholdsPosition = []
+                            while thresholdPosition <= maxThreshold:
+                                thresholdsPosition.append(thresholdPosition)
+                                thresholdPosition += increment
+                            timeRange4Scaling = getScaleTimeRange(
+                                pathTRCFile4Scaling,
+                                thresholdPosition=thresholdsPosition,
+                                thresholdTime=0.1, removeRoot=True)
 
-                # Run scale tool.
-                logging.info('Running Scaling')
-                pathScaledModel = runScaleTool(
-                    pathGenericSetupFile4Scaling, pathGenericModel4Scaling,
-                    sessionMetadata['mass_kg'], pathTRCFile4Scaling, 
-                    timeRange4Scaling, outputScaledModelDir,
-                    subjectHeight=sessionMetadata['height_m'], 
-                    suffix_model=suffix_model)
-            except Exception as e:
-                if len(e.args) == 2: # specific exception
-                    raise Exception(e.args[0], e.args[1])
-                elif len(e.args) == 1: # generic exception
-                    exception = "Musculoskeletal model scaling failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
-                    raise Exception(exception, traceback.format_exc())
-            # Extract one frame from videos to verify neutral pose.
-            staticImagesFolderDir = os.path.join(sessionDir, 
-                                                 'NeutralPoseImages')
-            os.makedirs(staticImagesFolderDir, exist_ok=True)
-            popNeutralPoseImages(cameraDirectories, cameras2Use, 
-                                 timeRange4Scaling[0], staticImagesFolderDir,
-                                 trial_id, writeVideo = True)   
-            pathOutputIK = pathScaledModel[:-5] + '.mot'
-            pathModelIK = pathScaledModel
+                            # Run scale tool.
+                            logging.info('Running Scaling')
+                            pathScaledModel = runScaleTool(
+                                pathGenericSetupFile4Scaling, pathGenericModel4Scaling,
+                                sessionMetadata['mass_kg'], pathTRCFile4Scaling, 
+                                timeRange4Scaling, outputScaledModelDir,
+                                subjectHeight=sessionMetadata['height_m'], 
+                                suffix_model=suffix_model)
+                        except Exception as e:
+                            if len(e.args) == 2: # specific exception
+                                raise Exception(e.args[0], e.args[1])
+                            elif len(e.args) == 1: # generic exception
+                                exception = "Musculoskeletal model scaling failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed neutral pose."
+                                raise Exception(exception, traceback.format_exc())
+                        # Extract one frame from videos to verify neutral pose.
+                        os.makedirs(staticImagesFolderDir, exist_ok=True)
+                        popNeutralPoseImages(cameraDirectories, cameras2Use, 
+                                             timeRange4Scaling[0], staticImagesFolderDir,
+                                             trial_id, writeVideo = True)   
+                        pathOutputIK = pathScaledModel[:-5] + '.mot'
+                        pathModelIK = pathScaledModel
+                        stageCache.put('scaling', scalingKey, 
+                                       [pathScaledModel, pathOutputIK] + 
+                                       listFiles(staticImagesFolderDir),
+                                       {'pathScaledModel': os.path.relpath(pathScaledModel,
+                                                                           sessionDir)})
         
-        # Inverse kinematics.
-        if not scaleModel:
-            outputIKDir = os.path.join(openSimDir, 'Kinematics')
-            os.makedirs(outputIKDir, exist_ok=True)
-            # Check if there is a scaled model.
-            pathScaledModel = os.path.join(outputScaledModelDir, 
-                                            sessionMetadata['openSimModel'] + 
-                                            "_scaled.osim")
-            if os.path.exists(pathScaledModel):
-                # Path setup file.
-                genericSetupFile4IKName = 'Setup_IK{}.xml'.format(suffix_model)
-                pathGenericSetupFile4IK = os.path.join(
-                    openSimPipelineDir, 'IK', genericSetupFile4IKName)
-                # Path TRC file.
-                pathTRCFile4IK = pathAugmentedOutputFiles[trialName]
-                # Run IK tool. 
-                logging.info('Running Inverse Kinematics')
-                try:
-                    pathOutputIK, pathModelIK = runIKTool(
-                        pathGenericSetupFile4IK, pathScaledModel, 
-                        pathTRCFile4IK, outputIKDir)
-                except Exception as e:
-                    if len(e.args) == 2: # specific exception
-                        raise Exception(e.args[0], e.args[1])
-                    elif len(e.args) == 1: # generic exception
-                        exception = "Inverse kinematics failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."
-                        raise Exception(exception, traceback.format_exc())
-            else:
-                raise ValueError("No scaled model available.")
+            # Inverse kinematics.
+            if not scaleModel:
+                outputIKDir = os.path.join(openSimDir, 'Kinematics')
+                os.makedirs(outputIKDir, exist_ok=True)
+                # Check if there is a scaled model.
+                pathScaledModel = os.path.join(outputScaledModelDir, 
+                                                sessionMetadata['openSimModel'] + 
+                                                "_scaled.osim")
+                if os.path.exists(pathScaledModel):
+                    # Path setup file.
+                    genericSetupFile4IKName = 'Setup_IK{}.xml'.format(suffix_model)
+                    pathGenericSetupFile4IK = os.path.join(
+                        openSimPipelineDir, 'IK', genericSetupFile4IKName)
+                    # Path TRC file.
+                    pathTRCFile4IK = pathAugmentedOutputFiles[trialName]
+                    # Skip IK if the markers, scaled model and setup did not
+                    # change.
+                    ikKey = hashInputs(
+                        hashFiles([pathTRCFile4IK, pathScaledModel, 
+                                   pathGenericSetupFile4IK]),
+                        getCodeVersion(['utilsOpenSim', 'utilsDataman']))
+                    ikCached = stageCache.get('inverseKinematics', ikKey)
+                    if ikCached is not None:
+                        logging.info('Inverse Kinematics - inputs unchanged.')
+                        pathOutputIK = os.path.join(sessionDir, 
+                                                    ikCached['pathOutputIK'])
+                        pathModelIK = os.path.join(sessionDir, 
+                                                   ikCached['pathModelIK'])
+                    else:
+                        # Run IK tool. 
+                        logging.info('Running Inverse Kinematics')
+                        with profiler.stage('inverseKinematics'):
+                            try:
+                                pathOutputIK, pathModelIK = runIKToolChunked(
+                                    pathGenericSetupFile4IK, pathScaledModel, 
+                                    pathTRCFile4IK, outputIKDir)
+                            except Exception as e:
+                                if len(e.args) == 2: # specific exception
+                                    raise Exception(e.args[0], e.args[1])
+                                elif len(e.args) == 1: # generic exception
+                                    exception = "Inverse kinematics failed. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about data collection and https://www.opencap.ai/troubleshooting for potential causes for a failed trial."
+                                    raise Exception(exception, traceback.format_exc())
+                            stageCache.put(
+                                'inverseKinematics', ikKey, [pathOutputIK],
+                                {'pathOutputIK': os.path.relpath(pathOutputIK, sessionDir),
+                                 'pathModelIK': os.path.relpath(pathModelIK, sessionDir)})
+                else:
+                    raise ValueError("No scaled model available.")
         
-        # Write body transforms to json for visualization.
-        outputJsonVisDir = os.path.join(sessionDir,'VisualizerJsons',
-                                        trialName)
-        os.makedirs(outputJsonVisDir,exist_ok=True)
-        outputJsonVisPath = os.path.join(outputJsonVisDir,
-                                         trialName + '.json')
-        generateVisualizerJson(pathModelIK, pathOutputIK,
-                               outputJsonVisPath, 
-                               vertical_offset=vertical_offset,
-                               roundToRotations=4, roundToTranslations=4)
+            # Write body transforms to json for visualization.
+            outputJsonVisDir = os.path.join(sessionDir,'VisualizerJsons',
+                                            trialName)
+            os.makedirs(outputJsonVisDir,exist_ok=True)
+            outputJsonVisPath = os.path.join(outputJsonVisDir,
+                                             trialName + '.json')
+            # Optionally, decimated and in a compact binary format as well.
+            visualizerSettings = getVisualizerSettings()
+            outputBinaryVisPath = None
+            outputVisPaths = [outputJsonVisPath]
+            if visualizerSettings['binary']:
+                outputBinaryVisPath = getVisualizerBinaryPath(sessionDir, 
+                                                              trialName)
+                os.makedirs(os.path.dirname(outputBinaryVisPath), exist_ok=True)
+                outputVisPaths.append(outputBinaryVisPath)
+            visualizerKey = hashInputs(
+                hashFiles([pathModelIK, pathOutputIK]), vertical_offset,
+                visualizerSettings, getCodeVersion(['utilsOpenSim', 'utils']))
+            if stageCache.get('visualizerJson', visualizerKey) is None:
+                with profiler.stage('visualizerJson'):
+                    generateVisualizerJson(pathModelIK, pathOutputIK,
+                                           outputJsonVisPath, 
+                                           vertical_offset=vertical_offset,
+                                           roundToRotations=4, roundToTranslations=4,
+                                           outputFrameRate=visualizerSettings['outputFrameRate'],
+                                           binaryOutputPath=outputBinaryVisPath)
+                    stageCache.put('visualizerJson', visualizerKey, outputVisPaths)
         
-    # %% Rewrite settings, adding offset  
-    if not extrinsicsTrial:
-        if offset:
-            settings['verticalOffset'] = vertical_offset_settings 
-        with open(pathSettings, 'w') as file:
-            yaml.dump(settings, file)
+        # %% Rewrite settings, adding offset  
+        if not extrinsicsTrial:
+            if offset:
+                settings['verticalOffset'] = vertical_offset_settings 
+            with open(pathSettings, 'w') as file:
+                yaml.dump(settings, file)
+    
+    finally:
+        # Write the profile, also when a stage failed.
+        profiler.write(pathProfile)
@@ -1,76 +1,110 @@
 import os
-import time
 import logging
 import shutil
 import json
+import argparse
 import torch
 
-from utilsMMpose import detection_inference, pose_inference
+from utilsMMpose import MMposeService
+from utilsJobQueue import initQueue, getJobDir, waitForClaim, completeJob
 
 logging.basicConfig(level=logging.INFO)
 
-logging.info("Waiting for data...")
-
 def checkCudaPyTorch():
     if torch.cuda.is_available():
         num_gpus = torch.cuda.device_count()
         logging.info(f"Found {num_gpus} GPU(s).")
     else:
-        logging.info("No GPU detected. Exiting.")
-        raise Exception("No GPU detected. Exiting.")
+        logging.info("No GPU detected. Running on CPU.")
+
+parser = argparse.ArgumentParser(description='mmpose worker')
+parser.add_argument('--queue_dir', default="/mmpose/data/queue_mmpose",
+                    help='Job queue served in service mode')
+parser.add_argument('--output_dir', default="/mmpose/data/output_mmpose",
+                    help='Output folder in batch mode')
+parser.add_argument('--videos', nargs='*', default=None,
+                    help='Process these videos and exit, instead of polling')
+parser.add_argument('--settings',
+                    default='/mmpose/defaultOpenCapSettings.json')
+parser.add_argument('--model_config_person',
+                    default='/mmpose/faster_rcnn_r50_fpn_coco.py')
+parser.add_argument('--model_ckpt_person',
+                    default='/mmpose/faster_rcnn_r50_fpn_1x_coco_20200130-047c8118.pth')
+parser.add_argument('--model_config_pose',
+                    default='/mmpose/hrnet_w48_coco_wholebody_384x288_dark_plus.py')
+parser.add_argument('--model_ckpt_pose',
+                    default='/mmpose/hrnet_w48_coco_wholebody_384x288_dark-f5726563_20200918.pth')
+parser.add_argument('--device', default='cuda:0',
+                    help='Falls back to cpu if no GPU is available')
+parser.add_argument('--det_batch_size', type=int, default=1,
+                    help='Frames per detector call; >1 is faster on GPU but '
+                    'boxes may differ slightly from per-frame detection')
+args = parser.parse_args()
 
-video_path = "/mmpose/data/video_mmpose.mov"
-output_dir = "/mmpose/data/output_mmpose"
+queue_dir = args.queue_dir
+output_dir = args.output_dir
 
 generateVideo=False
 
-with open('/mmpose/defaultOpenCapSettings.json') as f:
+with open(args.settings) as f:
     defaultOpenCapSettings = json.load(f)
 bbox_thr = defaultOpenCapSettings['hrnet']
-model_config_person='/mmpose/faster_rcnn_r50_fpn_coco.py'
-model_ckpt_person='/mmpose/faster_rcnn_r50_fpn_1x_coco_20200130-047c8118.pth'
-model_config_pose='/mmpose/hrnet_w48_coco_wholebody_384x288_dark_plus.py'
-model_ckpt_pose='/mmpose/hrnet_w48_coco_wholebody_384x288_dark-f5726563_20200918.pth'
-    
-if os.path.isfile(video_path):
-    os.remove(video_path)
 
+# Models are initialized once and reused for every video.
 checkCudaPyTorch()
-while True:    
-    if not os.path.isfile(video_path):
-        time.sleep(0.1)
-        continue
+service = MMposeService(args.model_config_person, args.model_ckpt_person,
+                        args.model_config_pose, args.model_ckpt_pose,
+                        device=args.device, bbox_thr=bbox_thr,
+                        det_batch_size=args.det_batch_size)
 
-    logging.info("Processing mmpose...")
+# Batch mode: process the given videos and exit.
+if args.videos is not None:
+    jobs = []
+    for c_video_path in args.videos:
+        videoName = os.path.splitext(os.path.basename(c_video_path))[0]
+        c_output_dir = os.path.join(output_dir, videoName)
+        os.makedirs(c_output_dir, exist_ok=True)
+        jobs.append({'video_path': c_video_path,
+                     'bbox_path': os.path.join(c_output_dir, 'box.pkl'),
+                     'pkl_path': os.path.join(c_output_dir, 'human.pkl')})
+    timings = service.process_queue(jobs, visualize=generateVideo)
+    with open(os.path.join(output_dir, 'timing.json'), 'w') as f:
+        json.dump(dict(zip(args.videos, timings)), f, indent=2)
+    raise SystemExit(0 if all(timings) else 1)
+
+# Service mode: process jobs from the queue.
+initQueue(queue_dir)
+
+logging.info("Waiting for data...")
+while True:
+    job = waitForClaim(queue_dir)
+    job_dir = getJobDir(queue_dir, job['jobId'])
+    video_path = os.path.join(job_dir, job['input'])
+    output_dir = os.path.join(job_dir, 'output')
+
+    logging.info("Processing mmpose job {}...".format(job['jobId']))
 
     if os.path.isdir(output_dir):
         shutil.rmtree(output_dir)
     os.makedirs(output_dir)
-    
+
     try:
-        checkCudaPyTorch()
-        # Run human detection.
-        pathModelCkptPerson = model_ckpt_person
+        # Run human and pose detection.
         bboxPath = os.path.join(output_dir, 'box.pkl')
-        full_model_config_person = model_config_person
-        detection_inference(full_model_config_person, pathModelCkptPerson,
-                            video_path, bboxPath)        
-        
-        # Run pose detection.     
-        pathModelCkptPose = model_ckpt_pose
         pklPath = os.path.join(output_dir, 'human.pkl')
-        videoOutPath = ''
-        full_model_config_pose = model_config_pose
-        pose_inference(full_model_config_pose, pathModelCkptPose, 
-                       video_path, bboxPath, pklPath, videoOutPath, 
-                       bbox_thr=bbox_thr, visualize=generateVideo)
-        if os.path.isfile(video_path):
-            os.remove(video_path)
+        timing = service.process_video(video_path, bboxPath, pklPath,
+                                       visualize=generateVideo)
         if os.path.isfile(bboxPath):
             os.remove(bboxPath)
-        
+        completeJob(queue_dir, job['jobId'],
+                    outputs=[os.path.join('output', 'human.pkl')],
+                    timing=timing)
+
         logging.info("mmpose: Done. Cleaning up")
-        
-    except:
-        logging.info("mmpose: Pose detection failed.")
+
+    except Exception as e:
+        logging.exception("mmpose: Pose detection failed.")
+        completeJob(queue_dir, job['jobId'], error=str(e))
+
+    if os.path.isfile(video_path):
         os.remove(video_path)
@@ -4,18 +4,23 @@ import pickle
 
 
 from mmpose_constants import get_flip_pair_dict
-from mmpose_utils import _xyxy2xywh, _box2cs, frame_iter
-from torch.utils.data import Dataset
+from mmpose_utils import _xyxy2xywh, _box2cs, frame_batch_iter
+from torch.utils.data import IterableDataset
 
 
-class CustomVideoDataset(Dataset):
+class CustomVideoDataset(IterableDataset):
     """Create custom video dataset for top down inference
 
+    Frames are decoded lazily while iterating, with at most read_ahead
+    frames decoded ahead of the consumer, so memory does not grow with the
+    length of the video. Instances are yielded in instance index order.
+
     Args:
         video_path (str): Path to video file
         bbox_path (str): Path to bounding box file
                          (expects format to be xyxy [left, top, right, bottom])
         pipeline (list[dict | callable]): A sequence of data transforms
+        read_ahead (int): Maximum number of frames decoded ahead
     """
 
     def __init__(self,
@@ -23,12 +28,15 @@ class CustomVideoDataset(Dataset):
                  bbox_path,
                  bbox_threshold,
                  pipeline,
-                 config):
+                 config,
+                 read_ahead=32):
 
-        # load video
-        self.capture = cv2.VideoCapture(video_path)
-        assert self.capture.isOpened(), f'Failed to load video file {video_path}'
-        self.frames = np.stack([x for x in frame_iter(self.capture)])
+        # check video
+        self.video_path = video_path
+        capture = cv2.VideoCapture(video_path)
+        assert capture.isOpened(), f'Failed to load video file {video_path}'
+        capture.release()
+        self.read_ahead = read_ahead
 
         # load bbox
         self.bboxs = pickle.load(open(bbox_path, "rb"))
@@ -53,7 +61,21 @@ class CustomVideoDataset(Dataset):
     def __len__(self):
         return len(self.instance_to_frame)
 
-    def __getitem__(self, idx):
+    def __iter__(self):
+        capture = cv2.VideoCapture(self.video_path)
+        frames = frame_batch_iter(capture, 1, prefetch=self.read_ahead)
+        try:
+            for frame_num, (img,) in enumerate(frames):
+                if frame_num >= len(self.frame_to_instance):
+                    break
+                for idx in self.frame_to_instance[frame_num]:
+                    yield self.get_instance(idx, img)
+        finally:
+            # stop the decoding thread before releasing the video
+            frames.close()
+            capture.release()
+
+    def get_instance(self, idx, img):
         frame_num, detection_num = self.instance_to_frame[idx]
         num_joints = self.cfg.data_cfg['num_joints']
         bbox_xyxy = self.bboxs[frame_num][detection_num]['bbox']
@@ -62,7 +84,7 @@ class CustomVideoDataset(Dataset):
 
         # joints_3d and joints_3d_visalble are place holders
         # but bbox in image file, image file is not used but we need bbox information later
-        data = {'img': self.frames[frame_num],
+        data = {'img': img,
                 'image_file': bbox_xyxy,
                 'center': center,
                 'scale': scale,
@@ -1,4 +1,6 @@
 import cv2
+import queue
+import threading
 import numpy as np
 
 def frame_iter(capture):
@@ -6,6 +8,58 @@ def frame_iter(capture):
         yield capture.retrieve()[1]
 
 
+def frame_batch_iter(capture, batch_size, prefetch=2):
+    """Iterate over batches of frames, decoded in a background thread
+    Args:
+        capture (cv2.VideoCapture): opened video
+        batch_size (int): number of frames per batch (last may be smaller)
+        prefetch (int): number of batches decoded ahead of the consumer
+    Returns:
+        iterator of list(np.ndarray): batches of frames, in video order
+    """
+    batches = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decode():
+        try:
+            batch = []
+            for img in frame_iter(capture):
+                batch.append(img)
+                if len(batch) == batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 class LoadImage:
     """Simple pipeline step to check channel order"""
 
@@ -6,6 +6,8 @@ import ffmpeg
 import json
 import subprocess
 
+from utilsJobQueue import initQueue, getJobDir, waitForClaim, completeJob
+
 logging.basicConfig(level=logging.INFO)
 
 #%%
@@ -76,43 +78,52 @@ def getResolutionCommand(resolutionPoseDetection, horizontal):
 
 logging.info("Waiting for data...")
 
-video_path = "/openpose/data/video_openpose.mov"
-output_dir = "/openpose/data/output_openpose"
+queue_dir = "/openpose/data/queue_openpose"
+initQueue(queue_dir)
 
 # Set resolution for OpenPose ('default', '1x736', or '1x1008_4scales').
 with open('/openpose/defaultOpenCapSettings.json') as f:
     defaultOpenCapSettings = json.load(f)
 resolutionPoseDetection = defaultOpenCapSettings['openpose']
-    
-if os.path.isfile(video_path):
-    os.remove(video_path)
 
 while True:    
-    if not os.path.isfile(video_path):
-        time.sleep(0.1)
-        continue
+    job = waitForClaim(queue_dir)
+    job_dir = getJobDir(queue_dir, job['jobId'])
+    video_path = os.path.join(job_dir, job['input'])
+    output_dir = os.path.join(job_dir, 'output')
 
-    logging.info("Processing openpose...")
+    logging.info("Processing openpose job {}...".format(job['jobId']))
+    start = time.time()
 
     if os.path.isdir(output_dir):
         shutil.rmtree(output_dir)
     os.makedirs(output_dir)
-    
-    horizontal = getVideoOrientation(video_path)
-    cmd_hr = getResolutionCommand(resolutionPoseDetection, horizontal)
 
     try: 
+        horizontal = getVideoOrientation(video_path)
+        cmd_hr = getResolutionCommand(
+            job['params'].get('resolutionPoseDetection',
+                              resolutionPoseDetection), horizontal)
         check_cuda_device()
         command = "/openpose/build/examples/openpose/openpose.bin\
             --video {video_path}\
             --display 0\
             --write_json {output_dir}\
             --render_pose 0{cmd_hr}".format(video_path=video_path, output_dir=output_dir, cmd_hr=cmd_hr)
-        os.system(command)
+        returnCode = os.system(command)
+        if returnCode != 0:
+            raise Exception('openpose exited with code {}'.format(returnCode))
 
-        logging.info("openpose: Done. Cleaning up")
-        os.remove(video_path)
+        outputs = [os.path.join('output', f) for f in sorted(os.listdir(output_dir))]
+        completeJob(queue_dir, job['jobId'], outputs=outputs,
+                    timing={'total': time.time() - start})
+        logging.info("openpose: Done with job {} in {:.2f} s.".format(
+            job['jobId'], time.time() - start))
 
-    except:
+    except Exception as e:
         logging.info("openpose: Pose detection failed.")
+        completeJob(queue_dir, job['jobId'], error=str(e),
+                    timing={'total': time.time() - start})
+    
+    if os.path.isfile(video_path):
         os.remove(video_path)
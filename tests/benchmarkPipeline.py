@@ -0,0 +1,342 @@
+"""Synthetic benchmark of the CPU stages of the pipeline.
+
+Generates a camera rig and a ground-truth 3D keypoint trajectory (standing
+still, raising the right hand for synchronization, then squatting), projects
+it into noisy, time-offset 2D keypoints for each camera, stores them as pose
+outputs, and times synchronization, triangulation, TRC writing and reading
+and scaling time range detection. Accuracy is checked against the ground
+truth. No GPU, video or network is needed, but the utils modules read an
+API token at import, so API_TOKEN must be set (any value).
+
+Usage:
+    API_TOKEN=benchmark python tests/benchmarkPipeline.py --lengths 600 1800 --cameras 2 3 5
+        --repeats 3 --output benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import platform
+
+import numpy as np
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repoDir not in sys.path:
+    sys.path.insert(0, repoDir)
+
+import utilsDataman
+from utils import getOpenPoseMarkerNames, getOpenPoseFaceMarkers
+from utilsCameraPy3 import Camera, p2e
+from utilsChecker import (synchronizeVideoKeypoints, triangulateMultiviewVideo,
+                          writeTRCfrom3DKeypoints)
+from utilsPoseStore import (initPoseArrays, writePoseOutputs, loadPose,
+                            getPeopleKeypoints)
+
+# Standing pose (mm), y up, subject facing +z (their right is -x).
+standingPose = {
+    "Nose": (0, 1650, 90), "Neck": (0, 1480, 0),
+    "RShoulder": (-180, 1450, 0), "RElbow": (-200, 1180, 0),
+    "RWrist": (-210, 930, 30), "LShoulder": (180, 1450, 0),
+    "LElbow": (200, 1180, 0), "LWrist": (210, 930, 30),
+    "midHip": (0, 950, 0), "RHip": (-100, 950, 0), "RKnee": (-100, 520, 20),
+    "RAnkle": (-100, 90, 0), "LHip": (100, 950, 0), "LKnee": (100, 520, 20),
+    "LAnkle": (100, 90, 0), "REye": (-35, 1680, 75), "LEye": (35, 1680, 75),
+    "REar": (-75, 1660, 0), "LEar": (75, 1660, 0),
+    "LBigToe": (110, 20, 180), "LSmallToe": (150, 20, 150),
+    "LHeel": (100, 30, -50), "RBigToe": (-110, 20, 180),
+    "RSmallToe": (-150, 20, 150), "RHeel": (-100, 30, -50)}
+
+# %%
+def _bump(t, tStart, duration):
+    # Smooth 0 -> 1 -> 0 bump over [tStart, tStart + duration].
+
+    phase = np.clip((t - tStart) / duration, 0, 1)
+    return np.sin(np.pi * phase)**2
+
+# %%
+def generateTrajectory(nFrames, frameRate=60, staticDuration=1.5):
+    # Returns the ground-truth keypoints (3 x 25 x nFrames, mm) and the time
+    # range during which the subject stands still.
+
+    markerNames = getOpenPoseMarkerNames()
+    pose = np.array([standingPose[m] for m in markerNames], dtype=float).T
+    t = np.arange(nFrames) / frameRate
+    keypoints = np.repeat(pose[:,:,None], nFrames, axis=2)
+    idx = {m: i for i, m in enumerate(markerNames)}
+
+    # Right hand raised above the head, for synchronization.
+    tPunch = staticDuration
+    punch = _bump(t, tPunch, 1.0)
+    keypoints[1,idx['RWrist']] += 900 * punch
+    keypoints[1,idx['RElbow']] += 450 * punch
+    keypoints[2,idx['RWrist']] += 150 * punch
+
+    # Squats (0.5 Hz) with some lateral sway after that.
+    tSquat = tPunch + 1.5
+    squat = np.where(t > tSquat, np.sin(np.pi * 0.5 * (t - tSquat))**2, 0)
+    sway = np.where(t > tSquat, 40 * np.sin(2 * np.pi * 0.3 * (t - tSquat)), 0)
+    feet = [idx[m] for m in ['RAnkle', 'LAnkle', 'RBigToe', 'LBigToe',
+                             'RSmallToe', 'LSmallToe', 'RHeel', 'LHeel']]
+    knees = [idx['RKnee'], idx['LKnee']]
+    upper = [i for i in range(len(markerNames)) if i not in feet + knees]
+    keypoints[1][upper] -= 300 * squat
+    keypoints[1][knees] -= 120 * squat
+    keypoints[2][knees] += 150 * squat
+    keypoints[0][upper + knees] += sway
+
+    return keypoints, [0.2, staticDuration - 0.2]
+
+# %%
+def generateCameras(nCameras, radius=3500, height=1000,
+                    imageSize=(720, 1280), focalLength=1300):
+    # Cameras on an arc in front of the subject, looking at the pelvis. Returns
+    # the camera parameters as saved by calibration (mm).
+
+    CamParamDict = {}
+    angles = np.linspace(-60, 60, nCameras) if nCameras > 1 else [0]
+    target = np.array([0, 900, 0])
+    for iCam, angle in enumerate(angles):
+        center = np.array([radius * np.sin(np.radians(angle)), height,
+                           radius * np.cos(np.radians(angle))])
+        z = (target - center) / np.linalg.norm(target - center)
+        down = np.array([0, -1, 0])
+        y = down - np.dot(down, z) * z
+        y /= np.linalg.norm(y)
+        x = np.cross(y, z)
+        R = np.stack([x, y, z])
+        K = np.array([[focalLength, 0, imageSize[0] / 2],
+                      [0, focalLength, imageSize[1] / 2],
+                      [0, 0, 1]])
+        CamParamDict['Cam{}'.format(iCam)] = {
+            'intrinsicMat': K,
+            'distortion': np.zeros((1, 5)),
+            'imageSize': np.array([[imageSize[1]], [imageSize[0]]]),
+            'rotation': R,
+            'translation': -R @ center[:,None],
+            'rotation_EulerAngles': np.zeros((3, 1))}
+
+    return CamParamDict
+
+# %%
+def projectKeypoints(keypoints3D, CamParamDict, offsets, nFrames,
+                     noise=1.5, seed=0):
+    # Projects the ground truth in each camera. Camera iCam records frames
+    # offsets[iCam] to offsets[iCam] + nFrames. Returns 25 x nFrames x 2
+    # keypoints and 25 x nFrames confidences per camera.
+
+    rng = np.random.default_rng(seed)
+    nMarkers = keypoints3D.shape[1]
+    keypoints2D, confidence = [], []
+    for camName, offset in zip(CamParamDict, offsets):
+        c = Camera()
+        c.set_K(CamParamDict[camName]['intrinsicMat'])
+        c.set_R(CamParamDict[camName]['rotation'])
+        c.set_t(CamParamDict[camName]['translation'])
+        points = keypoints3D[:,:,offset:offset+nFrames].reshape((3, -1))
+        points2D = p2e(c.world_to_image(points)).reshape((2, nMarkers, nFrames))
+        points2D = points2D.transpose((1, 2, 0))
+        keypoints2D.append(points2D + rng.normal(0, noise, points2D.shape))
+        confidence.append(rng.uniform(0.7, 0.95, (nMarkers, nFrames)))
+
+    return keypoints2D, confidence
+
+# %%
+def storeKeypoints(keypoints2D, confidence, outputDir):
+    # Writes the keypoints of each camera as pose outputs. Returns the paths.
+
+    paths = []
+    for iCam, (keys, conf) in enumerate(zip(keypoints2D, confidence)):
+        nFrames = keys.shape[1]
+        poseArrays = initPoseArrays(nFrames, 1)
+        poseArrays['nPeople'] = 1
+        poseArrays['personIds'][:,0] = 0
+        poseArrays['keypoints'][:,0] = keys.transpose((1, 0, 2))
+        poseArrays['confidence'][:,0] = conf.T
+        path = os.path.join(outputDir, 'Cam{}_rotated_pp.pkl'.format(iCam))
+        writePoseOutputs(path, poseArrays)
+        paths.append(path)
+
+    return paths
+
+# %%
+def loadKeypoints(paths):
+
+    keypoints2D, confidence = [], []
+    for path in paths:
+        person = getPeopleKeypoints(loadPose(path))[0]
+        person = person.reshape((person.shape[0], -1, 3)).transpose((1, 0, 2))
+        keypoints2D.append(np.array(person[:,:,:2]))
+        confidence.append(np.array(person[:,:,2]))
+
+    return keypoints2D, confidence
+
+# %%
+def _time(fn, repeats):
+    # Runs fn repeats times, returns its last output and the timings (s).
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        timings.append(time.perf_counter() - start)
+
+    return out, timings
+
+def _stats(timings):
+
+    return {'min': float(np.min(timings)), 'median': float(np.median(timings)),
+            'max': float(np.max(timings))}
+
+# %%
+def runCase(nFrames, nCameras, repeats=3, frameRate=60, maxOffset=12,
+            seed=0, outputDir=None):
+    # Benchmarks one trial length and camera count. Returns timings (s) and
+    # accuracy metrics.
+
+    rng = np.random.default_rng(seed)
+    offsets = [0] + list(rng.integers(0, maxOffset + 1, nCameras - 1))
+    keypoints3D, staticRange = generateTrajectory(nFrames + maxOffset,
+                                                  frameRate=frameRate)
+    CamParamDict = generateCameras(nCameras)
+    camNames = list(CamParamDict)
+    keypoints2D, confidence = projectKeypoints(
+        keypoints3D, CamParamDict, offsets, nFrames, seed=seed)
+    markerNames = getOpenPoseMarkerNames()
+
+    timings, accuracy = {}, {}
+    with tempfile.TemporaryDirectory(dir=outputDir) as tmpDir:
+        # Pose outputs.
+        paths, timings['poseStoreWrite'] = _time(
+            lambda: storeKeypoints(keypoints2D, confidence, tmpDir), repeats)
+        (keypoints2D, confidence), timings['poseStoreRead'] = _time(
+            lambda: loadKeypoints(paths), repeats)
+
+        # Synchronization.
+        syncOut, timings['synchronizeVideoKeypoints'] = _time(
+            lambda: synchronizeVideoKeypoints(
+                [k.copy() for k in keypoints2D],
+                [c.copy() for c in confidence],
+                confidenceThreshold=0.4,
+                filtFreqs={'gait':12, 'default':30}, sampleFreq=frameRate,
+                maxShiftSteps=2*frameRate,
+                CameraParams=[CamParamDict[c] for c in camNames],
+                cameras2Use=camNames,
+                CameraDirectories={c: tmpDir for c in camNames}), repeats)
+        keypointsSync, confidenceSync, nansInOut, startEndFrames = syncOut
+        # Frame of the ground truth at the first synchronized frame of each
+        # camera; these should all be equal.
+        syncStarts = [startEndFrames[i][0] + offsets[i]
+                      for i in range(nCameras)]
+        accuracy['syncErrorFrames'] = int(np.max(np.abs(
+            np.array(syncStarts) - syncStarts[0])))
+
+        # Triangulation.
+        keypointDict = dict(zip(camNames, keypointsSync))
+        confidenceDict = dict(zip(camNames, confidenceSync))
+        nansInOutDict = dict(zip(camNames, nansInOut))
+        triangulateOut, timings['triangulateMultiviewVideo'] = _time(
+            lambda: triangulateMultiviewVideo(
+                CamParamDict, keypointDict, ignoreMissingMarkers=False,
+                cams2Use=camNames, confidenceDict=confidenceDict,
+                spline3dZeros=True, splineMaxFrames=int(frameRate/5),
+                nansInOut=nansInOutDict), repeats)
+        points3D = triangulateOut[0]
+        # Triangulation trims frames where markers are missing; there are
+        # none here, so the output starts at the first synchronized frame.
+        truth = keypoints3D[:,:,syncStarts[0]:syncStarts[0]+points3D.shape[2]]
+        _, idxFaceMarkers = getOpenPoseFaceMarkers()
+        bodyMarkers = [i for i in range(len(markerNames))
+                       if i not in idxFaceMarkers]
+        errors = np.linalg.norm(
+            points3D[:,bodyMarkers] - truth[:,bodyMarkers], axis=0)
+        accuracy['triangulationRMSE_mm'] = float(np.sqrt(np.mean(errors**2)))
+        accuracy['triangulationMaxError_mm'] = float(np.max(errors))
+        accuracy['nFramesTriangulated'] = int(points3D.shape[2])
+
+        # TRC writing and reading.
+        pathTRC = os.path.join(tmpDir, 'trial.trc')
+        _, timings['writeTRCfrom3DKeypoints'] = _time(
+            lambda: writeTRCfrom3DKeypoints(points3D, pathTRC, markerNames,
+                                            frameRate=frameRate), repeats)
+        trc_file, timings['TRCFile'] = _time(
+            lambda: utilsDataman.TRCFile(pathTRC), repeats)
+        bodyMarkerNames = [markerNames[i] for i in bodyMarkers]
+        trcData = np.stack([trc_file.marker(m) for m in bodyMarkerNames],
+                           axis=1)
+        accuracy['trcRoundTripMaxError_mm'] = float(np.max(np.abs(
+            trcData * 1000 - points3D[:,bodyMarkers].transpose((2, 1, 0)))))
+
+        # Scaling time range. utilsOpenSim requires opensim.
+        try:
+            from utilsOpenSim import getScaleTimeRange
+        except ImportError:
+            timings['getScaleTimeRange'] = None
+            accuracy['scaleTimeRangeInStatic'] = None
+        else:
+            timeRange, timings['getScaleTimeRange'] = _time(
+                lambda: getScaleTimeRange(pathTRC, thresholdPosition=0.003,
+                                          thresholdTime=0.1,
+                                          withOpenPoseMarkers=True,
+                                          removeRoot=True), repeats)
+            # Times in the TRC start at the first synchronized frame.
+            t0 = syncStarts[0] / frameRate
+            accuracy['scaleTimeRange'] = [float(t) for t in timeRange]
+            accuracy['scaleTimeRangeInStatic'] = bool(
+                timeRange[0] + t0 >= staticRange[0] - 0.2 and
+                timeRange[1] + t0 <= staticRange[1] + 0.2)
+
+    return {'nFrames': nFrames, 'nCameras': nCameras, 'frameRate': frameRate,
+            'offsets': [int(o) for o in offsets],
+            'timings': {k: _stats(v) if v is not None else None
+                        for k, v in timings.items()},
+            'accuracy': accuracy}
+
+# %%
+def runBenchmark(lengths=[600, 1800], cameraCounts=[2, 3, 5], repeats=3,
+                 seed=0):
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    cases = []
+    for nFrames in lengths:
+        for nCameras in cameraCounts:
+            cases.append(runCase(nFrames, nCameras, repeats=repeats,
+                                 seed=seed))
+
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'nCPUs': os.cpu_count(),
+            'repeats': repeats,
+            'cases': cases}
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic pipeline benchmark')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[600, 1800],
+                        help='Trial lengths (frames at 60 Hz)')
+    parser.add_argument('--cameras', type=int, nargs='+', default=[2, 3, 5],
+                        help='Camera counts')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json',
+                        help='Path of the json report')
+    args = parser.parse_args()
+
+    report = runBenchmark(args.lengths, args.cameras, repeats=args.repeats,
+                          seed=args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for case in report['cases']:
+        print('{} frames, {} cameras:'.format(case['nFrames'], case['nCameras']))
+        for stage, stats in case['timings'].items():
+            if stats is not None:
+                print('  {:28s} {:8.4f} s'.format(stage, stats['median']))
+        print('  accuracy: {}'.format(case['accuracy']))
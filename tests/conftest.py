@@ -0,0 +1,5 @@
+import os
+
+# The utils modules read an API token at import (utils.getToken); the tests
+# do not use the API, so any token works.
+os.environ.setdefault('API_TOKEN', 'test')
@@ -0,0 +1,126 @@
+"""Local fake of the OpenCap API, to run and test workers offline.
+
+Serves the endpoints used by app.py to pull and report trials:
+    GET   trials/dequeue/?workerType=...   next queued trial, 404 if none
+    GET   trials/<id>/                     trial json
+    PATCH trials/<id>/                     updates trial fields (eg status)
+Every PATCH is recorded in trial['patches'].
+
+Run as a script to serve trials from a json file (list of trial dicts with
+at least id, session, name and videos), then point API_URL to it.
+"""
+
+import sys
+import json
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FakeAPIServer(object):
+
+    def __init__(self, trials=[], host='127.0.0.1', port=0):
+
+        self.trials = {}
+        self.queue = []
+        self.lock = threading.Lock()
+        for trial in trials:
+            self.addTrial(trial)
+        self.server = ThreadingHTTPServer((host, port), self._makeHandler())
+        self.thread = None
+
+    @property
+    def url(self):
+
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def addTrial(self, trial):
+
+        trial = dict(trial)
+        trial.setdefault('status', 'stopped')
+        trial.setdefault('videos', [])
+        trial['patches'] = []
+        with self.lock:
+            self.trials[trial['id']] = trial
+            self.queue.append(trial['id'])
+
+    def start(self):
+
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _makeHandler(self):
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, code, body=None):
+                data = json.dumps(body if body is not None else {}).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _trialId(self, path):
+                parts = [p for p in path.split('/') if p]
+                if len(parts) == 2 and parts[0] == 'trials':
+                    return parts[1]
+                return None
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                with api.lock:
+                    if path.rstrip('/') == '/trials/dequeue':
+                        if not api.queue:
+                            return self._send(404, {'detail': 'Not found.'})
+                        trial = api.trials[api.queue.pop(0)]
+                        trial['status'] = 'processing'
+                        return self._send(200, _public(trial))
+                    trial_id = self._trialId(path)
+                    if trial_id in api.trials:
+                        return self._send(200, _public(api.trials[trial_id]))
+                return self._send(404, {'detail': 'Not found.'})
+
+            def do_PATCH(self):
+                trial_id = self._trialId(urlparse(self.path).path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode()
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    data = json.loads(body) if body else {}
+                else:
+                    data = {k: v[-1] for k, v in parse_qs(body).items()}
+                with api.lock:
+                    if trial_id not in api.trials:
+                        return self._send(404, {'detail': 'Not found.'})
+                    trial = api.trials[trial_id]
+                    trial['patches'].append(data)
+                    trial.update(data)
+                    return self._send(200, _public(trial))
+
+        return Handler
+
+def _public(trial):
+
+    return {k: v for k, v in trial.items() if k != 'patches'}
+
+if __name__ == '__main__':
+    trials = []
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            trials = json.load(f)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    api = FakeAPIServer(trials, port=port)
+    print('Serving fake API at {}'.format(api.url))
+    api.server.serve_forever()
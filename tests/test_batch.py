@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+
+from utilsBatch import BatchLedger, getJobs, runBatch
+
+
+def recordJob(job, settings):
+    with open(settings['logPath'], 'a') as f:
+        f.write(json.dumps([job['session_id'], job['trial_id'], time.time()]) + '\n')
+    if job['trial_id'].startswith('crash'):
+        os._exit(1)
+    if job['trial_id'].startswith('fail'):
+        raise Exception('Dynamic trial failed.', 'details')
+    time.sleep(0.2)
+    return {'poseDetection': 0.1}
+
+
+def readLog(logPath):
+    with open(logPath, 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_order_and_isolation(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            ledgerPath = os.path.join(tmpDir, 'ledger.json')
+            settings = {'logPath': os.path.join(tmpDir, 'log.txt')}
+            jobs = (getJobs('s0', 'calib0', 'static0', ['fail0', 'dyn0']) +
+                    getJobs('s1', 'calib1', [], ['dyn1']))
+            # Given out of order, calibration must still run first.
+            jobs = jobs[::-1]
+            ledger = runBatch(jobs, ledgerPath, nWorkers=2, settings=settings,
+                              jobFn=recordJob)
+
+            log = readLog(settings['logPath'])
+            order = {s: [t for s_, t, _ in log if s_ == s] for s in ['s0', 's1']}
+            self.assertEqual(order['s0'][:2], ['calib0', 'static0'])
+            self.assertEqual(set(order['s0'][2:]), {'fail0', 'dyn0'})
+            self.assertEqual(order['s1'], ['calib1', 'dyn1'])
+            # Sessions run in parallel.
+            starts = {t: start for _, t, start in log}
+            self.assertLess(starts['dyn1'], max(starts[t] for t in order['s0']))
+
+            self.assertEqual(ledger.summary(), {'done': 5, 'failed': 1})
+            with open(ledgerPath, 'r') as f:
+                saved = {j['trial_id']: j for j in json.load(f)['jobs']}
+            self.assertIn('Dynamic trial failed.', saved['fail0']['error'])
+            self.assertEqual(saved['dyn0']['timings']['poseDetection'], 0.1)
+
+            # Resume: only failed jobs run again, with retryFailed.
+            runBatch(jobs, ledgerPath, settings=settings, jobFn=recordJob)
+            self.assertEqual(len(readLog(settings['logPath'])), 6)
+            runBatch(jobs, ledgerPath, settings=settings, jobFn=recordJob,
+                     retryFailed=True)
+            self.assertEqual(readLog(settings['logPath'])[-1][1], 'fail0')
+
+    def test_resume_and_crash(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            ledgerPath = os.path.join(tmpDir, 'ledger.json')
+            settings = {'logPath': os.path.join(tmpDir, 'log.txt')}
+            jobs = getJobs('s0', 'calib0', 'static0', ['crash0', 'dyn0'])
+            # Ledger of a batch interrupted while processing static0.
+            ledger = BatchLedger(ledgerPath)
+            ledger.addJobs(jobs)
+            ledger.update('calib0', status='done')
+            ledger.update('static0', status='running', attempts=1)
+
+            ledger = runBatch(jobs, ledgerPath, settings=settings,
+                              jobFn=recordJob, maxAttempts=2)
+
+            log = [t for _, t, _ in readLog(settings['logPath'])]
+            self.assertEqual(log[0], 'static0')
+            self.assertEqual(log.count('crash0'), 2)
+            self.assertIn('dyn0', log)
+            self.assertEqual(ledger.index['crash0']['status'], 'failed')
+            self.assertEqual(ledger.index['crash0']['error'],
+                             'Worker process crashed.')
+            self.assertEqual(ledger.index['dyn0']['status'], 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+
+from benchmarkPipeline import runCase
+
+
+class TestSyntheticPipeline(unittest.TestCase):
+
+    def test_accuracy(self):
+        case = runCase(600, 3, repeats=1)
+        accuracy = case['accuracy']
+        self.assertEqual(accuracy['syncErrorFrames'], 0)
+        self.assertLess(accuracy['triangulationRMSE_mm'], 15)
+        self.assertLess(accuracy['trcRoundTripMaxError_mm'], 0.01)
+        if accuracy['scaleTimeRangeInStatic'] is not None:
+            self.assertTrue(accuracy['scaleTimeRangeInStatic'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+import unittest
+import importlib.util
+import numpy as np
+import cv2
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+hasMMpose = all(importlib.util.find_spec(m) is not None
+                for m in ['torch', 'mmcv', 'mmdet', 'mmpose'])
+
+
+def writeVideo(path, nFrames=3, size=(128, 96)):
+    rng = np.random.default_rng(0)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, size)
+    for i in range(nFrames):
+        writer.write(rng.integers(0, 255, (size[1], size[0], 3),
+                                  dtype=np.uint8))
+    writer.release()
+
+
+def writeTinyModels(outputDir):
+    # The detector and pose model of the repo configs, shrunk to run on the
+    # CPU in a few seconds, with random weights. The detector has a single
+    # (person) class and no score threshold, so every frame has boxes.
+    import torch
+    from mmcv import Config
+    from mmpose.models import build_posenet
+
+    configPerson = Config.fromfile(
+        os.path.join(repoDir, 'mmpose', 'faster_rcnn_r50_fpn_coco.py'))
+    configPerson.model.pretrained = None
+    configPerson.model.backbone.depth = 18
+    configPerson.model.neck.in_channels = [64, 128, 256, 512]
+    configPerson.model.roi_head.bbox_head.num_classes = 1
+    configPerson.model.test_cfg.rpn.nms_pre = 100
+    configPerson.model.test_cfg.rpn.max_per_img = 100
+    configPerson.model.test_cfg.rcnn.score_thr = 0.
+    configPerson.model.test_cfg.rcnn.max_per_img = 2
+    configPerson.data.test.pipeline[1].img_scale = (128, 96)
+    pathConfigPerson = os.path.join(outputDir, 'person.py')
+    configPerson.dump(pathConfigPerson)
+
+    configPose = Config.fromfile(os.path.join(
+        repoDir, 'mmpose', 'hrnet_w48_coco_wholebody_384x288_dark_plus.py'))
+    extra = configPose.model.backbone.extra
+    extra.stage1.num_blocks = (1,)
+    extra.stage1.num_channels = (16,)
+    for stage in [extra.stage2, extra.stage3, extra.stage4]:
+        stage.num_modules = 1
+        stage.num_blocks = (1,) * stage.num_branches
+        stage.num_channels = tuple(8 * 2**i for i in range(stage.num_branches))
+    configPose.model.keypoint_head.in_channels = 8
+    configPose.model.test_cfg.modulate_kernel = 3
+    configPose.data_cfg.image_size = [48, 64]
+    configPose.data_cfg.heatmap_size = [12, 16]
+    pathConfigPose = os.path.join(outputDir, 'pose.py')
+    configPose.dump(pathConfigPose)
+    pathCkptPose = os.path.join(outputDir, 'pose.pth')
+    torch.save({'state_dict': build_posenet(configPose.model).state_dict()},
+               pathCkptPose)
+
+    return pathConfigPerson, pathConfigPose, pathCkptPose
+
+
+@unittest.skipUnless(hasMMpose, 'mmpose and mmdet are not installed')
+class TestMMposeService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def test_process_video_and_queue(self):
+        sys.path.append(os.path.join(repoDir, 'mmpose'))
+        from utilsMMpose import MMposeService
+
+        pathConfigPerson, pathConfigPose, pathCkptPose = writeTinyModels(
+            self.tmpDir)
+        service = MMposeService(pathConfigPerson, None, pathConfigPose,
+                                pathCkptPose, device='cpu', batch_size=4,
+                                bbox_thr=0.)
+
+        nFrames = 3
+        videoPath = os.path.join(self.tmpDir, 'trial.avi')
+        writeVideo(videoPath, nFrames)
+        job = {'video_path': videoPath,
+               'bbox_path': os.path.join(self.tmpDir, 'trial_box.pkl'),
+               'pkl_path': os.path.join(self.tmpDir, 'trial_pose.pkl')}
+        timing = service.process_video(job['video_path'], job['bbox_path'],
+                                       job['pkl_path'])
+
+        self.assertEqual(set(timing), {'detection', 'pose', 'total'})
+        self.assertGreater(timing['detection'], 0)
+        self.assertGreater(timing['pose'], 0)
+        self.assertAlmostEqual(timing['total'],
+                               timing['detection'] + timing['pose'])
+        with open(job['pkl_path'], 'rb') as f:
+            results = pickle.load(f)
+        self.assertEqual(len(results), nFrames)
+        for frame in results:
+            self.assertGreater(len(frame), 0)
+
+        # Failed videos are skipped, the models are reused for the others.
+        missing = dict(job, video_path=os.path.join(self.tmpDir, 'missing.avi'))
+        timings = service.process_queue([missing, job])
+        self.assertIsNone(timings[0])
+        self.assertEqual(set(timings[1]), {'detection', 'pose', 'total'})
+
+
+if __name__ == '__main__':
+    unittest.main()
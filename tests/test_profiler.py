@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+
+from utilsProfiler import StageProfiler, getProfilePath, profileStage
+
+
+class TestStageProfiler(unittest.TestCase):
+
+    def test_stages_and_cameras(self):
+        profiler = StageProfiler()
+        with profiler.stage('poseDetection'):
+            threads = [threading.Thread(target=self._camera,
+                                        args=(profiler, cam))
+                       for cam in ['Cam0', 'Cam1']]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        with profileStage(None, 'skipped'):
+            pass
+
+        with tempfile.TemporaryDirectory() as outputDir:
+            pathProfile = getProfilePath(outputDir, 'trial')
+            profiler.write(pathProfile)
+            with open(pathProfile, 'r') as f:
+                profile = json.load(f)
+
+        self.assertEqual(list(profile['summary']), ['poseDetection'])
+        cameras = sorted(r['camera'] for r in profile['stages']
+                         if r['camera'] is not None)
+        self.assertEqual(cameras, ['Cam0', 'Cam1'])
+        for record in profile['stages']:
+            self.assertGreaterEqual(record['wallTime'], 0.05)
+        stage = [r for r in profile['stages'] if r['camera'] is None][0]
+        self.assertGreater(stage['peakRSS'], 0)
+        self.assertGreater(stage['writeBytes'], 0)
+
+    def test_failing_stage(self):
+        profiler = StageProfiler(samplingInterval=0.01)
+        with self.assertRaises(ValueError):
+            with profiler.stage('triangulation'):
+                raise ValueError('failed')
+
+        self.assertEqual(profiler.running, {})
+        self.assertEqual(list(profiler.summary()), ['triangulation'])
+        for _ in range(100):
+            if profiler._sampler is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(profiler._sampler)
+
+    def _camera(self, profiler, camName):
+        with profiler.stage('poseDetection', camName):
+            with tempfile.TemporaryFile() as f:
+                f.write(os.urandom(1024))
+            time.sleep(0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
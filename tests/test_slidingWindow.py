@@ -0,0 +1,24 @@
+import unittest
+import numpy as np
+
+from utils import getSlidingWindowRanges
+
+
+class TestSlidingWindowRanges(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        data = rng.normal(size=(200, 7))
+        data[50, 3] = np.nan
+        windowSizes = [61, 55, 49, 8, 1, 200, 201]
+        for windowSize, ranges in zip(windowSizes,
+                                      getSlidingWindowRanges(data, windowSizes)):
+            expected = np.array([
+                np.max(np.abs(np.max(data[i:i+windowSize], axis=0) -
+                              np.min(data[i:i+windowSize], axis=0)))
+                for i in range(data.shape[0] - windowSize + 1)])
+            np.testing.assert_array_equal(ranges, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from utilsStageCache import StageCache, hashInputs
+
+
+class TestStageCache(unittest.TestCase):
+
+    def test_hash_inputs(self):
+        self.assertEqual(hashInputs({'a': 1, 'b': [1, 2]}),
+                         hashInputs({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(hashInputs(np.zeros(3)), hashInputs(np.zeros(4)))
+        self.assertNotEqual(hashInputs(1), hashInputs('1'))
+
+    def test_get_put(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            pathOutput = os.path.join(tmpDir, 'out.trc')
+            with open(pathOutput, 'w') as f:
+                f.write('markers')
+            cacheDir = os.path.join(tmpDir, 'StageCache')
+            cache = StageCache(cacheDir, tmpDir, prefix='t_')
+
+            self.assertIsNone(cache.get('triangulation', 'key'))
+            cache.put('triangulation', 'key', [pathOutput],
+                      {'cameras2Use': ['Cam0']})
+            self.assertEqual(cache.get('triangulation', 'key'),
+                             {'cameras2Use': ['Cam0']})
+            self.assertIsNone(cache.get('triangulation', 'other'))
+            self.assertTrue(cache.isStale('triangulation', 'other'))
+
+            # Modified or removed outputs invalidate the stage.
+            with open(pathOutput, 'w') as f:
+                f.write('other markers')
+            self.assertIsNone(cache.get('triangulation', 'key'))
+            os.remove(pathOutput)
+            self.assertIsNone(cache.get('triangulation', 'key'))
+
+            disabled = StageCache(cacheDir, tmpDir, prefix='t_', enabled=False)
+            self.assertIsNone(disabled.getManifest('triangulation'))
+
+
+if __name__ == '__main__':
+    unittest.main()
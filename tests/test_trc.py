@@ -0,0 +1,151 @@
+import os
+import io
+import tempfile
+import unittest
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+import utilsDataman
+from utils import numpy2TRC
+
+
+def numpy2TRCReference(f, data, headers, fc=50.0, t_start=0.0, units="m"):
+    # Writer before utilsTRC, value by value.
+    f.write('PathFileType  4\t(X/Y/Z) %s\n' % os.getcwd())
+    f.write('DataRate\tCameraRate\tNumFrames\tNumMarkers\t'
+            'Units\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n')
+    num_frames = data.shape[0]
+    f.write('%.1f\t%.1f\t%i\t%i\t%s\t%.1f\t%i\t%i\n' % (
+        fc, fc, num_frames, len(headers), units, fc, 1, num_frames))
+    f.write("Frame#\tTime\t")
+    for header in headers:
+        f.write("%s\t\t\t" % format(header))
+    f.write("\n\t\t")
+    for imark in np.arange(len(headers)) + 1:
+        f.write('X%i\tY%s\tZ%s\t' % (imark, imark, imark))
+    f.write('\n')
+    f.write('\n')
+    for frame in range(num_frames):
+        f.write("{}\t{:.8f}\t".format(frame+1, frame/fc + t_start))
+        for i in range(len(headers)):
+            f.write("{:.5f}\t{:.5f}\t{:.5f}\t".format(
+                data[frame, 3*i], data[frame, 3*i+1], data[frame, 3*i+2]))
+        f.write("\n")
+
+
+class TestTRC(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.headers = ['Neck', 'RHip', 'LHip']
+        self.data = rng.normal(scale=0.8, size=(250, 9))
+        self.data[10, 4] = np.nan
+        self.data[11, 0] = -0.0000001
+
+    def test_numpy2TRC_byte_compatible(self):
+        for fc in [60.0, 59.94, 120]:
+            f, fReference = io.StringIO(), io.StringIO()
+            numpy2TRC(f, self.data, self.headers, fc=fc, t_start=0.3)
+            numpy2TRCReference(fReference, self.data, self.headers, fc=fc,
+                               t_start=0.3)
+            self.assertEqual(f.getvalue(), fReference.getvalue())
+
+    def test_TRCFile_read_write(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            pathTRC = os.path.join(tmpDir, 'markers.trc')
+            with open(pathTRC, 'w') as f:
+                numpy2TRC(f, self.data, self.headers, fc=60.0)
+
+            trc = utilsDataman.TRCFile(pathTRC)
+            self.assertEqual(trc.marker_names, self.headers)
+            self.assertEqual(trc.data['frame_num'][-1], 250)
+            np.testing.assert_array_equal(trc.time, np.round(np.arange(250)/60, 8))
+            np.testing.assert_array_equal(trc.marker('RHip'),
+                                          np.round(self.data[:, 3:6], 5))
+
+            # Written rows match the value-by-value format of TRCFile.write.
+            pathTRCOut = os.path.join(tmpDir, 'markers_out.trc')
+            trc.write(pathTRCOut)
+            with open(pathTRCOut, 'r') as f:
+                lines = f.read().split('\n')
+            self.assertEqual(lines[3], 'Frame#\tTime\tNeck\t\t\tRHip\t\t\tLHip\t\t\t')
+            expected = '%i\t%.7f' % (11, trc.time[10]) + ''.join(
+                '\t%.7f' % v for v in np.round(self.data[10], 5))
+            self.assertEqual(lines[6 + 10], expected)
+            trcOut = utilsDataman.TRCFile(pathTRCOut)
+            np.testing.assert_array_equal(trcOut.marker('LHip'), trc.marker('LHip'))
+
+    def test_MarkerSet_matches_TRCFile(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            pathTRC = os.path.join(tmpDir, 'markers.trc')
+            with open(pathTRC, 'w') as f:
+                numpy2TRC(f, self.data, self.headers, fc=60.0)
+            newMarkers = np.random.default_rng(1).normal(size=(250, 6))
+
+            trc = utilsDataman.TRCFile(pathTRC)
+            trc.rotate('y', 90)
+            trc.rotate('x', -30)
+            for c, name in enumerate(['RKnee', 'LKnee']):
+                trc.add_marker(name, *newMarkers[:, 3*c:3*c+3].T)
+            trc.offset('y', 0.3)
+            pathReference = os.path.join(tmpDir, 'reference.trc')
+            trc.write(pathReference)
+
+            markerSet = utilsDataman.MarkerSet.read(pathTRC)
+            self.assertEqual(markerSet.marker_names, self.headers)
+            np.testing.assert_array_equal(
+                markerSet.markers(['LHip', 'Neck']),
+                np.round(self.data[:, [6, 7, 8, 0, 1, 2]], 5))
+            markerSet.rotate('y', 90)
+            markerSet.rotate('x', -30)
+            markerSet.add_markers(['RKnee', 'LKnee'], newMarkers)
+            markerSet.offset('y', 0.3)
+            np.testing.assert_allclose(markerSet.marker('RHip'),
+                                       trc.marker('RHip'), atol=1e-12)
+            pathOut = os.path.join(tmpDir, 'out.trc')
+            markerSet.write(pathOut)
+            with open(pathOut, 'r') as f, open(pathReference, 'r') as fRef:
+                self.assertEqual(f.read(), fRef.read())
+
+    def test_TRCFile_transforms(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            pathTRC = os.path.join(tmpDir, 'markers.trc')
+            with open(pathTRC, 'w') as f:
+                numpy2TRC(f, self.data, self.headers, fc=60.0)
+            trc = utilsDataman.TRCFile(pathTRC)
+        trc.add_marker('RKnee', *self.data[:, :3].T)
+        xyz = np.stack([trc.marker(name) for name in trc.marker_names], axis=1)
+
+        # Marker by marker, as before.
+        r = R.from_euler('y', 90, degrees=True)
+        expected = np.stack([r.apply(xyz[:, i]) for i in range(4)], axis=1)
+        expected[:, :, 1] += 0.2
+        expected *= [1, 2, 3]
+        expected = expected[:, :, [0, 2, 1]]
+
+        trc.rotate('y', 90)
+        trc.offset('Y', 0.2)
+        trc.scale([1, 2, 3])
+        trc.swap_axes('y', 'z')
+        np.testing.assert_array_equal(trc.xyz(), expected)
+        np.testing.assert_array_equal(trc.marker('RKnee'), expected[:, 3])
+        np.testing.assert_array_equal(trc.data['LHip_tz'], expected[:, 2, 2])
+        self.assertTrue(np.may_share_memory(trc.xyz(), trc.data))
+        with self.assertRaises(ValueError):
+            trc.offset('w', 1)
+
+        # Marker fields that are not float64 are updated column by column.
+        data = np.empty(250, dtype=[('time', 'float64'), ('Neck_tx', 'float32'),
+                                    ('Neck_ty', 'float32'),
+                                    ('Neck_tz', 'float32')])
+        for name in data.dtype.names:
+            data[name] = trc.data[name]
+        trc.data, trc.marker_names = data, ['Neck']
+        self.assertFalse(np.may_share_memory(trc.xyz(), trc.data))
+        trc.offset('x', 1)
+        np.testing.assert_allclose(trc.data['Neck_tx'], expected[:, 0, 0] + 1,
+                                   atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
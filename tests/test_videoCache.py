@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import cv2
+
+import utilsVideo
+
+
+def writeVideo(path, nFrames=6, size=(64, 48)):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, size)
+    for i in range(nFrames):
+        writer.write(np.full((size[1], size[0], 3), 20 * i, dtype=np.uint8))
+    writer.release()
+
+
+class TestVideoCache(unittest.TestCase):
+
+    def setUp(self):
+        utilsVideo.clearVideoCache()
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        utilsVideo.clearVideoCache()
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def test_cache_bounds_and_cleanup(self):
+        sessionDirs = [os.path.join(self.tmpDir, s) for s in ['s0', 's1']]
+        paths = []
+        for sessionDir in sessionDirs:
+            os.makedirs(sessionDir)
+            paths.append(os.path.join(sessionDir, 'video.avi'))
+            writeVideo(paths[-1])
+
+        frames = utilsVideo.readVideoFrames(paths[0], frameIndices=[1, 3])
+        self.assertEqual(len(utilsVideo._frameCache), 2)
+
+        # Bounded in bytes, least recently used frames are dropped first.
+        maxBytes = utilsVideo.maxCachedFrameBytes
+        utilsVideo.maxCachedFrameBytes = 3 * frames[0].nbytes
+        try:
+            utilsVideo.readVideoFrames(paths[1], frameIndices=[0, 2])
+        finally:
+            utilsVideo.maxCachedFrameBytes = maxBytes
+        self.assertEqual(len(utilsVideo._frameCache), 3)
+        self.assertEqual(
+            sum(key[0][0] == os.path.abspath(paths[0])
+                for key in utilsVideo._frameCache), 1)
+
+        # Clearing a session folder only drops its videos.
+        utilsVideo.clearVideoCache(sessionDirs[1])
+        self.assertTrue(all(key[0][0] == os.path.abspath(paths[0])
+                            for key in utilsVideo._frameCache))
+
+        # Frames of deleted videos are dropped on the next read.
+        utilsVideo.readVideoFrames(paths[1], frameIndices=[4])
+        shutil.rmtree(sessionDirs[0])
+        utilsVideo.readVideoFrames(paths[1], frameIndices=[5])
+        self.assertTrue(all(key[0][0] == os.path.abspath(paths[1])
+                            for key in utilsVideo._frameCache))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import json
+import tempfile
+import unittest
+import numpy as np
+
+from utils import writeVisualizerBinary, readVisualizerBinary
+
+
+class TestVisualizerBinary(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        nFrames = 120
+        visualizeDict = {'time': (np.arange(nFrames) / 60).tolist(), 'bodies': {}}
+        for name in ['pelvis', 'femur_r']:
+            visualizeDict['bodies'][name] = {
+                'attachedGeometries': [name + '.vtp'],
+                'scaleFactors': [1.0, 1.1, 0.9],
+                'rotation': np.round(rng.uniform(-np.pi, np.pi, (nFrames, 3)), 4).tolist(),
+                'translation': np.round(rng.uniform(-20, 20, (nFrames, 3)), 4).tolist()}
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            pathBinary = os.path.join(tmpDir, 'trial.bin')
+            writeVisualizerBinary(visualizeDict, pathBinary)
+            decoded = readVisualizerBinary(pathBinary)
+            sizeJson = len(json.dumps(visualizeDict))
+            self.assertLess(os.path.getsize(pathBinary), sizeJson / 2)
+
+        self.assertEqual(decoded['time'], visualizeDict['time'])
+        for name, body in visualizeDict['bodies'].items():
+            self.assertEqual(decoded['bodies'][name]['attachedGeometries'],
+                             body['attachedGeometries'])
+            for key in ['rotation', 'translation']:
+                np.testing.assert_allclose(decoded['bodies'][name][key],
+                                           body[key], atol=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()
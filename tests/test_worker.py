@@ -0,0 +1,134 @@
+import time
+import threading
+import requests
+
+from fakeAPIServer import FakeAPIServer
+from utilsWorker import PipelinedWorker
+
+class StageRecorder:
+
+    def __init__(self, failingTrial=None):
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+        self.failingTrial = failingTrial
+        self.intervals = []
+
+    def stage(self, name, duration=0.05):
+        def run(trial, *args):
+            with self.lock:
+                self.active[name] = self.active.get(name, 0) + 1
+                self.peak[name] = max(self.peak.get(name, 0), self.active[name])
+            start = time.perf_counter()
+            time.sleep(duration)
+            with self.lock:
+                self.active[name] -= 1
+                self.intervals.append((name, trial['id'], start,
+                                       time.perf_counter()))
+            if name == 'process' and trial['id'] == self.failingTrial:
+                raise Exception('failed', 'failed')
+            return trial
+        return run
+
+def runWorker(trials, recorder, **kwargs):
+    # Dequeues and processes the trials, returns the statuses.
+
+    api = FakeAPIServer(trials).start()
+    worker = PipelinedWorker(
+        api.url, 'token', isDocker=False, deleteLocalFolder=False,
+        downloadFn=lambda trialJson, trial_type, isDocker: (
+            recorder.stage('download')(trialJson)),
+        poseFn=recorder.stage('pose'),
+        processFn=recorder.stage('process', duration=0.2),
+        uploadFn=recorder.stage('upload'), **kwargs)
+    try:
+        futures = []
+        while True:
+            if not worker.hasCapacity():
+                time.sleep(0.01)
+                continue
+            r = requests.get(api.url + 'trials/dequeue/?workerType=all')
+            if r.status_code == 404:
+                break
+            futures.append(worker.submit(r.json()))
+        statuses = [f.result(timeout=10) for f in futures]
+        assert worker.waitUntilIdle(timeout=10)
+        assert worker.sessions == {}
+    finally:
+        worker.shutdown()
+        api.stop()
+
+    return statuses
+
+class TestPipelinedWorker:
+
+    def test_session_trials(self):
+        names = ['calibration', 'neutral', 'trial2', 'trial3', 'trial4']
+        trials = [{'id': 'trial{}'.format(i), 'session': 'session',
+                   'name': name, 'videos': [{}]}
+                  for i, name in enumerate(names)]
+        recorder = StageRecorder(failingTrial='trial3')
+        statuses = runWorker(trials, recorder, maxTrials=3)
+        assert statuses == ['done', 'done', 'done', 'error', 'done']
+
+        intervals = {(name, trial_id): (start, end)
+                     for name, trial_id, start, end in recorder.intervals}
+        # Each stage runs for one trial of the session at a time, in order.
+        for name in ['download', 'pose', 'process']:
+            runs = sorted((start, end, trial_id) for (n, trial_id), (start, end)
+                          in intervals.items() if n == name)
+            assert [trial_id for _, _, trial_id in runs] == [
+                t['id'] for t in trials]
+            for previous, current in zip(runs[:-1], runs[1:]):
+                assert previous[1] <= current[0]
+        # Trials after calibration and static trials are downloaded once
+        # these are uploaded.
+        assert (intervals[('upload', 'trial0')][1] <=
+                intervals[('download', 'trial1')][0])
+        assert (intervals[('upload', 'trial1')][1] <=
+                intervals[('download', 'trial2')][0])
+        # Pose detection of a dynamic trial overlaps post-processing of the
+        # previous one.
+        assert (intervals[('pose', 'trial3')][0] <
+                intervals[('process', 'trial2')][1])
+
+    def test_pipelined_trials(self):
+        trials = [{'id': 'trial{}'.format(i), 'session': 'session{}'.format(i),
+                   'name': 'trial{}'.format(i), 'videos': [{}]}
+                  for i in range(4)]
+        api = FakeAPIServer(trials).start()
+        recorder = StageRecorder(failingTrial='trial2')
+        worker = PipelinedWorker(
+            api.url, 'token', isDocker=False, maxTrials=3,
+            deleteLocalFolder=False,
+            downloadFn=lambda trialJson, trial_type, isDocker: (
+                recorder.stage('download')(trialJson)),
+            poseFn=recorder.stage('pose'),
+            processFn=recorder.stage('process'),
+            uploadFn=recorder.stage('upload'))
+        try:
+            futures = []
+            while True:
+                if not worker.hasCapacity():
+                    time.sleep(0.01)
+                    continue
+                r = requests.get(api.url + 'trials/dequeue/?workerType=all')
+                if r.status_code == 404:
+                    break
+                futures.append(worker.submit(r.json()))
+            statuses = [f.result(timeout=10) for f in futures]
+            assert worker.waitUntilIdle(timeout=10)
+        finally:
+            worker.shutdown()
+            api.stop()
+
+        assert statuses == ['done', 'done', 'error', 'done']
+        for trial in trials:
+            patched = [p['status'] for p in api.trials[trial['id']]['patches']
+                       if 'status' in p]
+            assert patched == [statuses[trials.index(trial)]]
+            assert any('processed_duration' in p
+                       for p in api.trials[trial['id']]['patches'])
+        # One trial at a time on the GPU, several trials in flight.
+        assert recorder.peak['pose'] == 1
+        assert recorder.peak['download'] > 1
@@ -21,6 +21,8 @@ from urllib3.util.retry import Retry
 
 from utilsAuth import getToken
 from utilsAPI import getAPIURL
+from utilsPoseStore import convertPosePickle
+from utilsTRC import writeTRCHeader, writeTRCRows
 
 API_URL = getAPIURL()
 API_TOKEN = getToken()
@@ -946,6 +948,8 @@ def getPosePickles(trial_id,session_path, poseDetector='OpenPose',
                 os.makedirs(posePickleDir,exist_ok=True)
                 posePicklePath = os.path.join(posePickleDir,trialPrefix)
                 download_file(url,posePicklePath)
+                # Store the pose arrays used for processing.
+                convertPosePickle(posePicklePath)
 
 def checkAndGetPosePickles(trial_id, session_path, poseDetector, resolutionPoseDetection, bbox_thr):
     # Check if the pose pickles for that set of settings exist.
@@ -1076,46 +1080,17 @@ def downloadAndZipSession(session_id,deleteFolderWhenZipped=True,isDocker=True,
 
 def numpy2TRC(f, data, headers, fc=50.0, t_start=0.0, units="m"):
     
-    header_mapping = {}
-    for count, header in enumerate(headers):
-        header_mapping[count+1] = header 
-        
-    # Line 1.
-    f.write('PathFileType  4\t(X/Y/Z) %s\n' % os.getcwd())
-    
-    # Line 2.
-    f.write('DataRate\tCameraRate\tNumFrames\tNumMarkers\t'
-                'Units\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n')
-    
     num_frames=data.shape[0]
-    num_markers=len(header_mapping.keys())
-    
-    # Line 3.
-    f.write('%.1f\t%.1f\t%i\t%i\t%s\t%.1f\t%i\t%i\n' % (
-            fc, fc, num_frames,
-            num_markers, units, fc,
-            1, num_frames))
-    
-    # Line 4.
-    f.write("Frame#\tTime\t")
-    for key in sorted(header_mapping.keys()):
-        f.write("%s\t\t\t" % format(header_mapping[key]))
-
-    # Line 5.
-    f.write("\n\t\t")
-    for imark in np.arange(num_markers) + 1:
-        f.write('X%i\tY%s\tZ%s\t' % (imark, imark, imark))
-    f.write('\n')
+    num_markers=len(headers)
     
-    # Line 6.
-    f.write('\n')
-
-    for frame in range(data.shape[0]):
-        f.write("{}\t{:.8f}\t".format(frame+1,(frame)/fc+t_start)) # opensim frame labeling is 1 indexed
-
-        for key in sorted(header_mapping.keys()):
-            f.write("{:.5f}\t{:.5f}\t{:.5f}\t".format(data[frame,0+(key-1)*3], data[frame,1+(key-1)*3], data[frame,2+(key-1)*3]))
-        f.write("\n")
+    writeTRCHeader(f, os.getcwd(), fc, fc, num_frames, 
+                   [format(header) for header in headers], units, fc, 1, 
+                   num_frames)
+    
+    # opensim frame labeling is 1 indexed
+    time = np.arange(num_frames)/fc + t_start
+    writeTRCRows(f, time, data[:, :3*num_markers], timeFormat='%.8f', 
+                 valueFormat='%.5f', trailingTab=True)
         
 def numpy2storage(labels, data, storage_file):
     
@@ -1317,6 +1292,115 @@ def getIK(storage_file, joints, degrees=False):
     
     return Qs, QsFilt
 
+# %% Largest range (max - min) over the columns of data in sliding windows.
+def getSlidingWindowRanges(data, windowSizes):
+    # Returns, for each window size, an array with the range of each window
+    # start (empty if the window is longer than data). Window maxima and
+    # minima are combined from two overlapping power-of-two windows of a
+    # sparse table, built once for all window sizes, rather than computed
+    # for each window. NaNs propagate, such that windows with NaNs have a
+    # NaN range.
+    
+    nFrames = data.shape[0]
+    maxTable = [data]
+    minTable = [data]
+    length = 1
+    while 2*length <= min(max(windowSizes), nFrames):
+        maxTable.append(np.maximum(maxTable[-1][:-length], maxTable[-1][length:]))
+        minTable.append(np.minimum(minTable[-1][:-length], minTable[-1][length:]))
+        length *= 2
+    
+    ranges = []
+    for windowSize in windowSizes:
+        if windowSize < 1 or windowSize > nFrames:
+            ranges.append(np.zeros(0))
+            continue
+        k = int(np.log2(windowSize))
+        offset = windowSize - 2**k
+        nStarts = nFrames - windowSize + 1
+        windowMax = np.maximum(maxTable[k][:nStarts], 
+                               maxTable[k][offset:offset+nStarts])
+        windowMin = np.minimum(minTable[k][:nStarts], 
+                               minTable[k][offset:offset+nStarts])
+        ranges.append(np.max(np.abs(windowMax - windowMin), axis=1))
+        
+    return ranges
+
+# %% Compact binary format of the visualizer transforms.
+# A header (magic, length of the json metadata, json metadata with the bodies,
+# number of frames and quantization steps) followed by little-endian arrays:
+# time (float64, nFrames), rotations (int16, nFrames x nBodies x 3, in steps
+# of rotationStep rad) and translations (int32, same shape, in steps of
+# translationStep m).
+visualizerBinaryMagic = b'OCVT'
+
+def getVisualizerBinaryPath(sessionDir, trialName):
+    # Next to, rather than in, VisualizerJsons, whose files are all uploaded
+    # as visualizer jsons.
+    
+    return os.path.join(sessionDir, 'VisualizerBinaries', trialName,
+                        trialName + '.bin')
+
+def writeVisualizerBinary(visualizeDict, path, rotationStep=1e-4,
+                          translationStep=1e-4):
+    
+    bodyNames = list(visualizeDict['bodies'].keys())
+    metadata = {
+        'version': 1,
+        'nFrames': len(visualizeDict['time']),
+        'rotationStep': rotationStep,
+        'translationStep': translationStep,
+        'bodies': [{'name': name,
+                    'attachedGeometries': visualizeDict['bodies'][name]['attachedGeometries'],
+                    'scaleFactors': visualizeDict['bodies'][name]['scaleFactors']}
+                   for name in bodyNames]}
+    metadataBytes = json.dumps(metadata).encode('utf-8')
+    shape = (len(visualizeDict['time']), len(bodyNames), 3)
+    rotations = np.reshape([visualizeDict['bodies'][name]['rotation'] 
+                            for name in bodyNames], (len(bodyNames), -1, 3))
+    translations = np.reshape([visualizeDict['bodies'][name]['translation'] 
+                               for name in bodyNames], (len(bodyNames), -1, 3))
+    rotations = np.round(np.transpose(rotations, (1, 0, 2)) / rotationStep)
+    translations = np.round(np.transpose(translations, (1, 0, 2)) / translationStep)
+    with open(path, 'wb') as f:
+        f.write(visualizerBinaryMagic)
+        f.write(np.uint32(len(metadataBytes)).astype('<u4').tobytes())
+        f.write(metadataBytes)
+        f.write(np.asarray(visualizeDict['time'], dtype='<f8').tobytes())
+        f.write(rotations.reshape(shape).astype('<i2').tobytes())
+        f.write(translations.reshape(shape).astype('<i4').tobytes())
+        
+def readVisualizerBinary(path):
+    # Returns the content of a file written by writeVisualizerBinary, in the
+    # format of the visualizer json.
+    
+    with open(path, 'rb') as f:
+        content = f.read()
+    if content[:4] != visualizerBinaryMagic:
+        raise ValueError('Not a visualizer binary file: ' + path)
+    nMetadata = int(np.frombuffer(content[4:8], dtype='<u4')[0])
+    metadata = json.loads(content[8:8+nMetadata].decode('utf-8'))
+    nFrames = metadata['nFrames']
+    nBodies = len(metadata['bodies'])
+    offset = 8 + nMetadata
+    time = np.frombuffer(content, dtype='<f8', count=nFrames, offset=offset)
+    offset += 8 * nFrames
+    rotations = np.frombuffer(content, dtype='<i2', count=nFrames*nBodies*3,
+                              offset=offset).reshape(nFrames, nBodies, 3)
+    offset += 2 * nFrames * nBodies * 3
+    translations = np.frombuffer(content, dtype='<i4', count=nFrames*nBodies*3,
+                                 offset=offset).reshape(nFrames, nBodies, 3)
+    
+    visualizeDict = {'time': time.tolist(), 'bodies': {}}
+    for iBody, body in enumerate(metadata['bodies']):
+        visualizeDict['bodies'][body['name']] = {
+            'attachedGeometries': body['attachedGeometries'],
+            'scaleFactors': body['scaleFactors'],
+            'rotation': (rotations[:, iBody] * metadata['rotationStep']).tolist(),
+            'translation': (translations[:, iBody] * metadata['translationStep']).tolist()}
+        
+    return visualizeDict
+
 # %% Markers for augmenters.
 def getOpenPoseMarkers_fullBody():
 
@@ -1573,6 +1657,38 @@ def checkResourceUsage(stop_machine_and_email=True):
     
     return resourceUsage
 
+def getAvailableCPUs():
+    # Number of CPUs this process can use: the CPUs it may run on, capped by
+    # the CPU quota of its cgroup (eg docker --cpus).
+    
+    try:
+        nCPUs = len(os.sched_getaffinity(0))
+    except AttributeError:
+        nCPUs = os.cpu_count() or 1
+    
+    quota = None
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            c_quota, period = f.read().split()[:2]
+        if c_quota != 'max':
+            quota = int(c_quota) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+                c_quota = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+                period = int(f.read())
+            if c_quota > 0:
+                quota = c_quota / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        nCPUs = min(nCPUs, max(1, int(quota)))
+    
+    return nCPUs
+
 def checkCudaTF():
     import tensorflow as tf
 
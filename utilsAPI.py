@@ -52,12 +52,37 @@ def getStatusEmails():
 def getErrorLogBool():
     return config('ERROR_LOG', default=False, cast=bool)
 
+def getProfileUploadBool():
+    # Attach stage profiles (utilsProfiler) to trials.
+    return config('PROFILE_UPLOAD', default=False, cast=bool)
+
 def getAppPullWaitTimeAndJitter():
     time = config('APP_PULL_WAIT_TIME', default=5.0, cast=float)
     jitter = config('APP_PULL_WAIT_TIME_JITTER', default=1.0, cast=float)
 
     return time, jitter
 
+def getPipelinedWorkerSettings():
+    # The pipelined worker (utilsWorker) is off by default.
+    settings = {
+        'enabled': config('PIPELINED_WORKER', default=False, cast=bool),
+        'maxTrials': config('PIPELINED_WORKER_MAX_TRIALS', default=3, cast=int),
+        'nIOWorkers': config('PIPELINED_WORKER_IO', default=2, cast=int),
+        'nGPUWorkers': config('PIPELINED_WORKER_GPU', default=1, cast=int),
+        'nCPUWorkers': config('PIPELINED_WORKER_CPU', default=1, cast=int)}
+
+    return settings
+
+def getVisualizerSettings():
+    # Frame rate of the visualizer transforms (0: frame rate of the motion)
+    # and whether they are also written in the compact binary format.
+    frameRate = config('VISUALIZER_FRAME_RATE', default=0.0, cast=float)
+    settings = {
+        'outputFrameRate': frameRate if frameRate > 0 else None,
+        'binary': config('VISUALIZER_BINARY', default=False, cast=bool)}
+
+    return settings
+
 def getLogLevel():
     log_level_str = config('LOG_LEVEL', default='INFO')
     log_level = getattr(logging, log_level_str.upper(), logging.INFO)
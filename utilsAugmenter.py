@@ -3,163 +3,230 @@ import numpy as np
 import utilsDataman
 import copy
 import tensorflow as tf
-from utils import TRC2numpy
 import json
 
-def augmentTRC(pathInputTRCFile, subject_mass, subject_height,
-               pathOutputTRCFile, augmenterDir, augmenterModelName="LSTM",
-               augmenter_model='v0.3', offset=True):
-    
-    # This is by default - might need to be adjusted in the future.
-    featureHeight = True
-    featureWeight = True
-    
+# Loaded augmenter models, keyed by model directory. Models are loaded once
+# per process and kept warm across trials.
+_augmenterCache = {}
+
+def getAugmenterMarkers(augmenter_model='v0.3'):
+
     # Augmenter types
     if augmenter_model == 'v0.0':
         from utils import getOpenPoseMarkers_fullBody
-        feature_markers_full, response_markers_full = getOpenPoseMarkers_fullBody()         
+        feature_markers_full, response_markers_full = getOpenPoseMarkers_fullBody()
         augmenterModelType_all = [augmenter_model]
         feature_markers_all = [feature_markers_full]
-        response_markers_all = [response_markers_full]            
+        response_markers_all = [response_markers_full]
     elif augmenter_model == 'v0.1' or augmenter_model == 'v0.2':
-        # Lower body           
+        # Lower body
         augmenterModelType_lower = '{}_lower'.format(augmenter_model)
         from utils import getOpenPoseMarkers_lowerExtremity
         feature_markers_lower, response_markers_lower = getOpenPoseMarkers_lowerExtremity()
         # Upper body
         augmenterModelType_upper = '{}_upper'.format(augmenter_model)
         from utils import getMarkers_upperExtremity_noPelvis
-        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis()        
+        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis()
         augmenterModelType_all = [augmenterModelType_lower, augmenterModelType_upper]
         feature_markers_all = [feature_markers_lower, feature_markers_upper]
         response_markers_all = [response_markers_lower, response_markers_upper]
     else:
-        # Lower body           
+        # Lower body
         augmenterModelType_lower = '{}_lower'.format(augmenter_model)
         from utils import getOpenPoseMarkers_lowerExtremity2
         feature_markers_lower, response_markers_lower = getOpenPoseMarkers_lowerExtremity2()
         # Upper body
         augmenterModelType_upper = '{}_upper'.format(augmenter_model)
         from utils import getMarkers_upperExtremity_noPelvis2
-        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis2()        
+        feature_markers_upper, response_markers_upper = getMarkers_upperExtremity_noPelvis2()
         augmenterModelType_all = [augmenterModelType_lower, augmenterModelType_upper]
         feature_markers_all = [feature_markers_lower, feature_markers_upper]
         response_markers_all = [response_markers_lower, response_markers_upper]
+
+    return augmenterModelType_all, feature_markers_all, response_markers_all
+
+def loadAugmenterModel(augmenterModelDir):
+    # Returns the model, metadata and normalization arrays of an augmenter,
+    # loading them only the first time.
+
+    key = os.path.abspath(augmenterModelDir)
+    if key in _augmenterCache:
+        return _augmenterCache[key]
+
+    with open(os.path.join(augmenterModelDir, "metadata.json"), 'r') as f:
+        metadata = json.load(f)
+
+    pathMean = os.path.join(augmenterModelDir, "mean.npy")
+    pathSTD = os.path.join(augmenterModelDir, "std.npy")
+    trainFeatures_mean, trainFeatures_std = None, None
+    if os.path.isfile(pathMean):
+        trainFeatures_mean = np.load(pathMean, allow_pickle=True)
+    if os.path.isfile(pathSTD):
+        trainFeatures_std = np.load(pathSTD, allow_pickle=True)
+
+    json_file = open(os.path.join(augmenterModelDir, "model.json"), 'r')
+    pretrainedModel_json = json_file.read()
+    json_file.close()
+    model = tf.keras.models.model_from_json(pretrainedModel_json)
+    model.load_weights(os.path.join(augmenterModelDir, "weights.h5"))
+
+    _augmenterCache[key] = {'model': model, 'metadata': metadata,
+                            'mean': trainFeatures_mean,
+                            'std': trainFeatures_std}
+
+    return _augmenterCache[key]
+
+def loadAugmenters(augmenterDir, augmenterModelName="LSTM",
+                   augmenter_models=['v0.0', 'v0.1', 'v0.2', 'v0.3']):
+    # Loads augmenter models ahead of time, eg when a worker starts.
+
+    for augmenter_model in augmenter_models:
+        augmenterModelType_all, _, _ = getAugmenterMarkers(augmenter_model)
+        for augmenterModelType in augmenterModelType_all:
+            loadAugmenterModel(os.path.join(augmenterDir, augmenterModelName,
+                                            augmenterModelType))
+
+def clearAugmenterCache():
+
+    _augmenterCache.clear()
+    tf.keras.backend.clear_session()
+
+def augmentTRC(pathInputTRCFile, subject_mass, subject_height,
+               pathOutputTRCFile, augmenterDir, augmenterModelName="LSTM",
+               augmenter_model='v0.3', offset=True, markerSet=None):
+    # markerSet is the utilsDataman.MarkerSet of pathInputTRCFile, if already
+    # in memory.
+
+    trial = {'pathInputTRCFile': pathInputTRCFile,
+             'subject_mass': subject_mass,
+             'subject_height': subject_height,
+             'pathOutputTRCFile': pathOutputTRCFile,
+             'markerSet': markerSet}
+    min_y_pos = augmentTRCs([trial], augmenterDir,
+                            augmenterModelName=augmenterModelName,
+                            augmenter_model=augmenter_model, offset=offset)[0]
+
+    return min_y_pos
+
+def augmentTRCs(trials, augmenterDir, augmenterModelName="LSTM",
+                augmenter_model='v0.3', offset=True):
+    # Augments several trials with one predict call per augmenter model.
+    # trials is a list of dicts with keys pathInputTRCFile, subject_mass,
+    # subject_height and pathOutputTRCFile, and optionally markerSet (the
+    # input markers, read from pathInputTRCFile if None). Markers are kept in
+    # memory and each output file is written once. Returns the minimum
+    # y-position across response markers of each trial.
+
+    # This is by default - might need to be adjusted in the future.
+    featureHeight = True
+    featureWeight = True
+
+    augmenterModelType_all, feature_markers_all, response_markers_all = (
+        getAugmenterMarkers(augmenter_model))
     # print('Using augmenter model: {}'.format(augmenter_model))
-    
+
     # %% Process data.
-    # Import TRC file
-    trc_file = utilsDataman.TRCFile(pathInputTRCFile)
-    
+    # Import TRC files
+    trc_files = [utilsDataman.MarkerSet.read(trial['pathInputTRCFile'])
+                 if trial.get('markerSet') is None else
+                 trial['markerSet'].copy() for trial in trials]
+
     # Loop over augmenter types to handle separate augmenters for lower and
     # upper bodies.
-    outputs_all = {}
-    n_response_markers_all = 0
+    responses_all = [[] for _ in trials]
     for idx_augm, augmenterModelType in enumerate(augmenterModelType_all):
-        outputs_all[idx_augm] = {}
         feature_markers = feature_markers_all[idx_augm]
         response_markers = response_markers_all[idx_augm]
-        
-        augmenterModelDir = os.path.join(augmenterDir, augmenterModelName, 
+
+        augmenterModelDir = os.path.join(augmenterDir, augmenterModelName,
                                          augmenterModelType)
-        
+        augmenter = loadAugmenterModel(augmenterModelDir)
+        referenceMarker = augmenter['metadata']['reference_marker']
+
         # %% Pre-process inputs.
-        # Step 1: import .trc file with OpenPose marker trajectories.  
-        trc_data = TRC2numpy(pathInputTRCFile, feature_markers)
-        trc_data_data = trc_data[:,1:]
-        
-        # Step 2: Normalize with reference marker position.
-        with open(os.path.join(augmenterModelDir, "metadata.json"), 'r') as f:
-            metadata = json.load(f)
-        referenceMarker = metadata['reference_marker']
-        referenceMarker_data = trc_file.marker(referenceMarker)
-        norm_trc_data_data = np.zeros((trc_data_data.shape[0],
-                                       trc_data_data.shape[1]))
-        for i in range(0,trc_data_data.shape[1],3):
-            norm_trc_data_data[:,i:i+3] = (trc_data_data[:,i:i+3] - 
-                                           referenceMarker_data)
-            
-        # Step 3: Normalize with subject's height.
-        norm2_trc_data_data = copy.deepcopy(norm_trc_data_data)
-        norm2_trc_data_data = norm2_trc_data_data / subject_height
-        
-        # Step 4: Add remaining features.
-        inputs = copy.deepcopy(norm2_trc_data_data)
-        if featureHeight:    
-            inputs = np.concatenate(
-                (inputs, subject_height*np.ones((inputs.shape[0],1))), axis=1)
-        if featureWeight:    
-            inputs = np.concatenate(
-                (inputs, subject_mass*np.ones((inputs.shape[0],1))), axis=1)
-            
-        # Step 5: Pre-process data
-        pathMean = os.path.join(augmenterModelDir, "mean.npy")
-        pathSTD = os.path.join(augmenterModelDir, "std.npy")
-        if os.path.isfile(pathMean):
-            trainFeatures_mean = np.load(pathMean, allow_pickle=True)
-            inputs -= trainFeatures_mean
-        if os.path.isfile(pathSTD):
-            trainFeatures_std = np.load(pathSTD, allow_pickle=True)
-            inputs /= trainFeatures_std 
-            
-        # Step 6: Reshape inputs if necessary (eg, LSTM)
+        inputs_all, referenceMarker_data_all = [], []
+        for trial, trc_file in zip(trials, trc_files):
+            subject_height = trial['subject_height']
+            subject_mass = trial['subject_mass']
+
+            # Step 1: import .trc file with OpenPose marker trajectories.
+            trc_data_data = trc_file.markers(feature_markers)
+
+            # Step 2: Normalize with reference marker position.
+            referenceMarker_data = trc_file.marker(referenceMarker)
+            norm_trc_data_data = (
+                trc_data_data.reshape((trc_data_data.shape[0], -1, 3)) -
+                referenceMarker_data[:,None,:]).reshape(trc_data_data.shape)
+
+            # Step 3: Normalize with subject's height.
+            norm2_trc_data_data = norm_trc_data_data / subject_height
+
+            # Step 4: Add remaining features.
+            inputs = copy.deepcopy(norm2_trc_data_data)
+            if featureHeight:
+                inputs = np.concatenate(
+                    (inputs, subject_height*np.ones((inputs.shape[0],1))), axis=1)
+            if featureWeight:
+                inputs = np.concatenate(
+                    (inputs, subject_mass*np.ones((inputs.shape[0],1))), axis=1)
+
+            # Step 5: Pre-process data
+            if augmenter['mean'] is not None:
+                inputs -= augmenter['mean']
+            if augmenter['std'] is not None:
+                inputs /= augmenter['std']
+
+            inputs_all.append(inputs)
+            referenceMarker_data_all.append(referenceMarker_data)
+
+        # %% Predict outputs of all trials at once.
+        nFrames_all = [inputs.shape[0] for inputs in inputs_all]
         if augmenterModelName == "LSTM":
-            inputs = np.reshape(inputs, (1, inputs.shape[0], inputs.shape[1]))
-            
-        # %% Load model and weights, and predict outputs.
-        json_file = open(os.path.join(augmenterModelDir, "model.json"), 'r')
-        pretrainedModel_json = json_file.read()
-        json_file.close()
-        model = tf.keras.models.model_from_json(pretrainedModel_json)
-        model.load_weights(os.path.join(augmenterModelDir, "weights.h5"))  
-        outputs = model.predict(inputs, verbose=2)
-        
+            # Zero-pad sequences at the end to a common length. The LSTMs are
+            # causal (forward only), so the outputs of each trial's frames do
+            # not depend on the padding, which is cropped afterwards.
+            batch = np.zeros((len(inputs_all), max(nFrames_all),
+                              inputs_all[0].shape[1]))
+            for i, inputs in enumerate(inputs_all):
+                batch[i,:inputs.shape[0]] = inputs
+            outputs = augmenter['model'].predict(batch, verbose=2)
+            outputs_all = [outputs[i,:nFrames]
+                           for i, nFrames in enumerate(nFrames_all)]
+        else:
+            outputs = augmenter['model'].predict(
+                np.concatenate(inputs_all, axis=0), verbose=2)
+            outputs_all = np.split(outputs, np.cumsum(nFrames_all)[:-1])
+
         # %% Post-process outputs.
-        # Step 1: Reshape if necessary (eg, LSTM)
-        if augmenterModelName == "LSTM":
-            outputs = np.reshape(outputs, (outputs.shape[1], outputs.shape[2]))
-            
-        # Step 2: Un-normalize with subject's height.
-        unnorm_outputs = outputs * subject_height
-        
-        # Step 2: Un-normalize with reference marker position.
-        unnorm2_outputs = np.zeros((unnorm_outputs.shape[0],
-                                    unnorm_outputs.shape[1]))
-        for i in range(0,unnorm_outputs.shape[1],3):
-            unnorm2_outputs[:,i:i+3] = (unnorm_outputs[:,i:i+3] + 
-                                        referenceMarker_data)
-            
-        # %% Add markers to .trc file.
-        for c, marker in enumerate(response_markers):
-            x = unnorm2_outputs[:,c*3]
-            y = unnorm2_outputs[:,c*3+1]
-            z = unnorm2_outputs[:,c*3+2]
-            trc_file.add_marker(marker, x, y, z)
-            
-        # %% Gather data for computing minimum y-position.
-        outputs_all[idx_augm]['response_markers'] = response_markers   
-        outputs_all[idx_augm]['response_data'] = unnorm2_outputs
-        n_response_markers_all += len(response_markers)
-        
-    # %% Extract minimum y-position across response markers. This is used
-    # to align feet and floor when visualizing.
-    responses_all_conc = np.zeros((unnorm2_outputs.shape[0],
-                                   n_response_markers_all*3))
-    idx_acc_res = 0
-    for idx_augm in outputs_all:
-        idx_acc_res_end = (idx_acc_res + 
-                           (len(outputs_all[idx_augm]['response_markers']))*3)
-        responses_all_conc[:,idx_acc_res:idx_acc_res_end] = (
-            outputs_all[idx_augm]['response_data'])
-        idx_acc_res = idx_acc_res_end
-    # Minimum y-position across response markers.
-    min_y_pos = np.min(responses_all_conc[:,1::3])
-        
-    # %% If offset
-    if offset:
-        trc_file.offset('y', -(min_y_pos-0.01))
-        
-    # %% Return augmented .trc file   
-    trc_file.write(pathOutputTRCFile)
-    
-    return min_y_pos
+        for i, (trial, trc_file) in enumerate(zip(trials, trc_files)):
+            # Step 1: Un-normalize with subject's height.
+            unnorm_outputs = outputs_all[i] * trial['subject_height']
+
+            # Step 2: Un-normalize with reference marker position.
+            unnorm2_outputs = (
+                unnorm_outputs.reshape((unnorm_outputs.shape[0], -1, 3)) +
+                referenceMarker_data_all[i][:,None,:]).reshape(
+                    unnorm_outputs.shape)
+
+            # %% Add markers to .trc file.
+            trc_file.add_markers(response_markers, unnorm2_outputs)
+
+            # %% Gather data for computing minimum y-position.
+            responses_all[i].append(unnorm2_outputs)
+
+    min_y_pos_all = []
+    for i, (trial, trc_file) in enumerate(zip(trials, trc_files)):
+        # %% Extract minimum y-position across response markers. This is used
+        # to align feet and floor when visualizing.
+        responses_all_conc = np.concatenate(responses_all[i], axis=1)
+        min_y_pos = np.min(responses_all_conc[:,1::3])
+
+        # %% If offset
+        if offset:
+            trc_file.offset('y', -(min_y_pos-0.01))
+
+        # %% Return augmented .trc file
+        trc_file.write(trial['pathOutputTRCFile'])
+        min_y_pos_all.append(min_y_pos)
+
+    return min_y_pos_all
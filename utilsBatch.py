@@ -0,0 +1,248 @@
+"""Parallel batch reprocessing of sessions.
+
+The trials to reprocess are jobs in a ledger (a json file) recording their
+status (queued, running, done, failed), error text, stage timings and number
+of attempts. Jobs run in a pool of processes, so that an error or a crash in
+one trial does not stop the batch. Sessions are processed in parallel; the
+jobs of a session run one at a time, calibration first, then static, then
+dynamic trials, since they share the session folder and build on each other.
+Running a batch again with the same ledger resumes it: done jobs are skipped
+and jobs left running by a crash are queued again.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import traceback
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import (ProcessPoolExecutor, wait, FIRST_COMPLETED,
+                                BrokenExecutor)
+
+trialTypeOrder = {'calibration': 0, 'static': 1, 'dynamic': 2}
+
+# %% Default job, based on utilsServer.processTrial.
+def runBatchJob(job, settings):
+    # Processes a trial and patches its status. Returns the stage timings.
+
+    from utilsServer import (prepareTrial, runTrial, uploadTrial, API_URL,
+                             API_TOKEN)
+    from utils import makeRequestWithRetry
+
+    trial_url = "{}{}{}/".format(API_URL, "trials/", job['trial_id'])
+    timings = {}
+    try:
+        t0 = time.time()
+        trial = prepareTrial(
+            job['session_id'], job['trial_id'], trial_type=job['trial_type'],
+            poseDetector=settings.get('poseDetector', 'OpenPose'),
+            isDocker=settings.get('isDocker', False),
+            resolutionPoseDetection=settings.get('resolutionPoseDetection',
+                                                 'default'),
+            use_existing_pose_pickle=settings.get('use_existing_pose_pickle',
+                                                  False),
+            batchProcess=job['trial_type'] != 'calibration')
+        timings['download'] = time.time() - t0
+
+        runTrial(trial, cameras_to_use=settings.get('cameras_to_use', ['all']))
+        timings.update(trial['profiler'].summary())
+
+        if job['hasWritePermissions']:
+            t0 = time.time()
+            uploadTrial(trial)
+            timings['upload'] = time.time() - t0
+        else:
+            logging.info('You are not the owner of this session, so do not have permission to write results to database.')
+
+        makeRequestWithRetry('PATCH', trial_url, data={'status': 'done'},
+                             headers={"Authorization": "Token {}".format(API_TOKEN)})
+    except Exception:
+        makeRequestWithRetry('PATCH', trial_url, data={'status': 'error'},
+                             headers={"Authorization": "Token {}".format(API_TOKEN)})
+        raise
+
+    return timings
+
+# %%
+def _runJob(jobFn, job, settings):
+    # Runs in the worker process. Errors are returned as text, such that the
+    # full traceback ends up in the ledger.
+
+    t0 = time.time()
+    try:
+        timings = jobFn(job, settings) or {}
+        status, error = 'done', None
+    except Exception:
+        timings = {}
+        status, error = 'failed', traceback.format_exc()
+    timings['total'] = time.time() - t0
+
+    return status, timings, error
+
+# %%
+def getJobs(session_id, calib_id, static_id, dynamic_ids,
+            hasWritePermissions=True):
+    # Jobs of a session in processing order. Empty ids are skipped.
+
+    jobs = []
+    for trial_type, trial_ids in [('calibration', [calib_id]),
+                                  ('static', [static_id]),
+                                  ('dynamic', dynamic_ids)]:
+        for trial_id in trial_ids:
+            if trial_id is not None and len(trial_id) > 0:
+                jobs.append({'session_id': session_id, 'trial_id': trial_id,
+                             'trial_type': trial_type,
+                             'hasWritePermissions': hasWritePermissions})
+
+    return jobs
+
+# %%
+class BatchLedger(object):
+    """Status of the jobs of a batch, saved to path after each change."""
+
+    def __init__(self, path):
+
+        self.path = path
+        self.jobs = []
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.jobs = json.load(f)['jobs']
+        self.index = {job['trial_id']: job for job in self.jobs}
+
+    def save(self):
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'jobs': self.jobs}, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def addJobs(self, jobs, retryFailed=False):
+        # Adds new jobs and requeues jobs interrupted by a crash (and failed
+        # jobs if retryFailed). Jobs of a session are kept in processing
+        # order.
+
+        for job in jobs:
+            if job['trial_id'] not in self.index:
+                job = dict(job, status='queued', error=None, attempts=0,
+                           timings={}, started=None, finished=None)
+                self.jobs.append(job)
+                self.index[job['trial_id']] = job
+        for job in self.jobs:
+            if job['status'] == 'running' or (
+                    retryFailed and job['status'] == 'failed'):
+                job['status'] = 'queued'
+        sessionOrder = {}
+        for job in self.jobs:
+            sessionOrder.setdefault(job['session_id'], len(sessionOrder))
+        self.jobs.sort(key=lambda job: (sessionOrder[job['session_id']],
+                                        trialTypeOrder[job['trial_type']]))
+        self.save()
+
+    def nextJobs(self, busySessions, trial_ids=None):
+        # First queued job of each session that is not busy.
+
+        jobs = []
+        sessions = set(busySessions)
+        for job in self.jobs:
+            if trial_ids is not None and job['trial_id'] not in trial_ids:
+                continue
+            if job['status'] == 'queued' and job['session_id'] not in sessions:
+                jobs.append(job)
+                sessions.add(job['session_id'])
+
+        return jobs
+
+    def update(self, trial_id, **fields):
+
+        self.index[trial_id].update(fields)
+        self.save()
+
+    def summary(self):
+
+        summary = {}
+        for job in self.jobs:
+            summary[job['status']] = summary.get(job['status'], 0) + 1
+
+        return summary
+
+# %%
+def runBatch(jobs, ledgerPath, nWorkers=1, settings={}, jobFn=runBatchJob,
+             retryFailed=False, maxAttempts=2, deleteLocalFolder=False):
+    # Runs jobs (see getJobs) in nWorkers processes. Jobs already in the
+    # ledger keep their status, see BatchLedger.addJobs. A job running when
+    # a worker process crashes is queued again, up to maxAttempts times.
+    # Returns the ledger.
+
+    ledger = BatchLedger(ledgerPath)
+    ledger.addJobs(jobs, retryFailed=retryFailed)
+    trial_ids = set(job['trial_id'] for job in jobs)
+
+    # Workers are spawned rather than forked, such that they do not inherit
+    # state (eg threads, GPU contexts) of the parent process.
+    context = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(max_workers=nWorkers, mp_context=context)
+    running = {}
+    try:
+        while True:
+            busySessions = [job['session_id'] for job in running.values()]
+            for job in ledger.nextJobs(busySessions, trial_ids):
+                if len(running) >= nWorkers:
+                    break
+                logging.info('Processing {} trial {} of session {}'.format(
+                    job['trial_type'], job['trial_id'], job['session_id']))
+                ledger.update(job['trial_id'], status='running',
+                              attempts=job['attempts'] + 1,
+                              started=datetime.now().isoformat())
+                running[pool.submit(_runJob, jobFn, job, settings)] = job
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            poolBroken = any(isinstance(future.exception(), BrokenExecutor)
+                             for future in done)
+            if poolBroken:
+                # The jobs running in the other workers fail with the pool.
+                done, _ = wait(running)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    status, timings, error = future.result()
+                except BrokenExecutor:
+                    status = 'queued'
+                    if job['attempts'] >= maxAttempts:
+                        status = 'failed'
+                    timings = {}
+                    error = 'Worker process crashed.'
+                ledger.update(job['trial_id'], status=status, error=error,
+                              timings=timings,
+                              finished=datetime.now().isoformat())
+                if status == 'failed':
+                    logging.error('Trial {} failed:\n{}'.format(
+                        job['trial_id'], error))
+
+                # Remove the session folder after its last job.
+                session_id = job['session_id']
+                if deleteLocalFolder and not any(
+                        j['session_id'] == session_id and
+                        j['status'] in ['queued', 'running']
+                        for j in ledger.jobs if j['trial_id'] in trial_ids):
+                    # Imported here since utils logs in at import.
+                    from utils import getDataDirectory
+                    session_path = os.path.join(
+                        getDataDirectory(isDocker=settings.get('isDocker', False)),
+                        'Data', session_id)
+                    if os.path.isdir(session_path):
+                        shutil.rmtree(session_path)
+
+            if poolBroken:
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=nWorkers,
+                                           mp_context=context)
+    finally:
+        pool.shutdown(wait=True)
+
+    logging.info('Batch done: {}'.format(ledger.summary()))
+
+    return ledger
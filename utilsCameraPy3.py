@@ -880,6 +880,60 @@ def nview_linear_triangulations(cameras, image_points,weights=None):
     return world,confidence
 
 
+def nview_linear_triangulations_batch(cameras, image_points, weights=None):
+    """
+    Computes world coordinates from image correspondences in n views, solving
+    all DLT systems with a single stacked SVD. Gives the same results as
+    nview_linear_triangulations.
+    :param cameras: pinhole models of cameras corresponding to views
+    :type cameras: sequence of Camera objects
+    :param image_points: image coordinates of m correspondences in n views
+    :type image_points: numpy.ndarray, shape=(n, m, 2)
+    :param weights: confidence of each correspondence in each view
+    :type weights: numpy.ndarray, shape=(n, m)
+    :return: m world coordinates and their confidence
+    :rtype: numpy.ndarray, shape=(3, m), numpy.ndarray, shape=(1, m)
+    """
+    assert(type(cameras) == list)
+    image_points = np.asarray(image_points, dtype=float)
+    assert(image_points.shape[0] == len(cameras))
+    assert(image_points.shape[2] == 2)
+    nCams, nPoints = image_points.shape[:2]
+
+    if weights is None:
+        weights = np.ones((nCams, nPoints))
+    else:
+        weights = np.asarray(weights, dtype=float).reshape((nCams, nPoints))
+    w = np.nan_to_num(weights, nan=0.5) # turns nan confidences into 0.5
+
+    # D blocks for all points and cameras, see [1, p. 88].
+    P = np.stack([cam.P for cam in cameras]) # (n, 3, 4)
+    D = np.empty((nPoints, 2 * nCams, 4))
+    D[:, 0::2, :] = np.swapaxes(w[:, :, None] * (
+        image_points[:, :, 0, None] * P[:, None, 2, :] - P[:, None, 0, :]),
+        0, 1)
+    D[:, 1::2, :] = np.swapaxes(w[:, :, None] * (
+        image_points[:, :, 1, None] * P[:, None, 2, :] - P[:, None, 1, :]),
+        0, 1)
+    Q = np.matmul(np.swapaxes(D, 1, 2), D)
+    u, s, vh = np.linalg.svd(Q)
+    world = p2e(u[:, :, -1].T)
+
+    # Confidence is the mean of the non-zero weights (nans ignored, 0.5 if all
+    # are nan), and points seen by less than 2 cameras are set to 0.
+    nonZero = weights != 0
+    valid = np.count_nonzero(nonZero, axis=0) >= 2
+    finite = nonZero & ~np.isnan(weights)
+    nFinite = np.count_nonzero(finite, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        conf = np.where(finite, weights, 0).sum(axis=0) / nFinite
+    conf[nFinite == 0] = .5
+    conf[~valid] = 0
+    world[:, ~valid] = 0
+
+    return world, conf[None, :]
+
+
 def calibrate_division_model(line_coordinates, y0, z_n, focal_length=1):
     """
     Calibrate division model by making lines straight.
@@ -7,24 +7,25 @@ import os
 import glob 
 import pickle
 import json
-import subprocess
 import urllib.request
 import shutil
 import utilsDataman
 import requests
-import ffmpeg
 import matplotlib.pyplot as plt
 from scipy.ndimage import gaussian_filter1d
-from scipy.signal import gaussian, sosfiltfilt, butter, find_peaks
+from scipy.signal import gaussian, sosfiltfilt, butter, find_peaks, fftconvolve
 from scipy.interpolate import pchip_interpolate
 from scipy.spatial.transform import Rotation 
 import scipy.linalg
 from itertools import combinations
 import copy
 from utilsCameraPy3 import Camera, nview_linear_triangulations
+from utilsCameraPy3 import nview_linear_triangulations_batch
 from utils import getOpenPoseMarkerNames, getOpenPoseFaceMarkers
-from utils import numpy2TRC, rewriteVideos, delete_multiple_element,loadCameraParameters
+from utils import rewriteVideos, delete_multiple_element,loadCameraParameters
 from utils import makeRequestWithRetry
+from utilsPoseStore import loadPose, getPeopleKeypoints
+from utilsVideo import getVideoMetadata, readVideoFrames
 from utilsAPI import getAPIURL
 
 from utilsAuth import getToken
@@ -40,11 +41,7 @@ def download_file(url, file_name):
 
 # %% 
 def getVideoLength(filename):
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1", filename],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        return float(result.stdout)
+        return getVideoMetadata(filename)['duration']
 
 # %%
 def video2Images(videoPath, nImages=12, tSingleImage=None, filePrefix='output', skipIfRun=True, outputFolder='default'):
@@ -53,24 +50,26 @@ def video2Images(videoPath, nImages=12, tSingleImage=None, filePrefix='output',
     if outputFolder == 'default':
         outputFolder = os.path.dirname(videoPath)
     
+    if tSingleImage is not None:
+        outImagePath = os.path.join(outputFolder,filePrefix + '0.png')
+    else:
+        outImagePath = os.path.join(outputFolder,filePrefix) + '0.jpg'
+    
     # already written out?
     if not os.path.exists(os.path.join(outputFolder, filePrefix + '_0.jpg')) or not skipIfRun: 
         if tSingleImage is not None: # pop single image at time value
-            CMD = ('ffmpeg -loglevel error -skip_frame nokey -y -ss ' + str(tSingleImage) + ' -i ' + videoPath + 
-                   " -qmin 1 -q:v 1 -frames:v 1 -vf select='-eq(pict_type\,I)' " + 
-                   os.path.join(outputFolder,filePrefix + '0.png'))
-            os.system(CMD)
-            outImagePath = os.path.join(outputFolder,filePrefix + '0.png')
+            image = readVideoFrames(videoPath, times=[tSingleImage])[0]
+            if image is not None:
+                cv2.imwrite(outImagePath, image)
            
-        else: # pop multiple images from video
+        else: # pop multiple images from video, all from one decode pass
             lengthVideo = getVideoLength(videoPath)
             timeImageSamples = np.linspace(1,lengthVideo-1,nImages) # disregard first and last second
-            for iFrame,t_image in enumerate(timeImageSamples):
-                CMD = ('ffmpeg -loglevel error -skip_frame nokey -ss ' + str(t_image) + ' -i ' + videoPath + 
-                       " -qmin 1 -q:v 1 -frames:v 1 -vf select='-eq(pict_type\,I)' " + 
-                       os.path.join(outputFolder,filePrefix) + '_' + str(iFrame) + '.jpg')
-                os.system(CMD)
-                outImagePath = os.path.join(outputFolder,filePrefix) + '0.jpg'
+            images = readVideoFrames(videoPath, times=timeImageSamples)
+            for iFrame,image in enumerate(images):
+                if image is not None:
+                    cv2.imwrite(os.path.join(outputFolder,filePrefix) + '_' + str(iFrame) + '.jpg',
+                                image, [cv2.IMWRITE_JPEG_QUALITY, 100])
                 
     return outImagePath
         
@@ -288,26 +287,7 @@ def saveCameraParameters(filename,CameraParams):
 #%% 
 def getVideoRotation(videoPath):
     
-    
-    meta = ffmpeg.probe(videoPath)
-    try:
-        rotation = meta['format']['tags']['com.apple.quicktime.video-orientation']
-    except:
-        # For AVI (after we rewrite video), no rotation paramter, so just using h and w. 
-        # For now this is ok, we don't need leaning right/left for this, just need to know
-        # how to orient the pose estimation resolution parameters.
-        try: 
-            if meta['format']['format_name'] == 'avi':
-                if meta['streams'][0]['height']>meta['streams'][0]['width']:
-                    rotation = 90
-                else:
-                    rotation = 0
-            else:
-                raise Exception('no rotation info')
-        except:
-            rotation = 90 # upright is 90, and intrinsics were captured in that orientation
-        
-    return int(rotation)
+    return getVideoMetadata(videoPath)['rotation']
 
 #%% 
 def rotateIntrinsics(CamParams,videoPath):
@@ -351,8 +331,10 @@ def rotateIntrinsics(CamParams,videoPath):
 # %% 
 def calcExtrinsics(imageFileName, CameraParams, CheckerBoardParams,
                    imageScaleFactor=1,visualize=False,
-                   imageUpsampleFactor=1,useSecondExtrinsicsSolution=False):
+                   imageUpsampleFactor=1,useSecondExtrinsicsSolution=False,
+                   image=None):
     # Camera parameters is a dictionary with intrinsics
+    # If image is passed (BGR array), it is used instead of reading imageFileName
     
     # stop the iteration when specified 
     # accuracy, epsilon, is reached or 
@@ -370,7 +352,10 @@ def calcExtrinsics(imageFileName, CameraParams, CheckerBoardParams,
     objectp3d = generate3Dgrid(CheckerBoardParams)
     
     # Load and resize image - remember calibration image res needs to be same as all processing
-    image = cv2.imread(imageFileName)
+    if image is None:
+        image = cv2.imread(imageFileName)
+    else:
+        image = image.copy()
     if imageScaleFactor != 1:
         dim = (int(imageScaleFactor*image.shape[1]),int(imageScaleFactor*image.shape[0]))
         image = cv2.resize(image,dim,interpolation=cv2.INTER_AREA)
@@ -587,8 +572,8 @@ def calcExtrinsicsFromVideo(videoPath, CamParams, CheckerBoardParams,
     # Get video parameters.
     vidLength = getVideoLength(videoPath)
     videoDir, videoName = os.path.split(videoPath)    
-    # Pick end of video as only sample point. For some reason, won't output
-    # video with t close to vidLength, so we count down til it does.
+    # Pick end of video as only sample point, and default to beginning if
+    # that frame can't be decoded. Both are read in a single decode pass.
     tSampPts = [np.round(vidLength-0.3, decimals=1)]    
     upsampleIters = 0
     for iTime,t in enumerate(tSampPts):
@@ -596,22 +581,21 @@ def calcExtrinsicsFromVideo(videoPath, CamParams, CheckerBoardParams,
         imagePath = os.path.join(videoDir, 'extrinsicImage0.png')
         if os.path.exists(imagePath):
             os.remove(imagePath)
-        while not os.path.exists(imagePath) and t>=0:
-            video2Images(videoPath, nImages=1, tSingleImage=t, filePrefix='extrinsicImage', skipIfRun=False)
-            t -= 0.2
-        # Default to beginning if can't find a keyframe.
-        if not os.path.exists(imagePath):
-            video2Images(videoPath, nImages=1, tSingleImage=0.01, filePrefix='extrinsicImage', skipIfRun=False)
-        # Throw error if it can't find a keyframe.
-        if not os.path.exists(imagePath):
+        images = [im for im in readVideoFrames(videoPath, times=[t, 0.01])
+                  if im is not None]
+        # Throw error if it can't find a frame.
+        if not images:
             exception = 'No calibration image could be extracted for at least one camera. Verify your setup and try again. Visit https://www.opencap.ai/best-pratices to learn more about camera calibration and https://www.opencap.ai/troubleshooting for potential causes for a failed calibration.'
             raise Exception(exception, exception)
-        # Try to find the checkerboard; return None if you can't find it.           
+        image = images[0]
+        cv2.imwrite(imagePath, image)
+        # Try to find the checkerboard; return None if you can't find it.
+        # Retries reuse the decoded image.
         CamParamsTemp = calcExtrinsics(
-            os.path.join(videoDir, 'extrinsicImage0.png'),
-            CamParams, CheckerBoardParams, visualize=visualize, 
+            imagePath, CamParams, CheckerBoardParams, visualize=visualize, 
             imageUpsampleFactor=imageUpsampleFactor,
-            useSecondExtrinsicsSolution=useSecondExtrinsicsSolution)
+            useSecondExtrinsicsSolution=useSecondExtrinsicsSolution,
+            image=image)
         while iTime == 0 and CamParamsTemp is None and upsampleIters < 3:
             if imageUpsampleFactor > 1: 
                 imageUpsampleFactor = 1
@@ -620,10 +604,10 @@ def calcExtrinsicsFromVideo(videoPath, CamParams, CheckerBoardParams,
             elif imageUpsampleFactor < 1:
                 imageUpsampleFactor = 1
             CamParamsTemp = calcExtrinsics(
-                os.path.join(videoDir, 'extrinsicImage0.png'),
-                CamParams, CheckerBoardParams, visualize=visualize, 
+                imagePath, CamParams, CheckerBoardParams, visualize=visualize, 
                 imageUpsampleFactor=imageUpsampleFactor,
-                useSecondExtrinsicsSolution=useSecondExtrinsicsSolution)
+                useSecondExtrinsicsSolution=useSecondExtrinsicsSolution,
+                image=image)
             upsampleIters += 1
         if CamParamsTemp is not None:
             # If checkerboard was found, exit.
@@ -1509,38 +1493,68 @@ def findClosestBox(bbox,keyBoxes,imageSize,iPerson=None):
         
     return iPerson,bbox,samePerson
 
+#%%
+def boxCornerDistances(boxesA, boxesB):
+    # boxesA: ... x nA x 4, boxesB: ... x nB x 4 (xTopLeft, yTopLeft, width,
+    # height).
+    # output: ... x nA x nB, norm of the change of the corners from each box
+    # of boxesA to each box of boxesB, as in findClosestBox.
+    
+    cornersA = np.concatenate((boxesA[...,:2], boxesA[...,:2] + boxesA[...,2:]),
+                              axis=-1)
+    cornersB = np.concatenate((boxesB[...,:2], boxesB[...,:2] + boxesB[...,2:]),
+                              axis=-1)
+    
+    # One corner coordinate at a time, to not build a ... x nA x nB x 4 array.
+    sqDistances = 0
+    for i in range(4):
+        sqDistances = sqDistances + np.square(
+            cornersA[...,:,None,i] - cornersB[...,None,:,i])
+    
+    return np.sqrt(sqDistances)
+
 #%%
 def trackKeypointBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0 ,
                      frameIncrement = 1, visualize = False, poseDetector='OpenPose',
-                     badFramesBeforeStop = 0):
+                     badFramesBeforeStop = 0, imageSize=None):
     
     # Extract camera name
     if videoPath.split('InputMedia')[0][-5:-2] == 'Cam': # <= 10 cams
         camName = videoPath.split('InputMedia')[0][-5:-1]
     else:
         camName = videoPath.split('InputMedia')[0][-6:-1]
+    
+    # Image size (height, width) from the video metadata, the video is only
+    # read to visualize.
+    if imageSize is None:
+        metadata = getVideoMetadata(videoPath.replace('.mov', '_rotated.avi'))
+        if metadata['width'] is None or metadata['height'] is None:
+            print('Cannot read video file')
+            raise Exception('Cannot read video file')
+        imageSize = (metadata['height'], metadata['width'])
+    if visualize:
+        video = cv2.VideoCapture(videoPath.replace('.mov', '_rotated.avi'))
+    
+    # Proportion of mean image dimensions that corners must change to be
+    # considered different person, as in findClosestBox.
+    cornerChangeThreshold = 0.2
+    maxBoxError = cornerChangeThreshold*np.mean(imageSize)
 
     # Tracks closest keypoint bounding boxes until the box changes too much.
-    bboxKey = bbStart # starting bounding box
-    frameNum = frameStart
-
-    # initiate video capture
-    # Read video
-    video = cv2.VideoCapture(videoPath.replace('.mov', '_rotated.avi'))
-    nFrames = allBoxes[0].shape[0]
+    boxes = np.stack(allBoxes, axis=1) # nFrames x nPeople x 4
+    nFrames = boxes.shape[0]
+    frames = np.arange(frameStart, nFrames if frameIncrement > 0 else -1,
+                       frameIncrement)
+    if len(frames) == 0:
+        return dataOut
     
-    # Read desiredFrames.
-    video.set(1, frameNum)
-    ok, frame = video.read()
-    if not ok:
-        print('Cannot read video file')
-        raise Exception('Cannot read video file')
-        
-    imageSize = (frame.shape[0],frame.shape[1])
+    bboxKey = bbStart # starting bounding box
+    iPersonKey = None # person of bboxKey in the previous tracked frame
     justStarted = True
-    count = 0   
     badFrames = []
-    while frameNum > -1 and frameNum < nFrames:
+    framesToZero = []
+    trackedPeople = [] # person of each tracked frame
+    for step, frameNum in enumerate(frames.tolist()):
         # Read a new frame
         
         if visualize:
@@ -1550,10 +1564,17 @@ def trackKeypointBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0
                 break
         
         # Find person closest to tracked bounding box, and fill their keypoint data
-        keyBoxes = [box[frameNum] for box in allBoxes]        
-        
-        iPerson, bboxKey_new, samePerson = findClosestBox(bboxKey, keyBoxes, 
-                                                imageSize)
+        if iPersonKey is None:
+            boxKey = np.asarray(bboxKey)
+        else:
+            boxKey = boxes[frames[step-1], iPersonKey]
+        boxErrors = boxCornerDistances(boxKey[None], boxes[frameNum])[0]
+        boxErrors[np.isnan(boxErrors)] = np.inf
+        iPerson = int(np.argmin(boxErrors))
+        boxError = boxErrors[iPerson]
+            
+        # If large jump in bounding box, not same person.
+        samePerson = boxError <= maxBoxError
         
         # We allow badFramesBeforeStop of samePerson = False to account for an
         # errant frame(s) in the pose detector. Once we reach badFramesBeforeStop,
@@ -1566,23 +1587,26 @@ def trackKeypointBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0
                 print('{}: not same person at {}'.format(camName, frameNum - frameIncrement*badFramesBeforeStop))
                 # Replace the data from the badFrames with zeros
                 if len(badFrames) > 1:
-                    dataOut[badFrames,:] = np.zeros(len(badFrames),dataOut.shape[0])
+                    framesToZero = badFrames
                 break     
             else:
                 badFrames.append(frameNum)
                 
        # Don't update the bboxKey for the badFrames
         if len(badFrames) == 0:
-            bboxKey = bboxKey_new
-
+            iPersonKey = iPerson
+        elif iPersonKey is not None:
+            bboxKey = boxes[frames[step-1], iPersonKey]
+            iPersonKey = None
         
-        dataOut[frameNum,:] = allPeople[iPerson][frameNum,:]
+        trackedPeople.append(iPerson)
         
         # Next frame 
-        frameNum += frameIncrement
         justStarted = False
         
         if visualize: 
+            if iPersonKey is not None:
+                bboxKey = boxes[frameNum, iPersonKey]
             p3 = (int(bboxKey[0]), int(bboxKey[1]))
             p4 = (int(bboxKey[0] + bboxKey[2]), int(bboxKey[1] + bboxKey[3]))
             cv2.rectangle(frame, p3, p4, (0,255,0), 2, 1)
@@ -1593,8 +1617,14 @@ def trackKeypointBox(videoPath,bbStart,allPeople,allBoxes,dataOut,frameStart = 0
             # Exit if ESC pressed
             k = cv2.waitKey(1) & 0xff
             if k == 27 : break
-        
-        count += 1
+    
+    # Fill the keypoint data of the tracked people.
+    trackedPeople = np.array(trackedPeople, dtype=int)
+    trackedFrames = frames[:len(trackedPeople)]
+    for iPerson in np.unique(trackedPeople):
+        idxFrames = trackedFrames[trackedPeople == iPerson]
+        dataOut[idxFrames,:] = allPeople[iPerson][idxFrames,:]
+    dataOut[framesToZero,:] = 0
   
     return dataOut
  
@@ -1904,13 +1934,8 @@ def getMarkerSpeed(key2D,idxMkrs = [0],confidence = None, confThresh = 0.2, aver
 
 # %%
 def smoothKeypoints(key2D,sdKernel=1):
-    key2D_out = np.copy(key2D)
-    for i in range(25):
-        for j in range(2):
-            key2D_out[i,:,j] = np.apply_along_axis(
-                lambda x: gaussian_filter1d(x, sdKernel),
-                arr = key2D_out[i,:,j],
-                axis = 0)
+    key2D_out = gaussian_filter1d(np.asarray(key2D, dtype=float), sdKernel, 
+                                  axis=1)
     return key2D_out
 
 # %% 
@@ -1957,124 +1982,183 @@ def clean2Dkeypoints(key2D, confidence, confidenceThreshold=0.5, nCams=2,
     
     nMkrs = key2D_out.shape[0]    
     markerNames = getOpenPoseMarkerNames()
+    faceMarkers, idxFaceMarkers = getOpenPoseFaceMarkers()
     
     # Turn all 0s into nans.
     key2D_out[key2D_out==0] = np.nan    
     
-    # Turn low confidence values to 0s if >2 cameras and nans otherwise.
-    for i in range(nMkrs):        
-        # If a marker has at least two frames with positive confidence,
-        # then identify frames where confidence is lower than threshold.
-        if len(np.argwhere(confidence_out[i,:]>0))>2:
-            nanInds = np.where(confidence_out[i,:] < confidenceThreshold)
-        # If a marker doesn't have two frames with positive confidence,
-        # then return empty list.    
-        else:
-            nanInds = []
-            faceMarkers = getOpenPoseFaceMarkers()[0]
-            # no warning if face marker
-            if not markerNames[i] in faceMarkers:
-                print('There were <2 frames with >0 confidence for {}'.format(
-                    markerNames[i]))
-        # Turn low confidence values to 0s if >2 cameras.
-        # Frames with confidence values of 0s are ignored during triangulation.
-        if nCams>2:
-            confidence_out[i,nanInds] = 0
-        # Turn low confidence values to nans if 2 cameras.
-        # Frames with nan confidence values are splined, and nan confidences
-        # are replaced by 0.5 during triangulation.
-        else:
-            confidence_out[i,nanInds] = np.nan            
-        # Turn inleading and exiting nans into 0s
-        idx_nonnans = ~np.isnan(confidence_out[i,:])
-        idx_nonzeros  = confidence_out[i,:] != 0            
-        idx_nonnanszeros = idx_nonnans & idx_nonzeros
-        if True in idx_nonnanszeros:
-            idx_nonnanszeros_first = np.where(idx_nonnanszeros)[0][0]
-            idx_nonnanszeros_last = np.where(idx_nonnanszeros)[0][-1]
-            confidence_out[i,:idx_nonnanszeros_first] = 0
-            confidence_out[i,idx_nonnanszeros_last:] = 0 
-        else:
-            confidence_out[i,:] = 0                    
-            
-        # Turn low confidence values to 0s for confidence_sync_out whatever
-        # the number of cameras; confidence_sync_out is used for 
-        # calculating the reprojection error, and using nans rather than 
-        # 0s might affect the outcome.
-        confidence_sync_out[i,nanInds] = 0
-        # Turn inleading and exiting nans into 0s
-        idx_nonnans = ~np.isnan(confidence_sync_out[i,:])
-        idx_nonzeros  = confidence_sync_out[i,:] != 0            
-        idx_nonnanszeros = idx_nonnans & idx_nonzeros
-        if True in idx_nonnanszeros:
-            idx_nonnanszeros_first = np.where(idx_nonnanszeros)[0][0]
-            idx_nonnanszeros_last = np.where(idx_nonnanszeros)[0][-1]
-            confidence_sync_out[i,:idx_nonnanszeros_first] = 0
-            confidence_sync_out[i,idx_nonnanszeros_last:] = 0 
-        else:
-            confidence_sync_out[i,:] = 0
-        
-        # Turn keypoint values to nan if confidence is low. Keypoints with nan
-        # will be interpolated. In cases with more than 2 cameras, this will
-        # have no impact on triangulation, since corresponding confidence is 0.
-        # But with 2 cameras, we need the keypoint 2D coordinates to
-        # be interpolated. In both cases, not relying on garbage keypoints for
-        # interpolation matters when computing keypoint speeds, which are used
-        # for synchronization.            
-        key2D_out[i,nanInds,:] = np.nan
-    
-    # Helper function.
-    def nan_helper(y):
-        return np.isnan(y), lambda z: z.nonzero()[0]
+    # If a marker has at least two frames with positive confidence,
+    # then identify frames where confidence is lower than threshold.
+    # If a marker doesn't have two frames with positive confidence,
+    # then do not change it.
+    enoughConf = np.count_nonzero(confidence_out>0, axis=1) > 2
+    for i in np.argwhere(~enoughConf).flatten():
+        # no warning if face marker
+        if not markerNames[i] in faceMarkers:
+            print('There were <2 frames with >0 confidence for {}'.format(
+                markerNames[i]))
+    nanInds = (confidence_out < confidenceThreshold) & enoughConf[:,None]
+    
+    # Turn low confidence values to 0s if >2 cameras.
+    # Frames with confidence values of 0s are ignored during triangulation.
+    if nCams>2:
+        confidence_out[nanInds] = 0
+    # Turn low confidence values to nans if 2 cameras.
+    # Frames with nan confidence values are splined, and nan confidences
+    # are replaced by 0.5 during triangulation.
+    else:
+        confidence_out[nanInds] = np.nan
+    # Turn inleading and exiting nans into 0s
+    confidence_out[getInOutFrames(confidence_out)] = 0
+    
+    # Turn low confidence values to 0s for confidence_sync_out whatever
+    # the number of cameras; confidence_sync_out is used for 
+    # calculating the reprojection error, and using nans rather than 
+    # 0s might affect the outcome.
+    confidence_sync_out[nanInds] = 0
+    # Turn inleading and exiting nans into 0s
+    confidence_sync_out[getInOutFrames(confidence_sync_out)] = 0
+    
+    # Turn keypoint values to nan if confidence is low. Keypoints with nan
+    # will be interpolated. In cases with more than 2 cameras, this will
+    # have no impact on triangulation, since corresponding confidence is 0.
+    # But with 2 cameras, we need the keypoint 2D coordinates to
+    # be interpolated. In both cases, not relying on garbage keypoints for
+    # interpolation matters when computing keypoint speeds, which are used
+    # for synchronization.            
+    key2D_out[nanInds,:] = np.nan
     
     # Interpolate keypoints with nans.
-    for i in range(nMkrs):
-        for j in range(2):
-            if np.isnan(key2D_out[i,:,j]).all(): # only nans
-                key2D_out[i,:,j] = 0
-            elif np.isnan(key2D_out[i,:,j]).any():  # partially nans
-                nans, x = nan_helper(key2D_out[i,:,j])
-                if linearInterp:
-                    # Note: with linear interpolation, values are carried over
-                    # backward and forward for inleading and exiting nans.
-                    key2D_out[i,nans,j] = np.interp(x(nans), x(~nans), 
-                                                    key2D_out[i,~nans,j]) 
-                else:
-                    # Note: with cubic interpolate, values are garbage for
-                    # inleading and exiting nans.
-                    try:
-                        key2D_out[i,:,j] = pchip_interpolate(
-                            x(~nans), key2D_out[i,~nans,j], 
-                            np.arange(key2D_out.shape[1]))    
-                    except:
-                        key2D_out[i,nans,j] = np.interp(x(nans), x(~nans), 
-                                                        key2D_out[i,~nans,j])
+    key2D_out = interpolateKeypointNans(key2D_out, linearInterp=linearInterp)
                         
     # Keep track of inleading and exiting nans when less than 3 cameras.
     if nCams>2:
         nans_in_out = np.array([np.nan, np.nan])        
     else:
-        _, idxFaceMarkers = getOpenPoseFaceMarkers()       
-        nans_in = []
-        nans_out = []
-        for i in range(nMkrs):
-            if i not in idxFaceMarkers:
-                idx_nans = np.isnan(confidence_out[i,:])
-                if False in idx_nans:
-                    nans_in.append(np.where(idx_nans==False)[0][0])
-                    nans_out.append(np.where(idx_nans==False)[0][-1])
-                else:
-                    nans_in.append(np.nan)
-                    nans_out.append(np.nan)                    
-        in_max = np.max(np.asarray(nans_in))
-        out_min = np.min(np.asarray(nans_out))        
+        includedMkrs = np.delete(np.arange(nMkrs), idxFaceMarkers)
+        idx_nonnans = ~np.isnan(confidence_out[includedMkrs,:])
+        hasNonNans = np.any(idx_nonnans, axis=1)
+        nans_in = np.where(hasNonNans, np.argmax(idx_nonnans, axis=1), np.nan)
+        nans_out = np.where(
+            hasNonNans, 
+            idx_nonnans.shape[1] - 1 - np.argmax(idx_nonnans[:,::-1], axis=1),
+            np.nan)
+        in_max = np.max(nans_in)
+        out_min = np.min(nans_out)        
         nans_in_out = np.array([in_max, out_min])
     
 
     return key2D_out, confidence_out, nans_in_out, confidence_sync_out
 
 # %%
-def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=None, frameRate=60):
+# Returns a mask of the frames before the first and from the last frame with
+# a non-nan and non-zero confidence (the last frame is included). All frames
+# are masked for markers without any such frame.
+def getInOutFrames(confidence):
+    
+    idx_nonnanszeros = ~np.isnan(confidence) & (confidence != 0)
+    nFrames = confidence.shape[1]
+    first = np.argmax(idx_nonnanszeros, axis=1)
+    last = nFrames - 1 - np.argmax(idx_nonnanszeros[:,::-1], axis=1)
+    frames = np.arange(nFrames)
+    inOut = (frames < first[:,None]) | (frames >= last[:,None])
+    inOut[~np.any(idx_nonnanszeros, axis=1),:] = True
+    
+    return inOut
+
+# %%
+# Interpolates nans in keypoints (nMkrs x nFrames x 2). Series that are only
+# nans are set to 0. Series sharing the same nan pattern are interpolated
+# together. With linear interpolation, values are carried over backward and
+# forward for inleading and exiting nans. With cubic interpolation, values are
+# garbage for inleading and exiting nans.
+def interpolateKeypointNans(key2D, linearInterp=False):
+    
+    key2D_out = np.copy(key2D)
+    nFrames = key2D_out.shape[1]
+    # Series are markers x coordinates, of shape (nMkrs*2) x nFrames.
+    series = np.moveaxis(key2D_out, 1, 2).reshape((-1, nFrames))
+    nans = np.isnan(series)
+    
+    # only nans
+    allNans = np.all(nans, axis=1)
+    series[allNans,:] = 0
+    
+    # partially nans
+    partialNans = np.any(nans, axis=1) & ~allNans
+    if np.any(partialNans):
+        groups = {}
+        packedNans = np.packbits(nans, axis=1)
+        for iSeries in np.argwhere(partialNans).flatten():
+            groups.setdefault(packedNans[iSeries].tobytes(), []).append(iSeries)
+        x = np.arange(nFrames)
+        for idxGroup in groups.values():
+            pattern = nans[idxGroup[0]]
+            y = series[np.ix_(idxGroup, ~pattern)]
+            if not linearInterp and np.count_nonzero(~pattern) > 1:
+                series[idxGroup,:] = pchip_interpolate(x[~pattern], y, x, 
+                                                       axis=1)
+            else:
+                series[np.ix_(idxGroup, pattern)] = interpLinear(
+                    x[pattern], x[~pattern], y)
+    
+    key2D_out = np.moveaxis(series.reshape((key2D_out.shape[0], 2, nFrames)), 
+                            2, 1)
+    
+    return np.ascontiguousarray(key2D_out)
+
+# %%
+# Same as np.interp, for several series sharing the same sample points.
+def interpLinear(x, xp, fp):
+    
+    fp = np.atleast_2d(fp)
+    if len(xp) == 1:
+        return np.repeat(fp, len(x), axis=1)
+    
+    j = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    slope = (fp[:,j+1] - fp[:,j]) / (xp[j+1] - xp[j])
+    out = slope * (x - xp[j]) + fp[:,j]
+    # Hold values outside of the sample points.
+    out[:,x <= xp[0]] = fp[:,:1]
+    out[:,x >= xp[-1]] = fp[:,-1:]
+    
+    return out
+
+# %%
+def correlateSame(y1, y2):
+    """Computes np.correlate(y1, y2, mode='same') along the last axis.
+    
+    Uses FFTs, so the cost grows as N*log(N) instead of N^2 with the length
+    of the signals. Signals with non-finite values fall back to np.correlate
+    to keep the same nan propagation.
+    
+    Args:
+    y1, y2: Arrays of signals with the same length along the last axis.
+    
+    Returns:
+    corr: Correlation for the N lags centered around 0 (index N//2).
+    """
+    y1 = np.asarray(y1, dtype=float)
+    y2 = np.asarray(y2, dtype=float)
+    N = y1.shape[-1]
+    
+    corrFull = fftconvolve(y1, y2[...,::-1], mode='full', axes=-1)
+    start = (N-1) // 2
+    corr = corrFull[...,start:start+N]
+    
+    # nans and infs would spread over the full FFT output.
+    notFinite = ~(np.all(np.isfinite(y1), axis=-1) & 
+                  np.all(np.isfinite(y2), axis=-1))
+    if np.any(notFinite):
+        corr = np.array(corr)
+        corr[notFinite] = [np.correlate(a, b, mode='same') for a, b in 
+                           zip(y1[notFinite], y2[notFinite])]
+    
+    return corr
+
+# %%
+def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=None, frameRate=60,
+               returnCorr=False):
     """Calculates the cross correlation and lags without normalization.
     
     The definition of the discrete cross-correlation is in:
@@ -2082,10 +2166,12 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
     
     Args:
     y1, y2: Should have the same length.
+    returnCorr: If True, also return the correlation curve.
     
     Returns:
     max_corr: Maximum correlation without normalization.
     lag: The lag in terms of the index.
+    corr: Correlation curve, only if returnCorr (lag 0 at index N//2).
     """
     # Pad shorter signal with 0s
     if len(y1) > len(y2):
@@ -2099,11 +2185,12 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
         
     y1_auto_corr = np.dot(y1, y1) / len(y1)
     y2_auto_corr = np.dot(y2, y2) / len(y1)
-    corr = np.correlate(y1, y2, mode='same')
+    corr = correlateSame(y1, y2)
+    shift = len(y1) // 2
     # The unbiased sample size is N - lag.
-    unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
+    unbiased_sample_size = len(y1) - np.abs(np.arange(len(y1)) - shift)
     corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
-    shift = len(y1) // 2
+    corrCurve = corr
     max_corr = np.max(corr)
     argmax_corr = np.argmax(corr)    
 
@@ -2121,19 +2208,19 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
         # look at 3 lags closest to 0
         if np.isscalar(lags):
             max_corr = corr[lags+shift]
+            if returnCorr:
+                return max_corr, lags, corrCurve
             return max_corr, lags
         if len(lags)>3:
             lags = lags[np.argsort(np.abs(lags))[:3]]
         
-        reprojError = np.empty((len(lags),1))
-        reprojSuccess = []
-        for iPeak,lag in enumerate(lags):
-            # calculate reprojection error for each potential lag
-            reprojError[iPeak,0], reprojSuccessi = calcReprojectionErrorForSync(
-                dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                lag, dataForReproj['cams2UseReproj'], 
-                dataForReproj['confidence'], dataForReproj['cameras2Use'])
-            reprojSuccess.append(reprojSuccessi)
+        # calculate reprojection error for each potential lag
+        reprojError, reprojSuccessAll = calcReprojectionErrorForSyncLags(
+            dataForReproj['CamParamList'], dataForReproj['keypointList'],
+            lags, dataForReproj['cams2UseReproj'], 
+            dataForReproj['confidence'], dataForReproj['cameras2Use'])
+        reprojError = reprojError[:,None]
+        reprojSuccess = [reprojSuccessAll] * len(lags)
         
         # find if min reproj error is clearly smaller than other peaks. If it is not,
         # don't use reproj error min for sync. E.g. with treadmill walking, reproj error may not work as
@@ -2143,7 +2230,7 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
         if reprojErrorRatio < 0.6 and not False in reprojSuccess: # tunable parameter. Usually around 0.25 for overground walking
             # find idx with minimum reprojection error 
             lag_corr = lags[np.argmin(reprojError)]
-            max_corr = corr[lag+shift]
+            max_corr = corr[lag_corr+shift]
             
             if multCorrGaussianStd is not None:
                 print('For {}, used reprojection error minimization to sync.'.format(dataForReproj['cameras2Use'][dataForReproj['cams2UseReproj'][1]]))
@@ -2155,13 +2242,11 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
             # Create a list of lags to test that is +/- .2 seconds around the selected lag based on frameRate
             numFrames = int(.2*frameRate)
             lags = np.arange(lag_corr-numFrames,lag_corr+numFrames+1)
-            reprojErrors = np.empty((len(lags),1))
-
-            for iLag,lag in enumerate(lags):            
-                reprojErrors[iLag,0], _ = calcReprojectionErrorForSync(
-                    dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                    lag, dataForReproj['cams2UseReproj'], 
-                    dataForReproj['confidence'], dataForReproj['cameras2Use'])
+            reprojErrors, _ = calcReprojectionErrorForSyncLags(
+                dataForReproj['CamParamList'], dataForReproj['keypointList'],
+                lags, dataForReproj['cams2UseReproj'], 
+                dataForReproj['confidence'], dataForReproj['cameras2Use'])
+            reprojErrors = reprojErrors[:,None]
                 
             # Select the lag with the lowest reprojection error
             lag = lags[np.argmin(reprojErrors)]
@@ -2179,6 +2264,8 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
                 plt.show()
                 
                 
+            if returnCorr:
+                return max_corr, lag, corrCurve
             return max_corr, lag
         
     if visualize:
@@ -2198,11 +2285,14 @@ def cross_corr(y1, y2,multCorrGaussianStd=None,visualize=False, dataForReproj=No
     
     lag = argmax_corr-shift
     
+    if returnCorr:
+        return max_corr, lag, corrCurve
     return max_corr, lag
 
 
 # %%
-def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj=None,visualize=False,frameRate=60):
+def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj=None,visualize=False,frameRate=60,
+                                   returnCorr=False):
     
     # SHAPE OF Y1,Y2 is nMkrs by nSamples
     """Calculates the cross correlation and lags without normalization.
@@ -2212,34 +2302,30 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
     
     Args:
     y1, y2: Should have the same length.
+    returnCorr: If True, also return the correlation curve.
     
     Returns:
     max_corr: Maximum correlation without normalization.
     lag: The lag in terms of the index.
+    corr: Correlation curve, only if returnCorr (lag 0 at index N//2).
     """
+    # Pad shorter signals with 0s
+    nSamples = np.max((Y1.shape[1],Y2.shape[1]))
+    Y1_pad = np.zeros((Y1.shape[0],nSamples))
+    Y1_pad[:,:Y1.shape[1]] = Y1
+    Y2_pad = np.zeros((Y2.shape[0],nSamples))
+    Y2_pad[:,:Y2.shape[1]] = Y2
+    Y1, Y2 = Y1_pad, Y2_pad
     nMkrs = Y1.shape[0]
-    corrMat = np.empty(Y1.shape)
-    for iMkr in range(nMkrs):
-        y1=Y1[iMkr,:]
-        y2=Y2[iMkr,:]
-        # Pad shorter signal with 0s
-        if len(y1) > len(y2):
-            temp = np.zeros(len(y1))
-            temp[0:len(y2)] = y2
-            y2 = np.copy(temp)
-        elif len(y2)>len(y1):
-            temp = np.zeros(len(y2))
-            temp[0:len(y1)] = y1
-            y1 = np.copy(temp)
-            
-        y1_auto_corr = np.dot(y1, y1) / len(y1)
-        y2_auto_corr = np.dot(y2, y2) / len(y1)
-        corr = np.correlate(y1, y2, mode='same')
-        # The unbiased sample size is N - lag
-        unbiased_sample_size = np.correlate(np.ones(len(y1)), np.ones(len(y1)), mode='same')
-        corr = corr / unbiased_sample_size / np.sqrt(y1_auto_corr * y2_auto_corr)
-        shift = len(y1) // 2
-        corrMat[iMkr,:] = corr  
+    
+    y1_auto_corr = np.sum(Y1*Y1,axis=1) / nSamples
+    y2_auto_corr = np.sum(Y2*Y2,axis=1) / nSamples
+    corrMat = correlateSame(Y1, Y2)
+    shift = nSamples // 2
+    # The unbiased sample size is N - lag
+    unbiased_sample_size = nSamples - np.abs(np.arange(nSamples) - shift)
+    corrMat = (corrMat / unbiased_sample_size / 
+               np.sqrt(y1_auto_corr * y2_auto_corr)[:,None])
     
     if visualize:
         plt.figure()
@@ -2255,6 +2341,7 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
         plt.plot(Y2.T)
     
     summedCorr = np.nansum(corrMat,axis=0)
+    corrCurve = summedCorr
     
     # find correlation peak with minimum reprojection error
     if dataForReproj is not None:
@@ -2264,19 +2351,19 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
         # look at 3 lags closest to 0
         if np.isscalar(lags):
             max_corr = summedCorr[lags+shift]
+            if returnCorr:
+                return max_corr, lags, corrCurve
             return max_corr, lags
         if len(lags)>3:
             lags = lags[np.argsort(np.abs(lags))[:3]]
         
-        reprojError = np.empty((len(lags),1))
-        reprojSuccess = []
-        for iPeak,lag in enumerate(lags):
-            # calculate reprojection error for each potential lag
-            reprojError[iPeak,0], reprojSuccessi = calcReprojectionErrorForSync(
-                dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                lag, dataForReproj['cams2UseReproj'], 
-                dataForReproj['confidence'], dataForReproj['cameras2Use'])
-            reprojSuccess.append(reprojSuccessi)
+        # calculate reprojection error for each potential lag
+        reprojError, reprojSuccessAll = calcReprojectionErrorForSyncLags(
+            dataForReproj['CamParamList'], dataForReproj['keypointList'],
+            lags, dataForReproj['cams2UseReproj'], 
+            dataForReproj['confidence'], dataForReproj['cameras2Use'])
+        reprojError = reprojError[:,None]
+        reprojSuccess = [reprojSuccessAll] * len(lags)
         
         # find if min reproj error is clearly smaller than other peaks. If it is not,
         # don't use reproj error min for sync. E.g. with treadmill walking, reproj error may not work as
@@ -2286,7 +2373,7 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
         if reprojErrorRatio < 0.6 and not False in reprojSuccess: # tunable parameter. Usually around 0.25 for overground walking
             # find idx with minimum reprojection error 
             lag_corr = lags[np.argmin(reprojError)]
-            max_corr = summedCorr[lag+shift]
+            max_corr = summedCorr[lag_corr+shift]
             
             if multCorrGaussianStd is not None:
                 print('For {}, used reprojection error minimization to sync.'.format(dataForReproj['cameras2Use'][dataForReproj['cams2UseReproj'][1]]))
@@ -2298,13 +2385,11 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
             # Create a list of lags to test that is +/- .2 seconds around the selected lag based on frameRate
             numFrames = int(.2*frameRate)
             lags = np.arange(lag_corr-numFrames,lag_corr+numFrames+1)
-            reprojErrors = np.empty((len(lags),1))
-
-            for iLag,lag in enumerate(lags):            
-                reprojErrors[iLag,0], _ = calcReprojectionErrorForSync(
-                    dataForReproj['CamParamList'], dataForReproj['keypointList'],
-                    lag, dataForReproj['cams2UseReproj'], 
-                    dataForReproj['confidence'], dataForReproj['cameras2Use'])
+            reprojErrors, _ = calcReprojectionErrorForSyncLags(
+                dataForReproj['CamParamList'], dataForReproj['keypointList'],
+                lags, dataForReproj['cams2UseReproj'], 
+                dataForReproj['confidence'], dataForReproj['cameras2Use'])
+            reprojErrors = reprojErrors[:,None]
                 
             # Select the lag with the lowest reprojection error
             lag = lags[np.argmin(reprojErrors)]
@@ -2321,6 +2406,8 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
                 plt.legend(['reprojection error','corr lag','refined lag'])
                 plt.show()
 
+            if returnCorr:
+                return max_corr, lag, corrCurve
             return max_corr, lag
         
     # Multiply correlation curve by gaussian (prioritizing lag solution closest to 0)
@@ -2333,33 +2420,40 @@ def cross_corr_multiple_timeseries(Y1, Y2,multCorrGaussianStd=None,dataForReproj
     max_corr = np.nanmax(summedCorr)/corrMat.shape[0] 
     
     lag = argmax_corr-shift
+    if returnCorr:
+        return max_corr, lag, corrCurve
     return max_corr, lag
 
-# %% Triangulation
-# If you set ignoreMissingMarkers to True, and pass the DISTORTED keypoints
-# as keypoints2D, the triangulation will ignore data from cameras that
-# returned (0,0) as marker coordinates.
-def triangulateMultiview(CameraParamList, points2dUndistorted, 
-                          imageScaleFactor=1, useRotationEuler=False,
-                          ignoreMissingMarkers=False,selectCamerasMinReprojError = False,
-                          ransac = False, keypoints2D=[],confidence=None):
-    # create a list of cameras (says sequence in documentation) from CameraParamList
-    cameraList = []    
-    nCams = len(CameraParamList) 
-    nMkrs = np.shape(points2dUndistorted[0])[0]
-    
+# %% Create a list of Camera objects from a list of camera parameters.
+def getCameraList(CameraParamList, useRotationEuler=False):
+    cameraList = []
     for camParams in CameraParamList:
         # get rotation matrix
         if useRotationEuler:
             rotMat = cv2.Rodrigues(camParams['rotation_EulerAngles'])[0]
         else:
             rotMat = camParams['rotation']
-        
+
         c = Camera()
         c.set_K(camParams['intrinsicMat'])
         c.set_R(rotMat)
         c.set_t(np.reshape(camParams['translation'],(3,1)))
         cameraList.append(c)
+
+    return cameraList
+
+# %% Triangulation
+# If you set ignoreMissingMarkers to True, and pass the DISTORTED keypoints
+# as keypoints2D, the triangulation will ignore data from cameras that
+# returned (0,0) as marker coordinates.
+def triangulateMultiview(CameraParamList, points2dUndistorted, 
+                          imageScaleFactor=1, useRotationEuler=False,
+                          ignoreMissingMarkers=False,selectCamerasMinReprojError = False,
+                          ransac = False, keypoints2D=[],confidence=None):
+    # create a list of cameras (says sequence in documentation) from CameraParamList
+    cameraList = getCameraList(CameraParamList, useRotationEuler=useRotationEuler)
+    nCams = len(CameraParamList) 
+    nMkrs = np.shape(points2dUndistorted[0])[0]
            
    
     # triangulate
@@ -2547,21 +2641,37 @@ def triangulateMultiviewVideo(CameraParamDict,keypointDict,imageScaleFactor=1,
     keypointList_selectedCams = [keypointDict_selectedCams[i] for i in keypointDict_selectedCams]
     confidenceList_selectedCams = [confidenceDict_selectedCams[i] for i in confidenceDict_selectedCams]
     CameraParamList_selectedCams = [CameraParamDict_selectedCams[i] for i in CameraParamDict_selectedCams]
-    unpackedKeypoints = unpackKeypointList(keypointList_selectedCams)
-    points3D = np.zeros((3,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
-    confidence3D = np.zeros((1,keypointList_selectedCams[0].shape[0],keypointList_selectedCams[0].shape[1]))
-    
+    nMkrs, nFrames = keypointList_selectedCams[0].shape[:2]
     
-    for iFrame,points2d in enumerate(unpackedKeypoints):
-        # If confidence weighting
+    if ignoreMissingMarkers and len(CameraParamList_selectedCams) > 2:
+        unpackedKeypoints = unpackKeypointList(keypointList_selectedCams)
+        points3D = np.zeros((3,nMkrs,nFrames))
+        confidence3D = np.zeros((1,nMkrs,nFrames))
+        
+        for iFrame,points2d in enumerate(unpackedKeypoints):
+            # If confidence weighting
+            if confidenceDict:
+                thisConfidence = [c[:,iFrame] for c in confidenceList_selectedCams]
+            else:
+                thisConfidence = None
+            
+            points3D[:,:,iFrame], confidence3D[:,:,iFrame] = triangulateMultiview(CameraParamList_selectedCams, points2d, 
+                              imageScaleFactor=1, useRotationEuler=False,
+                              ignoreMissingMarkers=ignoreMissingMarkers, keypoints2D=keypoints2D,confidence=thisConfidence)
+    else:
+        # Triangulate all frames and markers at once.
+        cameraList = getCameraList(CameraParamList_selectedCams)
+        points2D = np.stack(keypointList_selectedCams).reshape(
+            (len(cameraList), nMkrs*nFrames, 2))
         if confidenceDict:
-            thisConfidence = [c[:,iFrame] for c in confidenceList_selectedCams]
+            weights = np.stack(confidenceList_selectedCams).reshape(
+                (len(cameraList), nMkrs*nFrames))
         else:
-            thisConfidence = None
-        
-        points3D[:,:,iFrame], confidence3D[:,:,iFrame] = triangulateMultiview(CameraParamList_selectedCams, points2d, 
-                          imageScaleFactor=1, useRotationEuler=False,
-                          ignoreMissingMarkers=ignoreMissingMarkers, keypoints2D=keypoints2D,confidence=thisConfidence)
+            weights = None
+        points3D, confidence3D = nview_linear_triangulations_batch(
+            cameraList, points2D, weights=weights)
+        points3D = points3D.reshape((3,nMkrs,nFrames))
+        confidence3D = confidence3D.reshape((1,nMkrs,nFrames))
         
     if trimTrial:
         # Delete confidence and 3D keypoints if markers, except for face 
@@ -2680,44 +2790,22 @@ def findInternalZeroInds(x,maxLength):
     if all(x==0):
         return None, None
     
-    zeroInds = np.argwhere(x==0)
-    dZeroInds = np.diff(zeroInds,axis=0,prepend=-1)
-    
-    # check if first/last values are 0, don't spline the beginning and end
-    start0 = x[0] == 0
-    end0 = x[-1] == 0
-    
-    if start0:
-        # delete string of 0s at beginning
-        while(dZeroInds.shape[0] > 0 and dZeroInds[0] == 1):
-            zeroInds = np.delete(zeroInds,0)
-            dZeroInds = np.delete(dZeroInds,0)
-    if end0: 
-        while(dZeroInds.shape[0] > 0 and dZeroInds[-1] == 1):
-            # keep deleting end inds if there is a string of 0s before end
-            zeroInds = np.delete(zeroInds,-1)
-            dZeroInds = np.delete(dZeroInds,-1)
-        # delete last index before jump - value will be greater than 1
-        zeroInds = np.delete(zeroInds,-1)
-        dZeroInds = np.delete(dZeroInds,-1)
-    
-    # check if any stretches are longer than maxLength
-    thisStretch = np.array([0]) # initialize with first value b/c dZeroInds[0] ~=1
-    indsToDelete = np.array([])
-    for iIdx,d in enumerate(dZeroInds):
-        if d == 1:
-            thisStretch = np.append(thisStretch,iIdx)
-        else:
-            if len(thisStretch) >= maxLength:
-                indsToDelete = np.append(indsToDelete,np.copy(thisStretch))
-            thisStretch = np.array([iIdx])
-    # if final stretch is too long, add it too
-    if len(thisStretch) >= maxLength:
-        indsToDelete = np.append(indsToDelete,np.copy(thisStretch))
-        
-    if len(indsToDelete) > 0:
-        zeroInds = np.delete(zeroInds,indsToDelete.astype(int))
-        dZeroInds = np.delete(dZeroInds,indsToDelete.astype(int))
+    # Find stretches of 0s, as [start, end) indices.
+    isZero = np.concatenate(([False], np.asarray(x)==0, [False]))
+    dIsZero = np.diff(isZero.astype(int))
+    starts = np.argwhere(dIsZero == 1).flatten()
+    ends = np.argwhere(dIsZero == -1).flatten()
+    
+    # don't spline the beginning and end, and skip stretches that are longer
+    # than maxLength
+    internal = (starts > 0) & (ends < len(x)) & (ends - starts < maxLength)
+    starts, ends = starts[internal], ends[internal]
+    
+    # indices of the selected stretches
+    lengths = ends - starts
+    zeroInds = (np.arange(np.sum(lengths)) - 
+                np.repeat(np.cumsum(lengths) - lengths, lengths) + 
+                np.repeat(starts, lengths))
             
     nonZeroInds = np.delete(np.arange(len(x)),zeroInds)
 
@@ -2728,17 +2816,29 @@ def findInternalZeroInds(x,maxLength):
 def calcReprojectionErrorForSync(CamParamList, keypointList, lagVal,
                                  cams2UseReproj, confidence, cameras2Use):
     
+    reprojErrors, reprojSuccess = calcReprojectionErrorForSyncLags(
+        CamParamList, keypointList, [lagVal], cams2UseReproj, confidence, 
+        cameras2Use)
+    reprojErrorAcrossFrames = reprojErrors[0]
+    
+    return reprojErrorAcrossFrames, reprojSuccess
+
+# %%
+# Evaluates the sync reprojection error for several lag values at once. Only
+# the sampled timesteps are triangulated, and all lags are triangulated and
+# reprojected in a single batch.
+def calcReprojectionErrorForSyncLags(CamParamList, keypointList, lagVals,
+                                     cams2UseReproj, confidence, cameras2Use):
+    
     # Number of timesteps to triangulate. Will average reprojection error over all nTimesteps.
     nTimesteps = 5 
-    
-    keypoints2D = copy.deepcopy(keypointList)
-    conf = copy.deepcopy(confidence)
-    CamParamListCopy = copy.deepcopy(CamParamList)
+    lagVals = np.asarray(lagVals).flatten()
+    nLags = len(lagVals)
     
     # Find the range of overlapping confidence for this lag value
     confSel = []
     for cam in cams2UseReproj:
-        confSel.append(conf[cam])
+        confSel.append(confidence[cam])
         
     # find confidence ranges in original indices
     confThresh = [.5*np.nanmax(c) for c in confSel] # Threshold for saying this camera confidently sees the person
@@ -2749,89 +2849,71 @@ def calcReprojectionErrorForSync(CamParamList, keypointList, lagVal,
     for i,c in enumerate(avgConf):
         temp = c > confThresh[i]
         if True in temp:
-            confRanges.append(np.array([np.argwhere(temp)[0], np.argwhere(temp)[-1]+1]))
+            confRanges.append(np.array([np.argwhere(temp)[0,0], np.argwhere(temp)[-1,0]+1]))
         else:
-            reprojErrorAcrossFrames = 0.1
+            reprojErrorAcrossFrames = 0.1 * np.ones(nLags)
             reprojSuccess = False
             return reprojErrorAcrossFrames, reprojSuccess
         
     # shift second camera based on lag, so indices are "aligned," then find overlapping range
-    shiftedConfRanges = copy.deepcopy(confRanges)
-    shiftedConfRanges[1] = shiftedConfRanges[1] - lagVal # shift the indices for second camera
     # Ignore the first and last few timesteps here as confidence drops
-    shiftedOverlapInds = [np.max((shiftedConfRanges[0][0],shiftedConfRanges[1][0]))+3,
-                          np.min((shiftedConfRanges[0][1],shiftedConfRanges[1][1]))-3]
+    shiftedOverlapStart = np.maximum(confRanges[0][0], confRanges[1][0] - lagVals) + 3
+    shiftedOverlapEnd = np.minimum(confRanges[0][1], confRanges[1][1] - lagVals) - 3
     
     # Sample nTimesteps between the shifted Overlap Inds
-    shiftedSampleInds = np.linspace(shiftedOverlapInds[0],shiftedOverlapInds[1],nTimesteps).astype(int)
+    shiftedSampleInds = np.linspace(shiftedOverlapStart, shiftedOverlapEnd,
+                                    nTimesteps, axis=1).astype(int)
     
     sampleInds = []
     sampleInds.append(shiftedSampleInds) # no shift for first camera
-    sampleInds.append(shiftedSampleInds + lagVal) # unshifts the indices for second camera
+    sampleInds.append(shiftedSampleInds + lagVals[:,None]) # unshifts the indices for second camera
     
-    # Select keypoints and confidence at appropriate timesteps
+    # Select keypoints and confidence at appropriate timesteps, for all lags.
+    # Samples are ordered as nMkrs x (nLags*nTimesteps).
     keypoints2DSelected = []
-    cameraListSelected = []
     confListSelected = []
     for iCam, cam in enumerate(cams2UseReproj):
-        keypoints2D[cam] = keypoints2D[cam][:,sampleInds[iCam],:]
-        conf[cam] = conf[cam][:,sampleInds[iCam]]
-        keypoints2DSelected.append(keypoints2D[cam])
-        cameraListSelected.append(CamParamListCopy[cam])
-        confListSelected.append(conf[cam])
-        
-    # Triangulate at each of the nTimesteps
-    # We here need to turn the lists back into dicts.
-    CamParamListCopy_dict = {}
-    keypoints2D_dict = {}
-    conf_dict = {}
-    for iCam, cam in enumerate(cameras2Use):
-        CamParamListCopy_dict[cam] = CamParamListCopy[iCam]
-        keypoints2D_dict[cam] = keypoints2D[iCam]
-        conf_dict[cam] = conf[iCam]
-    cameras2UseReproj = [cameras2Use[i] for i in cams2UseReproj]
-    keypoints3D, _ = triangulateMultiviewVideo(
-        CamParamListCopy_dict, keypoints2D_dict, ignoreMissingMarkers=False, 
-        cams2Use=cameras2UseReproj, confidenceDict=conf_dict,trimTrial=False)
-    
-    # Make list of camera objects
-    cameraObjList = []       
-    for camParams in cameraListSelected:
-        c = Camera()
-        c.set_K(camParams['intrinsicMat'])
-        c.set_R(camParams['rotation'])
-        c.set_t(np.reshape(camParams['translation'],(3,1)))
-        cameraObjList.append(c)
-        
-    # Compute confidence-weighted reprojection error for each of nTimesteps
-    reprojErrorVec = []
-    for tStep in range(nTimesteps):
-       
-        # Organize points for reprojectionError function
-        stackedPoints = np.stack([k[:,None,tStep,:] for k in keypoints2DSelected])
-        pointsInput = []
-        for i in range(stackedPoints.shape[1]):
-            pointsInput.append(stackedPoints[:,i,0,:].T)
-        
-        confForWeights = [c[:,None,tStep].T for c in confListSelected] # needs transpose for reprojection error function
-        confForWeights = [np.nan_to_num(c,nan=0) for c in confForWeights] # sometimes confidence has nans, don't want to use as weights in this case
-        
-        # Calculate combined reprojection error
-        key3D = np.squeeze(keypoints3D[:,:,tStep])
-        reprojErrors = calcReprojectionError(cameraObjList,pointsInput,key3D,
-                                             weights=confForWeights,normalizeError=True)
-        
-        # multiply minimum confidence between cameras times marker-wise reproj errors
-        # so we don't include errors for markers that had low confidence in one of the cameras
-        minConfVec = np.min(np.asarray(confForWeights), axis=0)
-        minConfVec[np.where(minConfVec<0.5)] = 0 # Set low conf markers to 0
-        weightedReprojErrors = np.multiply(reprojErrors,minConfVec)
-        if np.any(weightedReprojErrors):
-            reprojErrorVec.append(np.mean(weightedReprojErrors[minConfVec>0]))
-        else:
-            reprojErrorVec.append(1000) # in cases where no position is confident set to large reproj error. typical values are on the order of  0.1
-        
-    reprojErrorAcrossFrames = np.mean(reprojErrorVec)
+        keypoints2DSelected.append(keypointList[cam][:,sampleInds[iCam].flatten(),:])
+        confListSelected.append(confidence[cam][:,sampleInds[iCam].flatten()])
+    keypoints2DSelected = np.stack(keypoints2DSelected)
+    confListSelected = np.stack(confListSelected)
+    nCams, nMkrs, nSamples, _ = keypoints2DSelected.shape
+    
+    # Triangulate all samples at once.
+    cameraObjList = getCameraList([CamParamList[cam] for cam in cams2UseReproj])
+    keypoints3D, _ = nview_linear_triangulations_batch(
+        cameraObjList, keypoints2DSelected.reshape((nCams, nMkrs*nSamples, 2)),
+        weights=confListSelected.reshape((nCams, nMkrs*nSamples)))
+    
+    # Compute confidence-weighted reprojection errors normalized by the height
+    # of the bounding box.
+    confForWeights = np.nan_to_num(confListSelected,nan=0) # sometimes confidence has nans, don't want to use as weights in this case
+    reprojErrors = np.empty((nCams, nMkrs, nSamples))
+    for iCam,cam in enumerate(cameraObjList):
+        reproj = cam.world_to_image(keypoints3D)[:2,:].reshape((2, nMkrs, nSamples))
+        this2D = np.moveaxis(keypoints2DSelected[iCam], -1, 0)
+        reprojErrors[iCam] = np.linalg.norm((reproj-this2D)*confForWeights[iCam], axis=0)
+        
+        nonZeroYVals = np.where(this2D[1]>0, this2D[1], np.nan)
+        with np.errstate(invalid='ignore'):
+            boxHeight = np.nanmax(nonZeroYVals,axis=0) - np.nanmin(nonZeroYVals,axis=0)
+        reprojErrors[iCam] /= boxHeight
+    reprojErrors = np.mean(reprojErrors,axis=0)
+    
+    # multiply minimum confidence between cameras times marker-wise reproj errors
+    # so we don't include errors for markers that had low confidence in one of the cameras
+    minConf = np.min(confForWeights, axis=0)
+    minConf[minConf<0.5] = 0 # Set low conf markers to 0
+    weightedReprojErrors = np.multiply(reprojErrors,minConf)
+    nConfident = np.count_nonzero(minConf>0, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        reprojErrorVec = (np.sum(np.where(minConf>0, weightedReprojErrors, 0), axis=0) / 
+                          nConfident)
+    # in cases where no position is confident set to large reproj error. typical values are on the order of  0.1
+    reprojErrorVec[~np.any(weightedReprojErrors, axis=0)] = 1000
+        
+    reprojErrorAcrossFrames = np.mean(
+        reprojErrorVec.reshape((nLags, nTimesteps)), axis=1)
     reprojSuccess = True    
     
     return reprojErrorAcrossFrames, reprojSuccess
@@ -2873,38 +2955,32 @@ def calcReprojectionError(cameraList,points2D,points3D,weights=None,normalizeErr
 # %% Write TRC file for use with OpenSim.
 def writeTRCfrom3DKeypoints(keypoints3D, pathOutputFile, keypointNames, 
                             frameRate=60, rotationAngles={}):
+    # Returns the written markers as a utilsDataman.MarkerSet, such that
+    # the next steps do not need to read the file again.
     
-    keypoints3D_res = np.empty((keypoints3D.shape[2],
-                                keypoints3D.shape[0]*keypoints3D.shape[1]))
-    for iFrame in range(keypoints3D.shape[2]):
-        keypoints3D_res[iFrame,:] = np.reshape(
-            keypoints3D[:,:,iFrame], 
-            (1,keypoints3D.shape[0]*keypoints3D.shape[1]),"F")
-    
-    # Change units to save data in m.
-    keypoints3D_res /= 1000
+    # keypoints3D is 3 x nMarkers x nFrames, change units to save data in m.
+    keypoints3D_res = np.transpose(keypoints3D, (2, 1, 0)) / 1000
     
     # Do not write face markers, they are unreliable and useless.
     faceMarkers = getOpenPoseFaceMarkers()[0]
-    idxFaceMarkers = [keypointNames.index(i) for i in faceMarkers]    
-    idxToRemove = np.hstack([np.arange(i*3,i*3+3) for i in idxFaceMarkers])
-    keypoints3D_res_sel = np.delete(keypoints3D_res, idxToRemove, axis=1)  
-    keypointNames_sel = [i for i in keypointNames if i not in faceMarkers]
-
-    with open(pathOutputFile,"w") as f:
-        numpy2TRC(f, keypoints3D_res_sel, keypointNames_sel, fc=frameRate, 
-                  units="m")
+    idxToKeep = [i for i, name in enumerate(keypointNames) 
+                 if name not in faceMarkers]
+    keypointNames_sel = [keypointNames[i] for i in idxToKeep]
+    
+    time = np.arange(keypoints3D_res.shape[0]) / frameRate
+    markerSet = utilsDataman.MarkerSet(
+        time, keypoints3D_res[:, idxToKeep], keypointNames_sel, frameRate, 
+        units='m')
     
     # Rotate data to match OpenSim conventions; this assumes the chessboard
     # is behind the subject and the chessboard axes are parallel to those of
     # OpenSim.
-    trc_file = utilsDataman.TRCFile(pathOutputFile)    
     for axis,angle in rotationAngles.items():
-        trc_file.rotate(axis,angle)
+        markerSet.rotate(axis,angle)
 
-    trc_file.write(pathOutputFile)   
+    markerSet.write(pathOutputFile)   
     
-    return None
+    return markerSet
 
 # %% Find indices with high confidence that overlap between cameras.
 def findOverlap(confidenceList, markers4VertVel):    
@@ -2953,36 +3029,12 @@ def findOverlap(confidenceList, markers4VertVel):
 def loadPklVideo(pklPath, videoFullPath, imageBasedTracker=False, poseDetector='OpenPose',
                  confidenceThresholdForBB=0.3, visualizeKeypointAnimation=False):
     
-    open_file = open(pklPath, "rb")
-    frames = pickle.load(open_file)
-    open_file.close()
-
-    nFrames = len(frames)
+    # Load pose arrays (legacy pickles are converted).
+    poseArrays = loadPose(pklPath)
+    nFrames = len(poseArrays)
 
-    # Read in JSON files.
-    allPeople = []
-    iPerson = 0
-    anotherPerson = True
-    
-    while anotherPerson is True:             
-        anotherPerson = False
-        res = np.zeros((nFrames, 75))
-        res[:] = np.nan
-        
-        for c_frame, frame in enumerate(frames):    
-            # Get this persons keypoints if they exist.
-            if len(frame) > iPerson:
-                person = frame[iPerson]
-                keypoints = person['pose_keypoints_2d']
-                res[c_frame,:] = keypoints
-            
-            # See if there are more people.
-            if len(frame) > iPerson+1:
-                # If there was someone else in any frame, loop again.
-                anotherPerson = True 
-        
-        allPeople.append(res.copy())
-        iPerson +=1     
+    # Keypoints of each person, nan if the person is not in a frame.
+    allPeople = getPeopleKeypoints(poseArrays)
         
     # Creates a browser animation of the data in each person detected. This
     # may not be continuous yet. That happens later with person tracking.
@@ -7,6 +7,75 @@ from scipy.spatial.transform import Rotation as R
 import numpy as np
 from numpy.lib.recfunctions import append_fields
 
+from utilsTRC import writeTRCHeader, writeTRCRows, readTRCData
+
+def read_trc_header(fpath):
+    """Metadata of a TRC file, as a dict of the TRCFile attributes."""
+    # Split by any whitespace.
+    # TODO may cause issues with paths that have spaces in them.
+    f = open(fpath)
+    # These are lists of each entry on the first few lines.
+    first_line = f.readline().split()
+    # Skip the 2nd line.
+    f.readline()
+    third_line = f.readline().split()
+    fourth_line = f.readline().split()
+    f.close()
+
+    header = {}
+
+    # First line.
+    if len(first_line) > 3:
+        header['path'] = first_line[3]
+    else:
+        header['path'] = ''
+
+    # Third line.
+    header['data_rate'] = float(third_line[0])
+    header['camera_rate'] = float(third_line[1])
+    header['num_frames'] = int(third_line[2])
+    header['num_markers'] = int(third_line[3])
+    header['units'] = third_line[4]
+    header['orig_data_rate'] = float(third_line[5])
+    header['orig_data_start_frame'] = int(third_line[6])
+    header['orig_num_frames'] = int(third_line[7])
+
+    # Marker names.
+    # The first and second column names are 'Frame#' and 'Time'.
+    header['marker_names'] = fourth_line[2:]
+
+    len_marker_names = len(header['marker_names'])
+    if len_marker_names != header['num_markers']:
+        warnings.warn('Header entry NumMarkers, %i, does not '
+                'match actual number of markers, %i. Changing '
+                'NumMarkers to match actual number.' % (
+                    header['num_markers'], len_marker_names))
+        header['num_markers'] = len_marker_names
+
+    return header
+
+def _axis_index(axis):
+
+    if axis.lower() not in ['x', 'y', 'z']:
+        raise ValueError("Axis not recognized")
+    return 'xyz'.index(axis.lower())
+
+# Transforms of marker positions, applied in place to a (... x 3) array.
+def rotate_xyz(xyz, axis, value):
+    r = R.from_euler(axis, value, degrees=True)
+    xyz[...] = r.apply(xyz.reshape(-1, 3)).reshape(xyz.shape)
+
+def offset_xyz(xyz, axis, value):
+    xyz[..., _axis_index(axis)] += value
+
+def scale_xyz(xyz, factor):
+    # factor is a scalar or one factor per axis.
+    xyz *= np.asarray(factor, dtype=float)
+
+def swap_axes_xyz(xyz, axis1, axis2):
+    i, j = _axis_index(axis1), _axis_index(axis2)
+    xyz[..., [i, j]] = xyz[..., [j, i]]
+
 class TRCFile(object):
     """A plain-text file format for storing motion capture marker trajectories.
     TRC stands for Track Row Column.
@@ -48,44 +117,8 @@ class TRCFile(object):
     def read_from_file(self, fpath):
         # Read the header lines / metadata.
         # ---------------------------------
-        # Split by any whitespace.
-        # TODO may cause issues with paths that have spaces in them.
-        f = open(fpath)
-        # These are lists of each entry on the first few lines.
-        first_line = f.readline().split()
-        # Skip the 2nd line.
-        f.readline()
-        third_line = f.readline().split()
-        fourth_line = f.readline().split()
-        f.close()
-
-        # First line.
-        if len(first_line) > 3:
-            self.path = first_line[3]
-        else:
-            self.path = ''
-
-        # Third line.
-        self.data_rate = float(third_line[0])
-        self.camera_rate = float(third_line[1])
-        self.num_frames = int(third_line[2])
-        self.num_markers = int(third_line[3])
-        self.units = third_line[4]
-        self.orig_data_rate = float(third_line[5])
-        self.orig_data_start_frame = int(third_line[6])
-        self.orig_num_frames = int(third_line[7])
-
-        # Marker names.
-        # The first and second column names are 'Frame#' and 'Time'.
-        self.marker_names = fourth_line[2:]
-
-        len_marker_names = len(self.marker_names)
-        if len_marker_names != self.num_markers:
-            warnings.warn('Header entry NumMarkers, %i, does not '
-                    'match actual number of markers, %i. Changing '
-                    'NumMarkers to match actual number.' % (
-                        self.num_markers, len_marker_names))
-            self.num_markers = len_marker_names
+        for k, v in read_trc_header(fpath).items():
+            setattr(self, k, v)
 
         # Load the actual data.
         # ---------------------
@@ -96,9 +129,10 @@ class TRCFile(object):
             col_names += [mark + '_tx', mark + '_ty', mark + '_tz']
         dtype = {'names': col_names,
                 'formats': ['int'] + ['float64'] * (3 * self.num_markers + 1)}
-        usecols = [i for i in range(3 * self.num_markers + 1 + 1)]
-        self.data = np.loadtxt(fpath, delimiter='\t', skiprows=5, dtype=dtype,
-                               usecols=usecols)
+        values = readTRCData(fpath, 3 * self.num_markers + 1 + 1)
+        self.data = np.empty(values.shape[0], dtype=dtype)
+        for icol, col_name in enumerate(col_names):
+            self.data[col_name] = values[:, icol]
         self.time = self.data['time']
 
         # Check the number of rows.
@@ -188,47 +222,20 @@ class TRCFile(object):
             Valid file path to which this TRCFile is saved.
 
         """
-        f = open(fpath, 'w')
-
-        # Line 1.
-        f.write('PathFileType  4\t(X/Y/Z) %s\n' % os.path.split(fpath)[0])
-
-        # Line 2.
-        f.write('DataRate\tCameraRate\tNumFrames\tNumMarkers\t'
-                'Units\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n')
-
-        # Line 3.
-        f.write('%.1f\t%.1f\t%i\t%i\t%s\t%.1f\t%i\t%i\n' % (
-            self.data_rate, self.camera_rate, self.num_frames,
-            self.num_markers, self.units, self.orig_data_rate,
-            self.orig_data_start_frame, self.orig_num_frames))
-
-        # Line 4.
-        f.write('Frame#\tTime\t')
-        for imark in range(self.num_markers):
-            f.write('%s\t\t\t' % self.marker_names[imark])
-        f.write('\n')
-
-        # Line 5.
-        f.write('\t\t')
-        for imark in np.arange(self.num_markers) + 1:
-            f.write('X%i\tY%s\tZ%s\t' % (imark, imark, imark))
-        f.write('\n')
-
-        # Line 6.
-        f.write('\n')
-
-        # Data.
-        for iframe in range(self.num_frames):
-            f.write('%i' % (iframe + 1))
-            f.write('\t%.7f' % self.time[iframe])
-            for mark in self.marker_names:
-                idxs = [mark + '_tx', mark + '_ty', mark + '_tz']
-                f.write('\t%.7f\t%.7f\t%.7f' % tuple(
-                    self.data[coln][iframe] for coln in idxs))
-            f.write('\n')
-
-        f.close()
+        with open(fpath, 'w') as f:
+            writeTRCHeader(f, os.path.split(fpath)[0], self.data_rate,
+                           self.camera_rate, self.num_frames,
+                           self.marker_names, self.units,
+                           self.orig_data_rate, self.orig_data_start_frame,
+                           self.orig_num_frames)
+            data = np.zeros((self.num_frames, 0))
+            if self.marker_names:
+                data = np.column_stack([self.data[mark + '_t' + axis]
+                                        for mark in self.marker_names
+                                        for axis in 'xyz'])
+            writeTRCRows(f, self.time[:self.num_frames],
+                         data[:self.num_frames], timeFormat='%.7f',
+                         valueFormat='%.7f', trailingTab=False)
 
     def add_noise(self, noise_width):
         """ add random noise to each component of the marker trajectory
@@ -245,25 +252,48 @@ class TRCFile(object):
                 # add noise to each component of marker data.
                 self.data[self.marker_names[imarker] + components[iComponent]] += noise
                 
+    def xyz(self):
+        """Marker positions as a `num_frames` x `num_markers` x 3 array.
+
+        When the marker columns are contiguous float64 fields (as read from
+        a file or added with `add_marker`), this is a view of `self.data`,
+        such that changes to it are changes to the data; otherwise a copy.
+
+        """
+        names = [mark + '_t' + axis for mark in self.marker_names
+                 for axis in 'xyz']
+        num_frames = self.data.shape[0]
+        if not names:
+            return np.zeros((num_frames, 0, 3))
+        fields = self.data.dtype.fields
+        start = fields[names[0]][1]
+        packed = self.data.flags['C_CONTIGUOUS'] and all(
+            fields[name][0] == np.dtype(np.float64) and
+            fields[name][1] == start + 8 * i for i, name in enumerate(names))
+        if packed:
+            return np.ndarray((num_frames, len(self.marker_names), 3),
+                              dtype=np.float64, buffer=self.data,
+                              offset=start,
+                              strides=(self.data.dtype.itemsize, 24, 8))
+        return np.stack([self.marker(mark) for mark in self.marker_names],
+                        axis=1)
+
+    def _transform(self, transform, *args):
+        # Applies transform to all markers at once, see rotate_xyz.
+        xyz = self.xyz()
+        transform(xyz, *args)
+        if not np.may_share_memory(xyz, self.data):
+            for imarker, mark in enumerate(self.marker_names):
+                for iaxis, axis in enumerate('xyz'):
+                    self.data[mark + '_t' + axis] = xyz[:, imarker, iaxis]
+
     def rotate(self, axis, value):
         """ rotate the data.
 
             axis : rotation axis
             value : angle in degree
         """
-        for imarker in range(self.num_markers):   
-            
-            temp = np.zeros((self.num_frames, 3))
-            temp[:,0] = self.data[self.marker_names[imarker] + '_tx']
-            temp[:,1] = self.data[self.marker_names[imarker] + '_ty']
-            temp[:,2] = self.data[self.marker_names[imarker] + '_tz']          
-            
-            r = R.from_euler(axis, value, degrees=True)            
-            temp_rot = r.apply(temp)
-            
-            self.data[self.marker_names[imarker] + '_tx'] = temp_rot[:,0]
-            self.data[self.marker_names[imarker] + '_ty'] = temp_rot[:,1]
-            self.data[self.marker_names[imarker] + '_tz'] = temp_rot[:,2]
+        self._transform(rotate_xyz, axis, value)
             
     def offset(self, axis, value):
         """ offset the data.
@@ -271,12 +301,150 @@ class TRCFile(object):
             axis : rotation axis
             value : offset in m
         """
-        for imarker in range(self.num_markers):            
-            if axis.lower() == 'x':
-                self.data[self.marker_names[imarker] + '_tx'] += value
-            elif axis.lower() == 'y':
-                self.data[self.marker_names[imarker] + '_ty'] += value       
-            elif axis.lower() == 'z':
-                self.data[self.marker_names[imarker] + '_tz'] += value          
-            else:
-                raise ValueError("Axis not recognized")
+        self._transform(offset_xyz, axis, value)
+
+    def scale(self, factor):
+        """ scale the data.
+
+            factor : scale factor, or one factor per axis
+        """
+        self._transform(scale_xyz, factor)
+
+    def swap_axes(self, axis1, axis2):
+        """ swap two axes of the data, eg 'y' and 'z'.
+        """
+        self._transform(swap_axes_xyz, axis1, axis2)
+
+class MarkerSet(object):
+    """Marker trajectories held in memory, as a `num_frames` x `num_markers`
+    x 3 array.
+
+    Carries markers through the processing steps (rotation, augmentation,
+    offset) without writing and reading a TRC file between steps; files are
+    written with `write`, in the format of `TRCFile.write`.
+
+    """
+    def __init__(self, time, xyz, marker_names, data_rate, units='m',
+                 camera_rate=None, orig_data_rate=None,
+                 orig_data_start_frame=1, orig_num_frames=None):
+        """
+        Parameters
+        ----------
+        time : array_like
+            Time of each frame.
+        xyz : array_like
+            Marker positions, `num_frames` x `num_markers` x 3, or
+            `num_frames` x 3 * `num_markers` with columns x, y, z of each
+            marker.
+        marker_names : list of str
+        data_rate : float
+
+        """
+        self.time = np.asarray(time, dtype=float)
+        self.xyz = np.asarray(xyz, dtype=float).reshape(
+            len(self.time), len(marker_names), 3)
+        self.marker_names = list(marker_names)
+        self.data_rate = data_rate
+        self.units = units
+        self.camera_rate = data_rate if camera_rate is None else camera_rate
+        self.orig_data_rate = (data_rate if orig_data_rate is None
+                               else orig_data_rate)
+        self.orig_data_start_frame = orig_data_start_frame
+        self.orig_num_frames = (len(self.time) if orig_num_frames is None
+                                else orig_num_frames)
+
+    @classmethod
+    def read(cls, fpath):
+        """Marker set of a TRC file."""
+        header = read_trc_header(fpath)
+        values = readTRCData(fpath, 3 * header['num_markers'] + 1 + 1)
+        return cls(values[:, 1], values[:, 2:], header['marker_names'],
+                   header['data_rate'], units=header['units'],
+                   camera_rate=header['camera_rate'],
+                   orig_data_rate=header['orig_data_rate'],
+                   orig_data_start_frame=header['orig_data_start_frame'],
+                   orig_num_frames=header['orig_num_frames'])
+
+    @property
+    def num_frames(self):
+        return self.xyz.shape[0]
+
+    @property
+    def num_markers(self):
+        return self.xyz.shape[1]
+
+    def copy(self):
+        return MarkerSet(self.time.copy(), self.xyz.copy(), self.marker_names,
+                         self.data_rate, units=self.units,
+                         camera_rate=self.camera_rate,
+                         orig_data_rate=self.orig_data_rate,
+                         orig_data_start_frame=self.orig_data_start_frame,
+                         orig_num_frames=self.orig_num_frames)
+
+    def marker(self, name):
+        """The trajectory of marker `name`, as a `num_frames` x 3 array."""
+        return self.xyz[:, self.marker_names.index(name)].copy()
+
+    def markers(self, names):
+        """Trajectories of markers `names`, as a `num_frames` x
+        3 * len(`names`) array with columns x, y, z of each marker (the data
+        columns of `utils.TRC2numpy`).
+
+        """
+        idx = [self.marker_names.index(name) for name in names]
+        return self.xyz[:, idx].reshape(self.num_frames, -1)
+
+    def add_markers(self, names, xyz):
+        """Add markers `names`, with positions `xyz` given as in `__init__`.
+        """
+        xyz = np.asarray(xyz, dtype=float).reshape(
+            self.num_frames, len(names), 3)
+        self.xyz = np.concatenate((self.xyz, xyz), axis=1)
+        self.marker_names += list(names)
+
+    def rotate(self, axis, value):
+        """ rotate the data.
+
+            axis : rotation axis
+            value : angle in degree
+        """
+        rotate_xyz(self.xyz, axis, value)
+
+    def offset(self, axis, value):
+        """ offset the data.
+
+            axis : rotation axis
+            value : offset in m
+        """
+        offset_xyz(self.xyz, axis, value)
+
+    def scale(self, factor):
+        """ scale the data.
+
+            factor : scale factor, or one factor per axis
+        """
+        scale_xyz(self.xyz, factor)
+
+    def swap_axes(self, axis1, axis2):
+        """ swap two axes of the data, eg 'y' and 'z'.
+        """
+        swap_axes_xyz(self.xyz, axis1, axis2)
+
+    def write(self, fpath):
+        """Write this marker set to a TRC file, as `TRCFile.write`.
+
+        Parameters
+        ----------
+        fpath : str
+            Valid file path to which this marker set is saved.
+
+        """
+        with open(fpath, 'w') as f:
+            writeTRCHeader(f, os.path.split(fpath)[0], self.data_rate,
+                           self.camera_rate, self.num_frames,
+                           self.marker_names, self.units,
+                           self.orig_data_rate, self.orig_data_start_frame,
+                           self.orig_num_frames)
+            writeTRCRows(f, self.time, self.markers(self.marker_names),
+                         timeFormat='%.7f', valueFormat='%.7f',
+                         trailingTab=False)
@@ -5,19 +5,33 @@ import pickle
 import numpy as np
 import json
 import sys
-import time
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from decouple import config
 
 from utils import getOpenPoseMarkerNames, getMMposeMarkerNames, getVideoExtension
 from utilsChecker import getVideoRotation
+from utilsPoseStore import initPoseArrays, writePoseOutputs, getPoseArraysPath
+from utilsJobQueue import submitJob, waitForJob, getJobDir, removeJob
+from utilsProfiler import profileStage
+
+# mmpose workers with loaded models, reused across videos.
+_mmposeServices = {}
+_mmposeServicesLock = threading.Lock()
 
 # %%
 def runPoseDetector(CameraDirectories, trialRelativePath, pathPoseDetector,
                     trialName,
                     CamParamDict=None, resolutionPoseDetection='default',
                     generateVideo=True, cams2Use=['all'],
-                    poseDetector='OpenPose', bbox_thr=0.8):
+                    poseDetector='OpenPose', bbox_thr=0.8,
+                    maxConcurrentPose=None, profiler=None):
+    # Videos of all cameras are rewritten concurrently, and pose detection
+    # of each camera starts as soon as its video is ready, with at most
+    # maxConcurrentPose cameras in pose detection at once (default from the
+    # POSE_CONCURRENCY environment variable, 1 if not set).
     
     # Create list of cameras.
     if cams2Use[0] == 'all':
@@ -38,21 +52,96 @@ def runPoseDetector(CameraDirectories, trialRelativePath, pathPoseDetector,
     extension = getVideoExtension(pathVideoWithoutExtension)            
     trialRelativePath += extension
         
-    for camName in CameraDirectories_selectedCams:
+    if maxConcurrentPose is None:
+        maxConcurrentPose = config("POSE_CONCURRENCY", cast=int, default=1)
+    
+    def preprocess(camName):
+        cameraDirectory = CameraDirectories_selectedCams[camName]
+        if os.path.exists(os.path.join(cameraDirectory, trialRelativePath)):
+            with profileStage(profiler, 'videoRewrite', camName):
+                rotateVideo(cameraDirectory, trialRelativePath)
+    
+    def detect(camName, preprocessing):
+        # Wait for this camera's video to be rewritten.
+        preprocessing.result()
         cameraDirectory = CameraDirectories_selectedCams[camName]
         print('Running {} for {}'.format(poseDetector, camName))
-        if poseDetector == 'OpenPose':
-            runOpenPoseVideo(
-                cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
-                resolutionPoseDetection=resolutionPoseDetection,
-                generateVideo=generateVideo)
-        elif poseDetector == 'mmpose':
-            runMMposeVideo(
-                cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
-                generateVideo=generateVideo, bbox_thr=bbox_thr)
+        with profileStage(profiler, 'poseDetection', camName):
+            if poseDetector == 'OpenPose':
+                runOpenPoseVideo(
+                    cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
+                    resolutionPoseDetection=resolutionPoseDetection,
+                    generateVideo=generateVideo)
+            elif poseDetector == 'mmpose':
+                runMMposeVideo(
+                    cameraDirectory,trialRelativePath,pathPoseDetector, trialName,
+                    generateVideo=generateVideo, bbox_thr=bbox_thr)
+    
+    camNames = list(CameraDirectories_selectedCams.keys())
+    with ThreadPoolExecutor(max_workers=len(camNames)) as preprocessPool, \
+            ThreadPoolExecutor(max_workers=maxConcurrentPose) as posePool:
+        preprocessing = {camName: preprocessPool.submit(preprocess, camName)
+                         for camName in camNames}
+        detecting = [posePool.submit(detect, camName, preprocessing[camName])
+                     for camName in camNames]
+        # Raise the first error, in camera order, once all cameras are done.
+        errors = [f.exception() for f in detecting]
+    for error in errors:
+        if error is not None:
+            raise error
             
     return extension
             
+# %%
+def getPosePklPath(cameraDirectory, trialName, trial_id, poseDetector='OpenPose',
+                   resolutionPoseDetection='default', bbox_thr=0.8):
+    # Path of the post-processed pose pickle written by runOpenPoseVideo and
+    # runMMposeVideo.
+    
+    if poseDetector == 'OpenPose':
+        outputPklFolder = "OutputPkl_" + resolutionPoseDetection
+    elif poseDetector == 'mmpose':
+        outputPklFolder = "OutputPkl_mmpose_" + str(bbox_thr)
+        
+    return os.path.join(cameraDirectory, outputPklFolder, trialName,
+                        trial_id + '_rotated_pp.pkl')
+
+# %%
+def removePoseOutputs(cameraDirectory, trialRelativePath, ppPklPath):
+    # Removes the rewritten video and the pose outputs of a trial, such that
+    # runPoseDetector processes it again.
+    
+    trialPath, _ = os.path.splitext(trialRelativePath)
+    for path in [os.path.join(cameraDirectory, trialPath + "_rotated.avi"),
+                 ppPklPath, getPoseArraysPath(ppPklPath),
+                 ppPklPath.replace('_pp.pkl', '.pkl')]:
+        if os.path.exists(path):
+            os.remove(path)
+            
+# %%
+def rotateVideo(cameraDirectory, fileName):
+    # The video is rewritten, unrotated, and downsampled. There is no
+    # need to do anything specific for the rotation, just rewriting the video
+    # unrotates it. Returns the path of the rewritten video, relative to
+    # cameraDirectory.
+    
+    videoFullPath = os.path.normpath(os.path.join(cameraDirectory, fileName))
+    trialPath, _ = os.path.splitext(fileName)        
+    fileName = trialPath + "_rotated.avi"
+    pathVideoRot = os.path.normpath(os.path.join(cameraDirectory, fileName))
+    cmd_fr = ' '
+    # frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
+    # if frameRate > 60.0: # previously downsampled for efficiency
+    #     cmd_fr = ' -r 60 '
+    #     frameRate = 60.0  
+    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
+        videoFullPath, cmd_fr, pathVideoRot)
+    
+    if not os.path.exists(pathVideoRot):
+        os.system(CMD)
+        
+    return fileName
+
 # %%
 def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
                      resolutionPoseDetection='default', generateVideo=True):
@@ -86,37 +175,19 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
     thisVideo = cv2.VideoCapture(videoFullPath)
     nFrameIn = int(thisVideo.get(cv2.CAP_PROP_FRAME_COUNT))
     
-    # The video is rewritten, unrotated, and downsampled. There is no
-    # need to do anything specific for the rotation, just rewriting the video
-    # unrotates it.
-    trialPath, _ = os.path.splitext(fileName)        
-    fileName = trialPath + "_rotated.avi"
-    pathVideoRot = os.path.normpath(os.path.join(cameraDirectory, fileName))
-    cmd_fr = ' '
-    # frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
-    # if frameRate > 60.0: # previously downsampled for efficiency
-    #     cmd_fr = ' -r 60 '
-    #     frameRate = 60.0  
-    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
-        videoFullPath, cmd_fr, pathVideoRot)
-        
-    videoFullPath = pathVideoRot
+    # The video is rewritten, unrotated, and downsampled.
+    fileName = rotateVideo(cameraDirectory, fileName)
+    videoFullPath = os.path.normpath(os.path.join(cameraDirectory, fileName))
     trialPrefix = trialPrefix + "_rotated"
-    
-    if not os.path.exists(pathVideoRot):
-        os.system(CMD)
 
     # Run OpenPose if this file doesn't exist in outputs
     ppPklPath = os.path.join(pathOutputPkl, trialPrefix + '_pp.pkl')    
     if not os.path.exists(ppPklPath):
-        c_path = os.getcwd()
-        command = runOpenPoseCMD(
+        runOpenPoseCMD(
             pathOpenPose, resolutionPoseDetection, cameraDirectory,
             fileName, openposeJsonDir, pathOutputVideo, trialPrefix,
             generateVideo, videoFullPath, pathOutputJsons)
         
-        if not pathOpenPose == "docker":
-            os.chdir(c_path)            
         # Get number of frames output video. We count the number of jsons, as
         # videos are not written on server.
         nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
@@ -128,16 +199,12 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
         if not resolutionPoseDetection == 'default' and checknFrames:
             countFrames = 0
             while nFrameIn != nFrameOut:
-                # Need to get command again, as there is os.chdir(pathOpenPose)
-                # in the function.
-                command = runOpenPoseCMD(pathOpenPose, resolutionPoseDetection,
-                                         cameraDirectory, fileName, 
-                                         openposeJsonDir, pathOutputVideo,
-                                         trialPrefix, generateVideo,
-                                         videoFullPath, pathOutputJsons)
+                runOpenPoseCMD(pathOpenPose, resolutionPoseDetection,
+                               cameraDirectory, fileName, 
+                               openposeJsonDir, pathOutputVideo,
+                               trialPrefix, generateVideo,
+                               videoFullPath, pathOutputJsons)
 
-                if not pathOpenPose == "docker":
-                    os.chdir(c_path)
                 nFrameOut = len([f for f in os.listdir(pathOutputJsons) 
                                  if f.endswith('.json')])
                 if countFrames > 4:
@@ -154,6 +221,29 @@ def runOpenPoseVideo(cameraDirectory,fileName,pathOpenPose, trialName,
         
     return
         
+# %%
+def runDockerPoseJob(queueDir, videoPath, outputDir, detectorName,
+                     timeout=60*60):
+    # Submits a video to a pose-detection container through its job queue,
+    # waits for the result and copies the outputs to outputDir.
+    
+    jobId = submitJob(queueDir, videoPath)
+    try:
+        result = waitForJob(queueDir, jobId, timeout=timeout)
+        if result is None:
+            raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - ' + detectorName)
+        if result['status'] == 'error':
+            raise Exception('{} job {} failed: {}'.format(
+                detectorName, jobId, result['error']))
+        jobDir = getJobDir(queueDir, jobId)
+        os.makedirs(outputDir, exist_ok=True)
+        for output in result['outputs']:
+            shutil.copy(os.path.join(jobDir, output), outputDir)
+    finally:
+        removeJob(queueDir, jobId)
+        
+    return result
+
 # %%
 def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
                    fileName, openposeJsonDir, pathOutputVideo, trialPrefix, 
@@ -166,6 +256,7 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
         horizontal = False
     
     command = None
+    cwd = None
     if resolutionPoseDetection == 'default':
         cmd_hr = ' '
     elif resolutionPoseDetection == '1x1008_4scales':
@@ -185,29 +276,12 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
             cmd_hr = ' --net_resolution "736x-1" --scale_number 2 --scale_gap 0.75 '
         
     if config("DOCKERCOMPOSE", cast=bool, default=False):
-        vid_path_tmp = "/data/tmp-video.mov"
-        vid_path = "/data/video_openpose.mov"
-        
-        # copy the video to vid_path_tmp
-        shutil.copy(f"{cameraDirectory}/{fileName}", vid_path_tmp)
-        
-        # rename the video to vid_path
-        os.rename(vid_path_tmp, vid_path)
-
         try:
-            # wait until the video is processed (i.e. until the video is removed -- then json should be ready)
-            start = time.time()
-            while True:
-                if not os.path.isfile(vid_path):
-                    break
-                
-                if start + 60*60 < time.time():
-                    raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - openpose')
-                
-                time.sleep(0.1)
-            
-            # copy /data/output to openposeJsonDir
-            os.system("cp /data/output_openpose/* {cameraDirectory}/{openposeJsonDir}/".format(cameraDirectory=cameraDirectory, openposeJsonDir=openposeJsonDir))
+            # Submit the video to the openpose container and copy the jsons
+            # back once the job is done.
+            runDockerPoseJob(
+                "/data/queue_openpose", f"{cameraDirectory}/{fileName}",
+                os.path.join(cameraDirectory, openposeJsonDir), 'openpose')
         
         except Exception as e:
             if len(e.args) == 2: # specific exception
@@ -226,7 +300,7 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
             --render_pose 0{}".format(cameraDirectory, fileName,
                                         openposeJsonDir, cmd_hr)
     else:
-        os.chdir(pathOpenPose)
+        cwd = pathOpenPose
         pathVideoOut = os.path.join(pathOutputVideo,
                                     trialPrefix + 'withKeypoints.avi')
         if not generateVideo:
@@ -237,7 +311,9 @@ def runOpenPoseCMD(pathOpenPose, resolutionPoseDetection, cameraDirectory,
                 videoFullPath, pathOutputJsons, cmd_hr, pathVideoOut))
 
     if command:
-        os.system(command)
+        # Run in pathOpenPose without changing the working directory of the
+        # process, so that other cameras can be processed concurrently.
+        subprocess.run(command, shell=True, cwd=cwd)
     
     return
 
@@ -272,53 +348,22 @@ def runMMposeVideo(
     thisVideo = cv2.VideoCapture(videoFullPath)
     # frameRate = np.round(thisVideo.get(cv2.CAP_PROP_FPS))
     
-    # The video is rewritten, unrotated, and downsampled. There is no
-    # need to do anything specific for the rotation, just rewriting the video
-    # unrotates it. 
-    trialPath, _ = os.path.splitext(fileName)        
-    fileName = trialPath + "_rotated.avi"
-    pathVideoRot = os.path.normpath(os.path.join(cameraDirectory, fileName))  
-    cmd_fr = ' '
-    # if frameRate > 60.0:
-    #     cmd_fr = ' -r 60 '
-    #     frameRate = 60.0  
-    CMD = "ffmpeg -loglevel error -y -i {}{}-q 0 {}".format(
-        videoFullPath, cmd_fr, pathVideoRot)
-        
-    videoFullPath = pathVideoRot
+    # The video is rewritten, unrotated, and downsampled.
+    fileName = rotateVideo(cameraDirectory, fileName)
+    videoFullPath = os.path.normpath(os.path.join(cameraDirectory, fileName))
     trialPrefix = trialPrefix + "_rotated"
-    
-    if not os.path.exists(pathVideoRot):
-        os.system(CMD)
  
     pklPath = os.path.join(pathOutputPkl, trialPrefix + '.pkl')
     ppPklPath = os.path.join(pathOutputPkl, trialPrefix + '_pp.pkl')
     # Run pose detector if this file doesn't exist in outputs
     if not os.path.exists(ppPklPath):
         if config("DOCKERCOMPOSE", cast=bool, default=False):
-            vid_path_tmp = "/data/tmp-video.mov"
-            vid_path = "/data/video_mmpose.mov"
-            
-            # copy the video to vid_path_tmp
-            shutil.copy(f"{cameraDirectory}/{fileName}", vid_path_tmp)
-            
-            # rename the video to vid_path
-            os.rename(vid_path_tmp, vid_path)
-    
             try:
-                # wait until the video is processed (i.e. until the video is removed -- then json should be ready)
-                start = time.time()
-                while True:
-                    if not os.path.isfile(vid_path):
-                        break
-                    
-                    if start + 60*60 < time.time():
-                        raise Exception("Pose detection timed out. This is unlikely to be your fault, please report this issue on the forum. You can proceed with your data collection (videos are uploaded to the server) and later reprocess errored trials.", 'timeout - hrnet')
-                
-                    time.sleep(0.1)
-                      
-                # copy /data/output to pathOutputPkl
-                os.system("cp /data/output_mmpose/* {pathOutputPkl}/".format(pathOutputPkl=pathOutputPkl))
+                # Submit the video to the mmpose container and copy the
+                # pose pickle back once the job is done.
+                runDockerPoseJob(
+                    "/data/queue_mmpose", f"{cameraDirectory}/{fileName}",
+                    pathOutputPkl, 'hrnet')
                 pkl_path_tmp = os.path.join(pathOutputPkl, 'human.pkl')
                 if os.path.exists(pkl_path_tmp):
                     os.rename(pkl_path_tmp, pklPath)
@@ -335,24 +380,30 @@ def runMMposeVideo(
         else:           
             c_path = os.path.dirname(os.path.abspath(__file__))
             sys.path.append(os.path.join(c_path, 'mmpose'))
-            from utilsMMpose import detection_inference, pose_inference
-            # Run human detection.
+            from utilsMMpose import MMposeService
+            # Models are initialized once per process and reused.
             pathModelCkptPerson = os.path.join(pathMMpose, model_ckpt_person)
-            bboxPath = os.path.join(pathOutputBox, trialPrefix + '.pkl')
             full_model_config_person = os.path.join(c_path, 'mmpose',
                                                     model_config_person)
-            detection_inference(full_model_config_person, pathModelCkptPerson,
-                                videoFullPath, bboxPath)        
-            
-            # Run pose detection.     
             pathModelCkptPose = os.path.join(pathMMpose, model_ckpt_pose)
-            videoOutPath = os.path.join(pathOutputVideo,
-                                        trialPrefix + 'withKeypoints.mp4')
             full_model_config_pose = os.path.join(c_path, 'mmpose',
                                                   model_config_pose)
-            pose_inference(full_model_config_pose, pathModelCkptPose, 
-                            videoFullPath, bboxPath, pklPath, videoOutPath, 
-                            bbox_thr=bbox_thr, visualize=generateVideo)
+            serviceKey = (full_model_config_person, pathModelCkptPerson,
+                          full_model_config_pose, pathModelCkptPose, bbox_thr)
+            with _mmposeServicesLock:
+                if serviceKey not in _mmposeServices:
+                    _mmposeServices[serviceKey] = MMposeService(
+                        full_model_config_person, pathModelCkptPerson,
+                        full_model_config_pose, pathModelCkptPose,
+                        bbox_thr=bbox_thr)
+            
+            # Run human and pose detection.
+            bboxPath = os.path.join(pathOutputBox, trialPrefix + '.pkl')
+            videoOutPath = os.path.join(pathOutputVideo,
+                                        trialPrefix + 'withKeypoints.mp4')
+            _mmposeServices[serviceKey].process_video(
+                videoFullPath, bboxPath, pklPath, video_out_path=videoOutPath,
+                visualize=generateVideo)
             
         # Post-process data to have OpenPose-like file structure.        
         arrangeMMposePkl(pklPath, ppPklPath)
@@ -378,60 +429,55 @@ def arrangeMMposePkl(poseInferencePklPath, outputPklPath):
     open_file.close()
     
     markersMMpose = getMMposeMarkerNames()
-    markersOpenPose = getOpenPoseMarkerNames()    
+    markersOpenPose = getOpenPoseMarkerNames()
     
-    data4pkl = []
+    # Indices of the OpenPose markers in the MMpose markers. midHip and Neck
+    # are not MMpose markers and are computed from the hips and shoulders.
+    idxMarkers = np.array([markersMMpose.index(marker) 
+                           if marker in markersMMpose else 0 
+                           for marker in markersOpenPose])
+    idxMidHip = markersOpenPose.index("midHip")
+    idxNeck = markersOpenPose.index("Neck")
+    idxLHip, idxRHip = markersMMpose.index("LHip"), markersMMpose.index("RHip")
+    idxLShoulder = markersMMpose.index("LShoulder")
+    idxRShoulder = markersMMpose.index("RShoulder")
+    
+    nSlots = max([len(frame) for frame in frames], default=1)
+    poseArrays = initPoseArrays(len(frames), nSlots)
     for c_frame, frame in enumerate(frames):
-        data4people = []
-        for c, person in enumerate(frame):        
-            coordinates = person['preds_with_flip'].tolist()        
-            c_coord_out = np.zeros((25*3,))  
-            for c_m, marker in enumerate(markersOpenPose):            
-                if marker == "midHip":
-                    leftHip = coordinates[markersMMpose.index("LHip")]
-                    rightHip = coordinates[markersMMpose.index("RHip")]
-                    c_coord = []
-                    # Mid point between both hips
-                    c_coord.append((leftHip[0] + rightHip[0]) / 2)
-                    c_coord.append((leftHip[1] + rightHip[1]) / 2)
-                    # Lowest confidence
-                    c_coord.append(np.min([leftHip[2], rightHip[2]]))                
-                elif marker == "Neck":                
-                    leftShoulder = coordinates[
-                        markersMMpose.index("LShoulder")]
-                    rightShoulder = coordinates[
-                        markersMMpose.index("RShoulder")]                
-                    c_coord = []
-                    # Mid point between both shoulders
-                    c_coord.append((leftShoulder[0] + rightShoulder[0]) / 2)
-                    c_coord.append((leftShoulder[1] + rightShoulder[1]) / 2)
-                    # Lowest confidence
-                    c_coord.append(np.min([leftShoulder[2],
-                                           rightShoulder[2]]))                
-                else:
-                    c_coord = coordinates[markersMMpose.index(marker)]            
-                idx_out = np.arange(c_m*3, c_m*3+3)
-                c_coord_out[idx_out,] = c_coord            
-            c_dict = {}
-            c_dict['person_id'] = [c]
-            c_dict['pose_keypoints_2d'] = c_coord_out.tolist()
-            data4people.append(c_dict)
-        data4pkl.append(data4people)
+        nPeople = len(frame)
+        if nPeople == 0:
+            continue
+        coordinates = np.stack([person['preds_with_flip'] for person in frame
+                                ]).astype(np.float64)
+        c_coord_out = coordinates[:,idxMarkers,:3]
+        # Mid point between both hips, lowest confidence
+        c_coord_out[:,idxMidHip,:2] = (coordinates[:,idxLHip,:2] + 
+                                       coordinates[:,idxRHip,:2]) / 2
+        c_coord_out[:,idxMidHip,2] = np.minimum(coordinates[:,idxLHip,2],
+                                                coordinates[:,idxRHip,2])
+        # Mid point between both shoulders, lowest confidence
+        c_coord_out[:,idxNeck,:2] = (coordinates[:,idxLShoulder,:2] + 
+                                     coordinates[:,idxRShoulder,:2]) / 2
+        c_coord_out[:,idxNeck,2] = np.minimum(coordinates[:,idxLShoulder,2],
+                                              coordinates[:,idxRShoulder,2])
+        
+        poseArrays['nPeople'][c_frame] = nPeople
+        poseArrays['personIds'][c_frame,:nPeople] = np.arange(nPeople)
+        poseArrays['keypoints'][c_frame,:nPeople] = c_coord_out[:,:,:2]
+        poseArrays['confidence'][c_frame,:nPeople] = c_coord_out[:,:,2]
+        if all(['bbox' in person for person in frame]):
+            poseArrays['bboxes'][c_frame,:nPeople] = np.stack(
+                [person['bbox'][:5] for person in frame])
         
-    with open(outputPklPath, 'wb') as f:
-        pickle.dump(data4pkl, f)
+    writePoseOutputs(outputPklPath, poseArrays)
     
     return
 
 # %%
 def saveJsonsAsPkl(json_directory, outputPklPath, videoName):
     
-    nFrames = 0
-    for file in os.listdir(json_directory):
-      if videoName + "_000" in file: # not great
-        nFrames += 1
-                
-    data4pkl = []
+    keypoints4frames = []
     for frame in sorted(os.listdir(json_directory)):
         image_json = os.path.join(json_directory,frame)
         
@@ -440,20 +486,20 @@ def saveJsonsAsPkl(json_directory, outputPklPath, videoName):
         with open(image_json) as data_file:  
             data = json.load(data_file)
         
-        data4people = []
-        for person_idx in range(len(data['people'])):
-            
-            person = data['people'][person_idx]
-            keypoints = person['pose_keypoints_2d']
-            
-            
-            c_dict = {}
-            c_dict['person_id'] = [person_idx]
-            c_dict['pose_keypoints_2d'] = keypoints
-            data4people.append(c_dict)
-        data4pkl.append(data4people)
+        keypoints4frames.append(np.array(
+            [person['pose_keypoints_2d'] for person in data['people']],
+            dtype=np.float64).reshape((-1, 25, 3)))
+        
+    nSlots = max([len(keypoints) for keypoints in keypoints4frames], 
+                 default=1)
+    poseArrays = initPoseArrays(len(keypoints4frames), nSlots)
+    for c_frame, keypoints in enumerate(keypoints4frames):
+        nPeople = len(keypoints)
+        poseArrays['nPeople'][c_frame] = nPeople
+        poseArrays['personIds'][c_frame,:nPeople] = np.arange(nPeople)
+        poseArrays['keypoints'][c_frame,:nPeople] = keypoints[:,:,:2]
+        poseArrays['confidence'][c_frame,:nPeople] = keypoints[:,:,2]
         
-    with open(outputPklPath, 'wb') as f:
-        pickle.dump(data4pkl, f)
+    writePoseOutputs(outputPklPath, poseArrays)
                 
     return
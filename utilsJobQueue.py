@@ -0,0 +1,138 @@
+"""Job queue shared by the worker and the pose-detection containers.
+
+A queue is a directory on a volume shared by both sides:
+    <queueDir>/jobs/<jobId>/    input files and outputs of a job
+    <queueDir>/inbox/<jobId>.json    manifest of a submitted job
+    <queueDir>/claimed/<jobId>.json  manifest of a job being processed
+    <queueDir>/done/<jobId>.json     result of a job (status done or error)
+Manifests are written to a temporary file and renamed, so readers never see
+partial manifests, and a job is claimed by renaming its manifest, so several
+jobs can be in flight and several containers can serve the same queue. Paths
+in manifests are relative to the job directory since the volume is mounted
+at different places in each container.
+
+Kept compatible with python 3.6 (openpose image).
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+
+# %%
+def _writeJson(path, data):
+
+    pathTmp = path + '.tmp'
+    with open(pathTmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(pathTmp, path)
+
+# %%
+def _readJson(path):
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# %%
+def initQueue(queueDir):
+
+    for folder in ['jobs', 'inbox', 'claimed', 'done']:
+        os.makedirs(os.path.join(queueDir, folder), exist_ok=True)
+
+# %%
+def getJobDir(queueDir, jobId):
+
+    return os.path.join(queueDir, 'jobs', jobId)
+
+# %%
+def submitJob(queueDir, inputPath, params={}):
+    # Copies inputPath into a new job directory and submits the job. Returns
+    # the job id.
+
+    initQueue(queueDir)
+    jobId = uuid.uuid4().hex
+    jobDir = getJobDir(queueDir, jobId)
+    os.makedirs(jobDir)
+    inputName = 'input' + os.path.splitext(inputPath)[1]
+    shutil.copy(inputPath, os.path.join(jobDir, inputName))
+
+    manifest = {'jobId': jobId, 'input': inputName, 'params': params,
+                'submitted': time.time()}
+    _writeJson(os.path.join(queueDir, 'inbox', jobId + '.json'), manifest)
+
+    return jobId
+
+# %%
+def claimJob(queueDir):
+    # Claims the oldest submitted job. Returns its manifest, or None if the
+    # queue is empty.
+
+    initQueue(queueDir)
+    inboxDir = os.path.join(queueDir, 'inbox')
+    jobFiles = [f for f in os.listdir(inboxDir) if f.endswith('.json')]
+    jobFiles.sort(key=lambda f: os.path.getmtime(os.path.join(inboxDir, f))
+                  if os.path.exists(os.path.join(inboxDir, f)) else 0)
+    for jobFile in jobFiles:
+        claimedPath = os.path.join(queueDir, 'claimed', jobFile)
+        try:
+            os.rename(os.path.join(inboxDir, jobFile), claimedPath)
+        except OSError:
+            # Claimed by another container.
+            continue
+        manifest = _readJson(claimedPath)
+        manifest['claimed'] = time.time()
+        _writeJson(claimedPath, manifest)
+        return manifest
+
+    return None
+
+# %%
+def waitForClaim(queueDir, pollInterval=0.1):
+    # Blocks until a job can be claimed and returns its manifest.
+
+    while True:
+        manifest = claimJob(queueDir)
+        if manifest is not None:
+            return manifest
+        time.sleep(pollInterval)
+
+# %%
+def completeJob(queueDir, jobId, outputs=[], error=None, timing={}):
+    # Reports the result of a job. outputs are paths relative to the job
+    # directory.
+
+    claimedPath = os.path.join(queueDir, 'claimed', jobId + '.json')
+    result = _readJson(claimedPath) if os.path.exists(claimedPath) else {
+        'jobId': jobId}
+    result['status'] = 'done' if error is None else 'error'
+    result['outputs'] = outputs
+    result['error'] = error
+    result['timing'] = timing
+    result['completed'] = time.time()
+    _writeJson(os.path.join(queueDir, 'done', jobId + '.json'), result)
+    if os.path.exists(claimedPath):
+        os.remove(claimedPath)
+
+# %%
+def waitForJob(queueDir, jobId, timeout=60*60, pollInterval=0.1):
+    # Blocks until the job is completed and returns its result, or returns
+    # None if it takes longer than timeout (s).
+
+    donePath = os.path.join(queueDir, 'done', jobId + '.json')
+    start = time.time()
+    while not os.path.exists(donePath):
+        if time.time() - start > timeout:
+            return None
+        time.sleep(pollInterval)
+
+    return _readJson(donePath)
+
+# %%
+def removeJob(queueDir, jobId):
+
+    for folder in ['inbox', 'claimed', 'done']:
+        path = os.path.join(queueDir, folder, jobId + '.json')
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(getJobDir(queueDir, jobId), ignore_errors=True)
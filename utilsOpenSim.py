@@ -1,10 +1,29 @@
 import os
+import re
+import sys
 import utilsDataman
 import opensim
 import numpy as np
 import glob
 import json
-from utils import storage2numpy
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from utils import (storage2numpy, writeVisualizerBinary, getSlidingWindowRanges,
+                   getAvailableCPUs, API_TOKEN)
+from utilsStageCache import hashFile
+
+# %% Tools are run in this process through the bindings, rather than with
+# opensim-cmd, to avoid starting a process and loading the model again.
+def runTool(tool, toolName):
+    
+    try:
+        success = tool.run()
+    except RuntimeError as e:
+        raise Exception('{} failed: {}'.format(toolName, e))
+    if not success:
+        raise Exception('{} failed.'.format(toolName))
 
 # %% Scaling.
 def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
@@ -81,7 +100,7 @@ def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
     markerPlacer.setTimeRange(timeRange_os)
     
     # Disable tasks of dofs that are locked and markers that are not present.
-    model = opensim.Model(pathUpdGenericModel)
+    model = genericModel
     coordNames = []
     for coord in model.getCoordinateSet():
         if not coord.getDefaultLocked():
@@ -124,8 +143,7 @@ def runScaleTool(pathGenericSetupFile, pathGenericModel, subjectMass,
                       is not applied.'.format(meas.getName()))
     # Run scale tool.                      
     scaleTool.printToXML(pathOutputSetup)            
-    command = 'opensim-cmd -o error' + ' run-tool ' + pathOutputSetup
-    os.system(command)
+    runTool(scaleTool, 'Scale tool')
     
     # Sanity check
     scaled_model = opensim.Model(pathOutputModel)
@@ -163,11 +181,61 @@ def runIKTool(pathGenericSetupFile, pathScaledModel, pathTRCFile,
     pathOutputSetup =  os.path.join(
         pathOutputFolder, 'Setup_IK_' + IKFileName + '.xml')
     
+    # The model without patellas is loaded once and reused for all trials
+    # of the session, see getIKModel.
+    opensim.Logger.setLevelString('error')
+    ikModel = getIKModel(pathScaledModel)
+    pathScaledModelWithoutPatella = ikModel['path']
+
+    # Setup IK tool.    
+    IKTool = opensim.InverseKinematicsTool(pathGenericSetupFile)            
+    IKTool.setName(IKFileName)
+    IKTool.set_model_file(pathScaledModelWithoutPatella)          
+    IKTool.set_marker_file(pathTRCFile)
+    if timeRange:
+        IKTool.set_time_range(0, timeRange[0])
+        IKTool.set_time_range(1, timeRange[-1])
+    IKTool.setResultsDir(pathOutputFolder)                        
+    IKTool.set_report_errors(True)
+    IKTool.set_report_marker_locations(False)
+    IKTool.set_output_motion_file(pathOutputMotion)
+    IKTool.printToXML(pathOutputSetup)
+    with ikModel['lock']:
+        IKTool.setModel(ikModel['model'])
+        runTool(IKTool, 'Inverse kinematics tool')
+    
+    return pathOutputMotion, pathScaledModelWithoutPatella
+    
+    
+# %% Scaled models without patellas, by content of the scaled model and path
+# of the model without patellas. The scaled model is downloaded again for
+# each trial of a session (the Data folder is deleted after each trial), so
+# its modification time changes but its content does not.
+_ikModels = {}
+_ikModelsLock = threading.Lock()
+maxCachedIKModels = 4
+
+def getIKModel(pathScaledModel):
+    # Returns the cache entry (model, path and lock) of the model used for IK.
+    # The model is written to <scaledModel>_no_patella.osim, which is used
+    # for visualization, when that file is missing or older than the scaled
+    # model. Hold the lock while using the model.
+    
+    pathScaledModelWithoutPatella = pathScaledModel.replace('.osim', '_no_patella.osim')
+    key = (hashFile(pathScaledModel), 
+           os.path.abspath(pathScaledModelWithoutPatella))
+    with _ikModelsLock:
+        entry = _ikModels.get(key)
+    if entry is not None:
+        with entry['lock']:
+            if not os.path.exists(pathScaledModelWithoutPatella):
+                entry['model'].printToXML(pathScaledModelWithoutPatella)
+        return entry
+    
     # To make IK faster, we remove the patellas and their constraints from the
     # model. Constraints make the IK problem more difficult, and the patellas
     # are not used in the IK solution for this particular model. Since muscles
     # are attached to the patellas, we also remove all muscles.
-    opensim.Logger.setLevelString('error')
     model = opensim.Model(pathScaledModel)
     # Remove all actuators.                                         
     forceSet = model.getForceSet()
@@ -194,31 +262,196 @@ def runIKTool(pathGenericSetupFile, pathScaledModel, pathTRCFile,
     # Print the model to a new file.
     model.finalizeConnections
     model.initSystem()
-    pathScaledModelWithoutPatella = pathScaledModel.replace('.osim', '_no_patella.osim')
-    model.printToXML(pathScaledModelWithoutPatella)   
+    if (not os.path.exists(pathScaledModelWithoutPatella) or 
+            os.stat(pathScaledModelWithoutPatella).st_mtime_ns < 
+            os.stat(pathScaledModel).st_mtime_ns):
+        model.printToXML(pathScaledModelWithoutPatella)
+    
+    entry = {'model': model, 'path': pathScaledModelWithoutPatella,
+             'lock': threading.Lock()}
+    with _ikModelsLock:
+        entry = _ikModels.setdefault(key, entry)
+        while len(_ikModels) > maxCachedIKModels:
+            _ikModels.pop(next(iter(_ikModels)))
+    
+    return entry
+    
+# %% Inverse kinematics in overlapping time chunks, solved in parallel.
+def getIKChunks(times, nChunks, overlap):
+    # Splits the frames at times into nChunks consecutive chunks. For each
+    # chunk, returns the time range to solve, which starts overlap seconds
+    # before the chunk (except for the first chunk), and the time range of
+    # the frames to keep.
+    
+    edges = np.linspace(0, len(times), nChunks + 1).astype(int)
+    chunks = []
+    for i in range(nChunks):
+        keepRange = [times[edges[i]], times[edges[i+1] - 1]]
+        solveRange = [max(times[0], keepRange[0] - overlap), keepRange[1]]
+        chunks.append({'solveRange': solveRange, 'keepRange': keepRange})
+        
+    return chunks
 
-    # Setup IK tool.    
-    IKTool = opensim.InverseKinematicsTool(pathGenericSetupFile)            
-    IKTool.setName(IKFileName)
-    IKTool.set_model_file(pathScaledModelWithoutPatella)          
-    IKTool.set_marker_file(pathTRCFile)
-    if timeRange:
-        IKTool.set_time_range(0, timeRange[0])
-        IKTool.set_time_range(1, timeRange[-1])
-    IKTool.setResultsDir(pathOutputFolder)                        
-    IKTool.set_report_errors(True)
-    IKTool.set_report_marker_locations(False)
-    IKTool.set_output_motion_file(pathOutputMotion)
-    IKTool.printToXML(pathOutputSetup)
-    command = 'opensim-cmd -o error' + ' run-tool ' + pathOutputSetup
-    os.system(command)
+def stitchStorageFiles(pathFiles, keepRanges, pathOutputFile, tolerance=1e-4):
+    # Concatenates the rows of .mot/.sto files within keepRanges. The header
+    # of the first file is used, with the number of rows updated.
+    
+    header = None
+    rows = []
+    for pathFile, keepRange in zip(pathFiles, keepRanges):
+        with open(pathFile, 'r') as f:
+            lines = f.readlines()
+        iEndHeader = [l.strip() for l in lines].index('endheader')
+        if header is None:
+            # Header and column labels.
+            header = lines[:iEndHeader+2]
+        for line in lines[iEndHeader+2:]:
+            if not line.strip():
+                continue
+            time = float(line.split()[0])
+            if keepRange[0] - tolerance <= time <= keepRange[1] + tolerance:
+                rows.append(line)
+    header = ['nRows={}\n'.format(len(rows)) if line.startswith('nRows=') 
+              else line for line in header]
+    with open(pathOutputFile, 'w') as f:
+        f.writelines(header + rows)
+        
+def _runIKChunk(args):
+    # Runs in a worker process of runIKToolChunked.
     
-    return pathOutputMotion, pathScaledModelWithoutPatella
+    return runIKTool(*args)
+
+def _canSpawnWorkers():
+    # Spawned workers import the __main__ module of this process (unless it
+    # is interactive), which is only safe if the module does not run the
+    # pipeline at import, ie if it has an if __name__ == '__main__' guard.
+    
+    pathMain = getattr(sys.modules.get('__main__'), '__file__', None)
+    if pathMain is None:
+        return True
+    try:
+        with open(pathMain, 'r') as f:
+            source = f.read()
+    except (OSError, UnicodeDecodeError):
+        return False
+    
+    return re.search(r"^if\s+__name__\s*==\s*['\"]__main__['\"]", source,
+                     re.MULTILINE) is not None
+
+# Number of runIKToolChunked calls running in this process (eg trials in the
+# pipelined worker), which share the CPUs.
+_ikRunsInFlight = 0
+_ikRunsLock = threading.Lock()
+
+def runIKToolChunked(pathGenericSetupFile, pathScaledModel, pathTRCFile,
+                     pathOutputFolder, timeRange=[], IKFileName='not_specified',
+                     chunkDuration=10, overlap=0.5, nProcesses=None):
+    # Same as runIKTool, but the time range is split into chunks of about
+    # chunkDuration seconds that are solved in parallel processes. By default,
+    # the CPUs available to this process are shared between the concurrent
+    # calls. Trials shorter than two chunks, or with less than two processes,
+    # are solved with runIKTool. The overlap before each chunk is solved and
+    # discarded, such that frames are kept only once IK converged from the
+    # warm start of the chunk. The motion and the marker errors are stitched
+    # into the files written by runIKTool; the marker errors of each chunk
+    # are saved in <IKFileName>_ik_chunks.json. Workers are spawned and
+    # import the calling script, so IK is solved with runIKTool if the
+    # script has no if __name__ == '__main__' guard.
+    
+    if IKFileName == 'not_specified':
+        _, IKFileName = os.path.split(pathTRCFile)
+        IKFileName = IKFileName[:-4]
     
+    times = utilsDataman.TRCFile(pathTRCFile).time
+    if timeRange:
+        times = times[(times >= timeRange[0]) & (times <= timeRange[-1])]
+    nChunks = int((times[-1] - times[0]) // chunkDuration)
+    
+    global _ikRunsInFlight
+    with _ikRunsLock:
+        _ikRunsInFlight += 1
+        if nProcesses is None:
+            nProcesses = getAvailableCPUs() // _ikRunsInFlight
+    try:
+        nProcesses = min(nChunks, nProcesses)
+        if nProcesses < 2 or not _canSpawnWorkers():
+            return runIKTool(pathGenericSetupFile, pathScaledModel, 
+                             pathTRCFile, pathOutputFolder, 
+                             timeRange=timeRange, IKFileName=IKFileName)
+        return _runIKToolChunked(pathGenericSetupFile, pathScaledModel,
+                                 pathTRCFile, pathOutputFolder, times, 
+                                 IKFileName, nChunks, overlap, nProcesses)
+    finally:
+        with _ikRunsLock:
+            _ikRunsInFlight -= 1
+
+def _runIKToolChunked(pathGenericSetupFile, pathScaledModel, pathTRCFile,
+                      pathOutputFolder, times, IKFileName, nChunks, overlap,
+                      nProcesses):
+    
+    # Write the model used for IK once, before the workers load it.
+    getIKModel(pathScaledModel)
+    
+    chunks = getIKChunks(times, nChunks, overlap)
+    pathChunksFolder = os.path.join(pathOutputFolder, 
+                                    'Chunks_' + IKFileName)
+    os.makedirs(pathChunksFolder, exist_ok=True)
+    chunkFileNames = [IKFileName + '_chunk{}'.format(i) 
+                      for i in range(nChunks)]
+    # Spawned rather than forked: this process may run other threads (eg
+    # trials in the pipelined worker, TensorFlow), whose locks would be held
+    # forever in a forked child.
+    # The workers import utils, which logs in if there is no token in the
+    # environment or in the .env file.
+    os.environ.setdefault('API_TOKEN', API_TOKEN)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=nProcesses, 
+                             mp_context=context) as pool:
+        results = list(pool.map(_runIKChunk, [
+            (pathGenericSetupFile, pathScaledModel, pathTRCFile,
+             pathChunksFolder, chunk['solveRange'], chunkFileName)
+            for chunk, chunkFileName in zip(chunks, chunkFileNames)]))
+    
+    # Stitch motion and marker errors.
+    keepRanges = [chunk['keepRange'] for chunk in chunks]
+    pathOutputMotion = os.path.join(pathOutputFolder, IKFileName + '.mot')
+    stitchStorageFiles([pathMotion for pathMotion, _ in results], keepRanges,
+                       pathOutputMotion)
+    pathErrors = [os.path.join(pathChunksFolder, 
+                               chunkFileName + '_ik_marker_errors.sto')
+                  for chunkFileName in chunkFileNames]
+    stitchStorageFiles(pathErrors, keepRanges, os.path.join(
+        pathOutputFolder, IKFileName + '_ik_marker_errors.sto'))
+    
+    # Marker errors of the kept frames of each chunk.
+    chunkErrors = []
+    for pathError, chunk in zip(pathErrors, chunks):
+        errors = storage2numpy(pathError)
+        keep = ((errors['time'] >= chunk['keepRange'][0] - 1e-4) & 
+                (errors['time'] <= chunk['keepRange'][1] + 1e-4))
+        chunkErrors.append({
+            'solveRange': [float(t) for t in chunk['solveRange']],
+            'keepRange': [float(t) for t in chunk['keepRange']],
+            'marker_error_RMS': float(np.sqrt(np.mean(
+                errors['marker_error_RMS'][keep]**2))),
+            'marker_error_max': float(np.max(
+                errors['marker_error_max'][keep]))})
+        print('IK chunk {:.2f}-{:.2f}s: RMS marker error {:.4f} m, max {:.4f} m'.format(
+            chunkErrors[-1]['keepRange'][0], chunkErrors[-1]['keepRange'][1],
+            chunkErrors[-1]['marker_error_RMS'], 
+            chunkErrors[-1]['marker_error_max']))
+    with open(os.path.join(pathOutputFolder, 
+                           IKFileName + '_ik_chunks.json'), 'w') as f:
+        json.dump(chunkErrors, f, indent=2)
+    shutil.rmtree(pathChunksFolder)
+    
+    return pathOutputMotion, results[0][1]
     
 # %% This function will look for a time window, of a minimum duration specified
 # by thresholdTime, during which the markers move at most by a distance
-# specified by thresholdPosition.
+# specified by thresholdPosition. thresholdPosition can also be a list of
+# thresholds, in which case the smallest one for which a window is detected is
+# used.
 def getScaleTimeRange(pathTRCFile, thresholdPosition=0.005, thresholdTime=0.3,
                       withArms=True, withOpenPoseMarkers=False, isMocap=False,
                       removeRoot=False):
@@ -286,22 +519,35 @@ def getScaleTimeRange(pathTRCFile, thresholdPosition=0.005, thresholdTime=0.3,
     # Corresponding number of frames.
     nf = int(timeRange_min*sf + 1)
     
+    # Window sizes, from 1s down by 0.1s steps until shorter than 
+    # thresholdTime. The first window (earliest of the longest size) in
+    # which no marker moves by thresholdPosition or more is selected.
+    windowSizes = [nf]
+    while True:
+        nf -= max(1, int(0.1*sf))
+        if np.round((nf-1)/sf,2) < thresholdTime:
+            break
+        windowSizes.append(nf)
+    windowRanges = getSlidingWindowRanges(trc_data, windowSizes)
+    if np.round((windowSizes[0]-1)/sf,2) < thresholdTime:
+        # Only the first window is tried.
+        windowRanges[0] = windowRanges[0][:1]
+    
+    # With several thresholds, the range is selected with the smallest
+    # threshold for which a window is detected.
     detectedWindow = False
-    i = 0
-    while not detectedWindow:
-        c_window = trc_data[i:i+nf,:]
-        c_window_max = np.max(c_window, axis=0)
-        c_window_min = np.min(c_window, axis=0)
-        c_window_diff = np.abs(c_window_max - c_window_min)
-        detectedWindow = np.alltrue(c_window_diff<thresholdPosition)
-        if not detectedWindow:
-            i += 1
-            if i > c_trc_time.shape[0]-nf:
-                i = 0
-                nf -= int(0.1*sf) 
-            if np.round((nf-1)/sf,2) < thresholdTime: # number of frames got too small without detecting a window
-                exception = "Musculoskeletal model scaling failed; could not detect a static phase of at least %.2fs. After you press record, make sure the subject stands still until the message tells you they can relax . Visit https://www.opencap.ai/best-pratices to learn more about data collection." % thresholdTime
-                raise Exception(exception, exception)
+    for c_thresholdPosition in np.sort(np.atleast_1d(thresholdPosition)):
+        for nf, c_windowRanges in zip(windowSizes, windowRanges):
+            c_windows = np.flatnonzero(c_windowRanges < c_thresholdPosition)
+            if c_windows.size > 0:
+                i = c_windows[0]
+                detectedWindow = True
+                break
+        if detectedWindow:
+            break
+    if not detectedWindow:
+        exception = "Musculoskeletal model scaling failed; could not detect a static phase of at least %.2fs. After you press record, make sure the subject stands still until the message tells you they can relax . Visit https://www.opencap.ai/best-pratices to learn more about data collection." % thresholdTime
+        raise Exception(exception, exception)
     
     timeRange = [c_trc_time[i], c_trc_time[i+nf-1]]
     timeRangeSpan = np.round(timeRange[1] - timeRange[0], 2)
@@ -596,7 +842,12 @@ def compareTRCAndForcesTime(pathTRC,pathForces):
 # %% This takes model and IK and generates a json of body transforms that can 
 # be passed to the webapp visualizer
 def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
-                           vertical_offset=None, roundToRotations=None, roundToTranslations=None):
+                           vertical_offset=None, roundToRotations=None, roundToTranslations=None,
+                           outputFrameRate=None, binaryOutputPath=None):
+    # With outputFrameRate, the motion is decimated to about that frame rate
+    # (eg the playback rate of the webapp). With binaryOutputPath, the
+    # transforms are also written in the compact format of
+    # utils.writeVisualizerBinary.
     
     opensim.Logger.setLevelString('error')
     model = opensim.Model(modelPath)
@@ -610,6 +861,7 @@ def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
     stateTable = opensim.TimeSeriesTable(ikPath)
     stateNames = stateTable.getColumnLabels()
     stateTime = stateTable.getIndependentColumn()
+    stateData = stateTable.getMatrix().to_numpy()
     try:
         inDegrees = stateTable.getTableMetaDataAsString('inDegrees') == 'yes'
     except:
@@ -618,28 +870,34 @@ def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
     q = np.zeros((len(stateTime),nCoords))
     
     stateNamesOut= []
-    for col in stateNames:
+    for iCol, col in enumerate(stateNames):
         if 'activation' in col:
-            stateTable.removeColumn(col)
+            continue
         elif col[0] == '/' and any(['jointset' not in col, 'value' not in col]): # full state path
-            stateTable.removeColumn(col)
+            continue
         else:
             coordCol = [i for i,c in enumerate(coordNames) if c in col][0]
             coordName = col
             if col[0] == '/': # if full state path
                 temp = col[:col.rfind('/')]
                 coordName = temp[temp.rfind('/')+1:]
-            for t in range(len(stateTime)):
-                qTemp = np.asarray(stateTable.getDependentColumn(col)[t])
-                if coords.get(coordName).getMotionType() == 1 and inDegrees: # rotation
-                    qTemp = np.deg2rad(qTemp)
-                if 'pelvis_ty' in col and not (vertical_offset is None):
-                    qTemp -= (vertical_offset - 0.01)
-                q[t,coordCol] = qTemp
+            qTemp = np.copy(stateData[:, iCol])
+            if coords.get(coordName).getMotionType() == 1 and inDegrees: # rotation
+                qTemp = np.deg2rad(qTemp)
+            if 'pelvis_ty' in col and not (vertical_offset is None):
+                qTemp -= (vertical_offset - 0.01)
+            q[:,coordCol] = qTemp
             stateNamesOut.append(coordName) # This is always just coord - never full path
     
     # We may have deleted some columns
     stateNames = stateNamesOut
+    
+    # Frames to output.
+    frames = np.arange(len(stateTime))
+    if outputFrameRate is not None and len(stateTime) > 1:
+        frameRate = 1 / np.median(np.diff(stateTime))
+        step = max(1, int(np.round(frameRate / outputFrameRate)))
+        frames = frames[::step]
                           
     state = model.initSystem()
     
@@ -649,13 +907,17 @@ def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
     for stateName in stateNames:
         stateIdx = np.squeeze(np.argwhere([stateName+ '/value' in y for y in yNames]))
         systemStateInds.append(stateIdx)
+    Y = np.zeros((len(frames), state.getNY()))
+    for i in range(nCoords):
+        Y[:, systemStateInds[i]] = q[frames, i]
     
     # Loop over time and bodies
     visualizeDict = {}
-    visualizeDict['time'] = stateTime
+    visualizeDict['time'] = [stateTime[iTime] for iTime in frames]
     visualizeDict['bodies'] = {}
     
-    for body in bodyset:
+    bodies = list(bodyset)
+    for body in bodies:
         visualizeDict['bodies'][body.getName()] = {}
         attachedGeometries = []
         
@@ -673,36 +935,37 @@ def generateVisualizerJson(modelPath,ikPath,jsonOutputPath,statesInDegrees=True,
 
         scale_factors = attached_geometry.get_scale_factors().to_numpy() 
         visualizeDict['bodies'][body.getName()]['scaleFactors'] = scale_factors.tolist()
-        
-        # init body translation and rotations dictionaries
-          
-        visualizeDict['bodies'][body.getName()]['rotation'] = []
-        visualizeDict['bodies'][body.getName()]['translation'] = []
-    
-    for iTime, time in enumerate(stateTime): 
-        yVec = np.zeros((state.getNY())).tolist()
-        for i in range(nCoords):
-            yVec[systemStateInds[i]] = q[iTime,i]
-        state.setY(opensim.Vector(yVec))
+    
+    # The state is reused for all frames; transforms are collected in arrays
+    # and converted to lists once.
+    rotations = np.zeros((len(frames), len(bodies), 3))
+    translations = np.zeros((len(frames), len(bodies), 3))
+    for iFrame in range(len(frames)): 
+        state.setY(opensim.Vector(Y[iFrame].tolist()))
         
         model.realizePosition(state)
         
         # get body translations and rotations in ground
-        for body in bodyset:
+        for iBody, body in enumerate(bodies):
             # This gives us body transform to opensim body frame, which isn't nec. 
             # geometry origin. Ayman said getting transform to Geometry::Mesh is safest
             # but we don't have access to it thru API and Ayman said what we're doing
             # is OK for now
-            c_rotations = body.getTransformInGround(state).R().convertRotationToBodyFixedXYZ().to_numpy()
-            c_translations = body.getTransformInGround(state).T().to_numpy()
-            if roundToRotations is not None:                
-                c_rotations = np.round(c_rotations, roundToRotations)
-            if roundToTranslations is not None:
-                c_translations = np.round(c_translations, roundToTranslations)
-            visualizeDict['bodies'][body.getName()]['rotation'].append(c_rotations.tolist())
-            visualizeDict['bodies'][body.getName()]['translation'].append(c_translations.tolist())            
+            transform = body.getTransformInGround(state)
+            rotations[iFrame, iBody] = transform.R().convertRotationToBodyFixedXYZ().to_numpy()
+            translations[iFrame, iBody] = transform.T().to_numpy()
+    if roundToRotations is not None:                
+        rotations = np.round(rotations, roundToRotations)
+    if roundToTranslations is not None:
+        translations = np.round(translations, roundToTranslations)
+    for iBody, body in enumerate(bodies):
+        visualizeDict['bodies'][body.getName()]['rotation'] = rotations[:, iBody].tolist()
+        visualizeDict['bodies'][body.getName()]['translation'] = translations[:, iBody].tolist()
             
     with open(jsonOutputPath, 'w') as f:
         json.dump(visualizeDict, f)
+        
+    if binaryOutputPath is not None:
+        writeVisualizerBinary(visualizeDict, binaryOutputPath)
 
-    return        
+    return
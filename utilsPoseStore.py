@@ -0,0 +1,150 @@
+"""Array-native storage of 2D pose detections.
+
+Pose detections are stored as a single .npy file holding one record per
+frame, so that they can be memory-mapped and loaded in constant time. Each
+record holds a fixed number of person slots:
+    nPeople     number of people detected in the frame
+    personIds   id of each person, -1 for empty slots
+    keypoints   x and y coordinates of the 25 OpenPose keypoints
+    confidence  confidence of the 25 OpenPose keypoints
+    bboxes      detector bounding box (x1, y1, x2, y2, score), nan if unknown
+Empty slots are filled with nans. Slot i holds the i-th person of the frame,
+as in the legacy list-of-dict pickles ([frame][person]['pose_keypoints_2d']).
+"""
+
+import os
+import pickle
+import numpy as np
+
+nKeypoints = 25
+
+# %%
+def getPoseArraysPath(ppPklPath):
+
+    return os.path.splitext(ppPklPath)[0] + '.npy'
+
+# %%
+def getPoseDtype(nSlots):
+
+    return np.dtype([('nPeople', np.int32),
+                     ('personIds', np.int32, (nSlots,)),
+                     ('keypoints', np.float64, (nSlots, nKeypoints, 2)),
+                     ('confidence', np.float64, (nSlots, nKeypoints)),
+                     ('bboxes', np.float64, (nSlots, 5))])
+
+# %%
+def initPoseArrays(nFrames, nSlots):
+
+    poseArrays = np.zeros((nFrames,), dtype=getPoseDtype(max(nSlots, 1)))
+    poseArrays['personIds'] = -1
+    poseArrays['keypoints'] = np.nan
+    poseArrays['confidence'] = np.nan
+    poseArrays['bboxes'] = np.nan
+
+    return poseArrays
+
+# %%
+def savePoseArrays(path, poseArrays):
+
+    # Write to a temporary file first so that readers never see partial data.
+    pathTmp = path + '.tmp'
+    with open(pathTmp, 'wb') as f:
+        np.save(f, poseArrays, allow_pickle=False)
+    os.replace(pathTmp, path)
+
+# %%
+def loadPoseArrays(path, mmap=True):
+
+    return np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+# %% Convert legacy pickle frames to pose arrays.
+def peopleToPoseArrays(frames):
+
+    nSlots = max([len(frame) for frame in frames], default=1)
+    poseArrays = initPoseArrays(len(frames), nSlots)
+    for c_frame, frame in enumerate(frames):
+        if len(frame) == 0:
+            continue
+        poseArrays['nPeople'][c_frame] = len(frame)
+        keypoints = np.array([person['pose_keypoints_2d'] for person in frame],
+                             dtype=np.float64).reshape((len(frame), -1, 3))
+        poseArrays['keypoints'][c_frame,:len(frame)] = keypoints[:,:,:2]
+        poseArrays['confidence'][c_frame,:len(frame)] = keypoints[:,:,2]
+        for c, person in enumerate(frame):
+            if 'person_id' in person:
+                poseArrays['personIds'][c_frame,c] = np.ravel(
+                    person['person_id'])[0]
+            if 'bbox' in person:
+                poseArrays['bboxes'][c_frame,c] = person['bbox'][:5]
+
+    return poseArrays
+
+# %% Convert pose arrays to legacy pickle frames.
+def poseArraysToPeople(poseArrays):
+
+    nSlots = poseArrays['personIds'].shape[1]
+    keypoints = np.concatenate(
+        (poseArrays['keypoints'], poseArrays['confidence'][:,:,:,None]),
+        axis=3).reshape((len(poseArrays), nSlots, nKeypoints*3))
+
+    frames = []
+    for c_frame in range(len(poseArrays)):
+        data4people = []
+        for c in range(poseArrays['nPeople'][c_frame]):
+            c_dict = {}
+            c_dict['person_id'] = [int(poseArrays['personIds'][c_frame,c])]
+            c_dict['pose_keypoints_2d'] = keypoints[c_frame,c].tolist()
+            data4people.append(c_dict)
+        frames.append(data4people)
+
+    return frames
+
+# %% Write both the pose arrays and the legacy pickle (posted to the server).
+def writePoseOutputs(ppPklPath, poseArrays):
+
+    with open(ppPklPath, 'wb') as f:
+        pickle.dump(poseArraysToPeople(poseArrays), f)
+    # Written after the pickle so that loadPose uses it.
+    savePoseArrays(getPoseArraysPath(ppPklPath), poseArrays)
+
+# %% Load pose arrays for a _pp.pkl path. The array store is used when it is
+# at least as recent as the pickle, otherwise the pickle is converted (and
+# the arrays are cached next to it if cache is True).
+def loadPose(ppPklPath, mmap=True, cache=True):
+
+    arraysPath = getPoseArraysPath(ppPklPath)
+    if os.path.exists(arraysPath) and (
+            not os.path.exists(ppPklPath) or
+            os.path.getmtime(arraysPath) >= os.path.getmtime(ppPklPath)):
+        return loadPoseArrays(arraysPath, mmap=mmap)
+
+    with open(ppPklPath, 'rb') as f:
+        frames = pickle.load(f)
+    poseArrays = peopleToPoseArrays(frames)
+    if cache:
+        try:
+            savePoseArrays(arraysPath, poseArrays)
+        except OSError:
+            pass
+
+    return poseArrays
+
+# %% Rebuild the pose arrays from a legacy pickle, eg after downloading it.
+def convertPosePickle(ppPklPath):
+
+    with open(ppPklPath, 'rb') as f:
+        frames = pickle.load(f)
+    savePoseArrays(getPoseArraysPath(ppPklPath), peopleToPoseArrays(frames))
+
+# %% Per-person keypoints as nFrames x 75 arrays (x, y, confidence for each
+# keypoint), with nans in frames where the person is not detected.
+def getPeopleKeypoints(poseArrays):
+
+    nFrames = len(poseArrays)
+    nSlots = max(int(np.max(poseArrays['nPeople'], initial=0)), 1)
+    keypoints = np.concatenate(
+        (poseArrays['keypoints'][:,:nSlots],
+         poseArrays['confidence'][:,:nSlots,:,None]), axis=3)
+
+    return [keypoints[:,i].reshape((nFrames, nKeypoints*3))
+            for i in range(nSlots)]
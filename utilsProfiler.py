@@ -0,0 +1,192 @@
+"""Stage-level profiling of the processing pipeline.
+
+StageProfiler records, for each stage of main() and optionally for each
+camera, the wall time, CPU time, peak resident memory and bytes read and
+written. CPU time and I/O are process-wide counters, so figures of stages
+that run concurrently (eg cameras processed in parallel, or trials in the
+pipelined worker) overlap; threadCpuTime only counts the thread running the
+stage. childCpuTime counts subprocesses that have exited (eg ffmpeg), work
+done in other containers (OpenPose, mmpose) is only seen in wall time.
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# %%
+def _getRSS():
+    # Resident memory of this process in bytes, None if not available.
+
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+# %%
+def _getIOCounters():
+    # Bytes read and written by this process, None if not available.
+
+    if psutil is not None:
+        try:
+            io = psutil.Process().io_counters()
+            return (getattr(io, 'read_chars', io.read_bytes),
+                    getattr(io, 'write_chars', io.write_bytes))
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+# %%
+def _getCounters():
+
+    times = os.times()
+    return {'wall': time.perf_counter(),
+            'cpu': times.user + times.system,
+            'childCpu': times.children_user + times.children_system,
+            'threadCpu': time.thread_time(),
+            'io': _getIOCounters(),
+            'rss': _getRSS()}
+
+# %%
+def getProfilePath(outputDir, trial_id):
+
+    return os.path.join(outputDir, 'Profile_' + trial_id + '.json')
+
+# %%
+class StageProfiler(object):
+    """Records timing and resource usage of pipeline stages.
+
+    Use start/stop, or the stage context manager, around each stage. Stages
+    can be nested and can run in different threads. Peak RSS is sampled
+    every samplingInterval seconds while a stage is running.
+    """
+    def __init__(self, samplingInterval=0.05):
+
+        self.samplingInterval = samplingInterval
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.created = time.time()
+        self.running = {}
+        self.records = []
+        self._sampler = None
+
+    def _key(self, stage, camera):
+
+        return (stage, camera, threading.get_ident())
+
+    def _sample(self):
+        # Runs while stages are running.
+
+        while True:
+            time.sleep(self.samplingInterval)
+            rss = _getRSS()
+            with self.lock:
+                if not self.running or rss is None:
+                    self._sampler = None
+                    return
+                for counters in self.running.values():
+                    counters['peakRSS'] = max(counters['peakRSS'], rss)
+
+    def start(self, stage, camera=None):
+
+        counters = _getCounters()
+        counters['peakRSS'] = counters['rss'] or 0
+        with self.lock:
+            self.running[self._key(stage, camera)] = counters
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample,
+                                                 daemon=True)
+                self._sampler.start()
+
+    def stop(self, stage, camera=None):
+        # Returns the record of the stage, None if it was not started.
+
+        end = _getCounters()
+        with self.lock:
+            start = self.running.pop(self._key(stage, camera), None)
+            if start is None:
+                return None
+            record = {
+                'stage': stage,
+                'camera': camera,
+                'start': start['wall'] - self.t0,
+                'wallTime': end['wall'] - start['wall'],
+                'cpuTime': end['cpu'] - start['cpu'],
+                'childCpuTime': end['childCpu'] - start['childCpu'],
+                'threadCpuTime': end['threadCpu'] - start['threadCpu'],
+                'peakRSS': None,
+                'readBytes': None,
+                'writeBytes': None}
+            if end['rss'] is not None:
+                record['peakRSS'] = max(start['peakRSS'], end['rss'])
+            if start['io'] is not None and end['io'] is not None:
+                record['readBytes'] = end['io'][0] - start['io'][0]
+                record['writeBytes'] = end['io'][1] - start['io'][1]
+            self.records.append(record)
+
+        return record
+
+    @contextmanager
+    def stage(self, stage, camera=None):
+
+        self.start(stage, camera)
+        try:
+            yield
+        finally:
+            self.stop(stage, camera)
+
+    def summary(self):
+        # Wall time per stage, summed over cameras and repeated runs.
+
+        summary = {}
+        with self.lock:
+            for record in self.records:
+                if record['camera'] is None:
+                    summary[record['stage']] = (
+                        summary.get(record['stage'], 0) + record['wallTime'])
+
+        return summary
+
+    def toDict(self):
+
+        with self.lock:
+            records = sorted(self.records, key=lambda r: r['start'])
+
+        return {'hostname': socket.gethostname(),
+                'nCPUs': os.cpu_count(),
+                'created': self.created,
+                'wallTime': time.perf_counter() - self.t0,
+                'summary': self.summary(),
+                'stages': records}
+
+    def write(self, path):
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.toDict(), f, indent=2)
+
+# %%
+@contextmanager
+def profileStage(profiler, stage, camera=None):
+    # Same as profiler.stage, does nothing if profiler is None.
+
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(stage, camera):
+            yield
@@ -7,6 +7,7 @@ import logging
 import time
 import random
 import urllib
+import copy
 
 from main import main
 from utils import getDataDirectory
@@ -29,8 +30,14 @@ from utils import importMetadata
 from utils import checkAndGetPosePickles
 from utils import getTrialNameIdMapping
 from utils import makeRequestWithRetry
+from utils import deleteResult
+from utils import postFileToTrial
+from utils import getVisualizerBinaryPath
 from utilsAuth import getToken
-from utilsAPI import getAPIURL
+from utilsAPI import getAPIURL, getProfileUploadBool
+from utilsProfiler import StageProfiler, getProfilePath
+from utilsBatch import getJobs, runBatch
+from utilsVideo import clearVideoCache
 
 
 API_URL = getAPIURL()
@@ -46,12 +53,42 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
                  batchProcess = False,
                  cameras_to_use=['all']):
 
+    trial = prepareTrial(session_id, trial_id, trial_type=trial_type,
+                         poseDetector=poseDetector, isDocker=isDocker,
+                         resolutionPoseDetection=resolutionPoseDetection,
+                         bbox_thr=bbox_thr,
+                         use_existing_pose_pickle=use_existing_pose_pickle,
+                         batchProcess=batchProcess)
+    
+    runTrial(trial, imageUpsampleFactor=imageUpsampleFactor,
+             cameras_to_use=cameras_to_use)
+    
+    if not hasWritePermissions:
+        print('You are not the owner of this session, so do not have permission to write results to database.')
+        return
+    
+    uploadTrial(trial, extrinsicTrialName=extrinsicTrialName)
+    
+    # Remove data
+    if deleteLocalFolder:
+        shutil.rmtree(trial['session_path'])
+        clearVideoCache(trial['session_path'])
+
+# The steps of processTrial are also used separately by the pipelined worker
+# (utilsWorker), which runs different steps of different trials at once.
+def prepareTrial(session_id, trial_id, trial_type = 'dynamic',
+                 poseDetector = 'OpenPose', isDocker = True,
+                 resolutionPoseDetection = 'default', bbox_thr = 0.8,
+                 use_existing_pose_pickle = False, batchProcess = False):
+    # Downloads the data of a trial. Returns a dict describing the trial,
+    # which is passed to runTrial and uploadTrial.
+
     # Get session directory
     session_name = session_id 
     data_dir = getDataDirectory(isDocker=isDocker)
     session_path = os.path.join(data_dir,'Data',session_name)    
-    trial_url = "{}{}{}/".format(API_URL, "trials/", trial_id)
     metadata_path = os.path.join(session_path, 'sessionMetadata.yaml')        
+    calibrationOptions = None
        
     # Process the 3 different types of trials
     if trial_type == 'calibration':
@@ -62,43 +99,22 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
         trial_name = downloadVideosFromServer(session_id,trial_id,isDocker=isDocker,
                                  isCalibration=True,isStaticPose=False)
         
-        # run calibration
-        try:
-            main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=True,
-                 imageUpsampleFactor=imageUpsampleFactor,genericFolderNames = True,
-                 cameras_to_use=cameras_to_use)
-        except Exception as e:
-            error_msg = {}
-            error_msg['error_msg'] = e.args[0]
-            error_msg['error_msg_dev'] = e.args[1]
-            _ = makeRequestWithRetry('PATCH',
-                                     trial_url,
-                                     data={"meta": json.dumps(error_msg)},
-                                     headers = {"Authorization": "Token {}".format(API_TOKEN)}) 
-            raise Exception('Calibration failed', e.args[0], e.args[1])
-        
-        if not hasWritePermissions:
-            print('You are not the owner of this session, so do not have permission to write results to database.')
-            return
+    elif trial_type == 'static' or trial_type == 'dynamic':
+        if trial_type == 'static':
+            # delete static files if they exist.
+            deleteStaticFiles(session_path, staticTrialName = 'neutral')
             
-        # Write calibration images to django
-        images_path = os.path.join(session_path,'CalibrationImages')
-        writeMediaToAPI(API_URL,images_path,trial_id,tag="calibration-img",deleteOldMedia=True)
-        
-        # Write calibration solutions to django
-        writeCalibrationOptionsToAPI(session_path,session_id,calibration_id = trial_id,
-                                     trialName = extrinsicTrialName)
-        
-    elif trial_type == 'static':
-        # delete static files if they exist.
-        deleteStaticFiles(session_path, staticTrialName = 'neutral')
-        
-        # Check for calibration to use on django, if not, check for switch calibrations and post result.
-        calibrationOptions = getCalibration(session_id,session_path,trial_type=trial_type,getCalibrationOptions=True)
+            # Check for calibration to use on django, if not, check for switch calibrations and post result.
+            calibrationOptions = getCalibration(session_id,session_path,trial_type=trial_type,getCalibrationOptions=True)
+        else:
+            # download calibration, model, and metadata if not existing
+            getCalibration(session_id,session_path,trial_type=trial_type)   
+            getModelAndMetadata(session_id,session_path)
         
         # download the videos
-        trial_name = downloadVideosFromServer(session_id,trial_id,isDocker=isDocker,
-                                 isCalibration=False,isStaticPose=True)
+        trial_name = downloadVideosFromServer(
+            session_id, trial_id, isDocker=isDocker, isCalibration=False,
+            isStaticPose=(trial_type == 'static'))
         
         # Download the pose pickles to avoid re-running pose estimation.
         if batchProcess and use_existing_pose_pickle:
@@ -118,20 +134,84 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
             if poseDetector.lower() == 'openpose':
                 resolutionPoseDetection = defaultOpenCapSettings['openpose']
             elif poseDetector.lower() == 'hrnet':
-                bbox_thr = defaultOpenCapSettings['hrnet']            
+                bbox_thr = defaultOpenCapSettings['hrnet']
+        
+    else:
+        raise Exception('Wrong trial type. Options: calibration, static, dynamic.', 'TODO', 'TODO')
+        
+    trial = {'session_id': session_id, 'trial_id': trial_id,
+             'trial_type': trial_type, 'trial_name': trial_name,
+             'session_path': session_path, 'isDocker': isDocker,
+             'poseDetector': poseDetector,
+             'resolutionPoseDetection': resolutionPoseDetection,
+             'bbox_thr': bbox_thr, 'calibrationOptions': calibrationOptions,
+             'batchProcess': batchProcess, 'profiler': StageProfiler()}
+    
+    return trial
 
-        # run static
+def runTrial(trial, imageUpsampleFactor = 4, cameras_to_use=['all'],
+             poseDetectionOnly = False):
+    # Processes a trial prepared by prepareTrial. With poseDetectionOnly,
+    # only camera calibration and pose detection are run; running again
+    # without it reuses the pose detection outputs.
+    
+    session_name = trial['session_id']
+    trial_id = trial['trial_id']
+    trial_name = trial['trial_name']
+    trial_type = trial['trial_type']
+    session_path = trial['session_path']
+    isDocker = trial['isDocker']
+    poseDetector = trial['poseDetector']
+    resolutionPoseDetection = trial['resolutionPoseDetection']
+    bbox_thr = trial['bbox_thr']
+    batchProcess = trial['batchProcess']
+    trial_url = "{}{}{}/".format(API_URL, "trials/", trial_id)
+    
+    if trial_type == 'calibration':
+        if poseDetectionOnly:
+            return
+        # run calibration
         try:
-            main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=False,
-                 poseDetector=poseDetector,
-                 imageUpsampleFactor=imageUpsampleFactor,
-                 scaleModel = True,
-                 resolutionPoseDetection = resolutionPoseDetection,
-                 genericFolderNames = True,
-                 bbox_thr = bbox_thr,
-                 calibrationOptions = calibrationOptions,
-                 cameras_to_use=cameras_to_use)
-        except Exception as e:       
+            main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=True,
+                 imageUpsampleFactor=imageUpsampleFactor,genericFolderNames = True,
+                 cameras_to_use=cameras_to_use, profiler=trial['profiler'])
+        except Exception as e:
+            error_msg = {}
+            error_msg['error_msg'] = e.args[0]
+            error_msg['error_msg_dev'] = e.args[1]
+            _ = makeRequestWithRetry('PATCH',
+                                     trial_url,
+                                     data={"meta": json.dumps(error_msg)},
+                                     headers = {"Authorization": "Token {}".format(API_TOKEN)}) 
+            raise Exception('Calibration failed', e.args[0], e.args[1])
+        
+    elif trial_type == 'static' or trial_type == 'dynamic':
+        isNeutral = trial_type == 'static'
+        # run static or dynamic
+        try:
+            if isNeutral:
+                main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=False,
+                     poseDetector=poseDetector,
+                     imageUpsampleFactor=imageUpsampleFactor,
+                     scaleModel = True,
+                     resolutionPoseDetection = resolutionPoseDetection,
+                     genericFolderNames = True,
+                     bbox_thr = bbox_thr,
+                     calibrationOptions = copy.deepcopy(trial['calibrationOptions']),
+                     cameras_to_use=cameras_to_use,
+                     poseDetectionOnly=poseDetectionOnly,
+                     profiler=trial['profiler'])
+            else:
+                main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=False,
+                     poseDetector=poseDetector,
+                     imageUpsampleFactor=imageUpsampleFactor,
+                     resolutionPoseDetection = resolutionPoseDetection,
+                     genericFolderNames = True,
+                     bbox_thr = bbox_thr,
+                     cameras_to_use=cameras_to_use,
+                     poseDetectionOnly=poseDetectionOnly,
+                     profiler=trial['profiler'])
+        except Exception as e:
             # Try to post pose pickles so can be used offline. This function will 
             # error at kinematics most likely, but if pose estimation completed,
             # pickles will get posted
@@ -139,7 +219,7 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
                 # Write results to django
                 if not batchProcess:
                     print('trial failed. posting pose pickles')
-                    postMotionData(trial_id,session_path,trial_name=trial_name,isNeutral=True,
+                    postMotionData(trial_id,session_path,trial_name=trial_name,isNeutral=isNeutral,
                                     poseDetector=poseDetector, 
                                     resolutionPoseDetection=resolutionPoseDetection,
                                     bbox_thr=bbox_thr)
@@ -153,12 +233,37 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
                                      trial_url,
                                      data={"meta": json.dumps(error_msg)},
                                      headers = {"Authorization": "Token {}".format(API_TOKEN)})
-            raise Exception('Static trial failed', e.args[0], e.args[1])
+            if isNeutral:
+                raise Exception('Static trial failed', e.args[0], e.args[1])
+            else:
+                raise Exception('Dynamic trial failed.\n' + error_msg['error_msg_dev'], e.args[0], e.args[1])
         
-        if not hasWritePermissions:
-            print('You are not the owner of this session, so do not have permission to write results to database.')
-            return
+    else:
+        raise Exception('Wrong trial type. Options: calibration, static, dynamic.', 'TODO', 'TODO')
+
+def uploadTrial(trial, extrinsicTrialName = 'calibration'):
+    # Writes the results of a trial processed by runTrial to the database.
+    
+    session_id = trial['session_id']
+    trial_id = trial['trial_id']
+    trial_name = trial['trial_name']
+    trial_type = trial['trial_type']
+    session_path = trial['session_path']
+    isDocker = trial['isDocker']
+    poseDetector = trial['poseDetector']
+    resolutionPoseDetection = trial['resolutionPoseDetection']
+    bbox_thr = trial['bbox_thr']
+    
+    if trial_type == 'calibration':
+        # Write calibration images to django
+        images_path = os.path.join(session_path,'CalibrationImages')
+        writeMediaToAPI(API_URL,images_path,trial_id,tag="calibration-img",deleteOldMedia=True)
+        
+        # Write calibration solutions to django
+        writeCalibrationOptionsToAPI(session_path,session_id,calibration_id = trial_id,
+                                     trialName = extrinsicTrialName)
         
+    elif trial_type == 'static':
         # Write videos to django
         video_path = getResultsPath(session_id, trial_id,
                                     resultType='neutralVideo', isDocker=isDocker)
@@ -185,72 +290,6 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
         postCalibrationOptions(session_path,session_id,overwrite=True)
         
     elif trial_type == 'dynamic':
-        # download calibration, model, and metadata if not existing
-        getCalibration(session_id,session_path,trial_type=trial_type)   
-        getModelAndMetadata(session_id,session_path)
-        
-        # download the videos
-        trial_name = downloadVideosFromServer(
-            session_id, trial_id, isDocker=isDocker, isCalibration=False,
-            isStaticPose=False)
-        
-        # Download the pose pickles to avoid re-running pose estimation.
-        if batchProcess and use_existing_pose_pickle:
-            checkAndGetPosePickles(trial_id, session_path, poseDetector, resolutionPoseDetection, bbox_thr)
-
-        # If processTrial is run from app.py, poseDetector is set based on what
-        # users select in the webapp, which is saved in metadata. Based on this,
-        # we set resolutionPoseDetection or bbox_thr to the webapp defaults. If
-        # processTrial is run from batchReprocess.py, then the settings used are
-        # those passed as arguments to processTrial.
-        if not batchProcess:
-            sessionMetadata = importMetadata(metadata_path)
-            poseDetector = sessionMetadata['posemodel']
-            file_dir = os.path.dirname(os.path.abspath(__file__))
-            with open(os.path.join(file_dir,'defaultOpenCapSettings.json')) as f:
-                defaultOpenCapSettings = json.load(f)
-            if poseDetector.lower() == 'openpose':
-                resolutionPoseDetection = defaultOpenCapSettings['openpose']
-            elif poseDetector.lower() == 'hrnet':
-                bbox_thr = defaultOpenCapSettings['hrnet'] 
-        
-        # run dynamic
-        try:
-            main(session_name, trial_name, trial_id, isDocker=isDocker, extrinsicsTrial=False,
-                 poseDetector=poseDetector,
-                 imageUpsampleFactor=imageUpsampleFactor,
-                 resolutionPoseDetection = resolutionPoseDetection,
-                 genericFolderNames = True,
-                 bbox_thr = bbox_thr,
-                 cameras_to_use=cameras_to_use)
-        except Exception as e:
-            # Try to post pose pickles so can be used offline. This function will 
-            # error at kinematics most likely, but if pose estimation completed,
-            # pickles will get posted
-            try:
-                # Write results to django
-                if not batchProcess:
-                    print('trial failed. posting pose pickles')
-                    postMotionData(trial_id,session_path,trial_name=trial_name,isNeutral=False,
-                                    poseDetector=poseDetector, 
-                                    resolutionPoseDetection=resolutionPoseDetection,
-                                    bbox_thr=bbox_thr)
-            except:
-                pass
-            
-            error_msg = {}
-            error_msg['error_msg'] = e.args[0]
-            error_msg['error_msg_dev'] = e.args[1]
-            _ = makeRequestWithRetry('PATCH',
-                                     trial_url,
-                                     data={"meta": json.dumps(error_msg)},
-                                     headers = {"Authorization": "Token {}".format(API_TOKEN)})
-            raise Exception('Dynamic trial failed.\n' + error_msg['error_msg_dev'], e.args[0], e.args[1])
-        
-        if not hasWritePermissions:
-            print('You are not the owner of this session, so do not have permission to write results to database.')
-            return
-        
         # Write videos to django
         video_path = getResultsPath(session_id, trial_id,
                                     resultType='sync_video', isDocker=isDocker)
@@ -272,9 +311,21 @@ def processTrial(session_id, trial_id, trial_type = 'dynamic',
     else:
         raise Exception('Wrong trial type. Options: calibration, static, dynamic.', 'TODO', 'TODO')
     
-    # Remove data
-    if deleteLocalFolder:
-        shutil.rmtree(session_path)
+    # Attach the compact visualizer transforms, if written (see main).
+    pathVisualizerBinary = getVisualizerBinaryPath(session_path, trial_name)
+    if trial_type != 'calibration' and os.path.exists(pathVisualizerBinary):
+        deleteResult(trial_id, tag='visualizerTransforms-bin')
+        postFileToTrial(pathVisualizerBinary, trial_id,
+                        tag='visualizerTransforms-bin', device_id=None)
+    
+    # Attach stage profile to the trial.
+    if getProfileUploadBool():
+        pathProfile = getProfilePath(
+            os.path.join(session_path, 'MarkerData', 'PostAugmentation'),
+            trial_id)
+        if os.path.exists(pathProfile):
+            deleteResult(trial_id, tag='profile')
+            postFileToTrial(pathProfile, trial_id, tag='profile', device_id=None)
         
         
 def getCalibrationImagePath(session_id,isDocker=True):
@@ -345,7 +396,11 @@ def newSessionSameSetup(session_id_old,session_id_new,extrinsicTrialName='calibr
 def batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,poseDetector='OpenPose', 
                    resolutionPoseDetection='1x736',deleteLocalFolder=True,
                    isServer=False, use_existing_pose_pickle=True,
-                   cameras_to_use=['all']):
+                   cameras_to_use=['all'], nWorkers=1, ledgerPath=None,
+                   retryFailed=False):
+    # Trials are processed in nWorkers processes, see utilsBatch. The status
+    # of each trial is saved in a ledger; pass the path of the ledger of an
+    # interrupted batch as ledgerPath to resume it.
 
     # extract trial ids from trial names
     if dynamic_trialNames is not None and len(dynamic_trialNames)>0:
@@ -358,8 +413,9 @@ def batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,poseDetecto
         (type(dynamic_ids)==list and len(dynamic_ids)>0)) and len(session_ids) >1:
         raise Exception('can only have one session number if hardcoding other trial ids')
         
+    jobs = []
     for session_id in session_ids:
-        print('Processing ' + session_id)
+        print('Listing trials of ' + session_id)
         
         # check if write permissions (session owner or admin)
         response = makeRequestWithRetry('GET',
@@ -374,59 +430,11 @@ def batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,poseDetecto
         else:
             calib_id_toProcess = calib_id
         
-        if len(calib_id_toProcess) > 0:
-            try:
-                processTrial(session_id,
-                              calib_id_toProcess,
-                              trial_type="calibration",
-                              poseDetector = poseDetector,
-                              deleteLocalFolder = deleteLocalFolder,
-                              isDocker=isServer,
-                              hasWritePermissions = hasWritePermissions,
-                              cameras_to_use=cameras_to_use)
-                statusData = {'status':'done'}
-                _ = makeRequestWithRetry('PATCH',
-                                         API_URL + "trials/{}/".format(calib_id_toProcess),
-                                         data=statusData,
-                                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-            except Exception as e:
-                print(e)
-                statusData = {'status':'error'}
-                _ = makeRequestWithRetry('PATCH',
-                                         API_URL + "trials/{}/".format(calib_id_toProcess),
-                                         data=statusData,
-                                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-        
         if static_id == None:
             static_id_toProcess = getNeutralTrialID(session_id)
         else:
             static_id_toProcess = static_id
         
-        if len(static_id_toProcess)  > 0:
-            try:
-                processTrial(session_id,
-                              static_id_toProcess,
-                              trial_type="static",
-                              resolutionPoseDetection = resolutionPoseDetection,
-                              poseDetector = poseDetector,
-                              deleteLocalFolder = deleteLocalFolder,
-                              isDocker=isServer,
-                              hasWritePermissions = hasWritePermissions,
-                              use_existing_pose_pickle = use_existing_pose_pickle,
-                              batchProcess = True,
-                              cameras_to_use=cameras_to_use)
-                statusData = {'status':'done'}
-                _ = makeRequestWithRetry('PATCH',
-                                         API_URL + "trials/{}/".format(static_id_toProcess),
-                                         data=statusData,
-                                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-            except Exception as e:
-                print(e)
-                statusData = {'status':'error'}
-                _ = makeRequestWithRetry('PATCH',
-                                         API_URL + "trials/{}/".format(static_id_toProcess),
-                                         data=statusData,
-                                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
         if dynamic_ids == None:
             response = makeRequestWithRetry('GET',
                                             API_URL + "sessions/{}/".format(session_id),
@@ -439,32 +447,29 @@ def batchReprocess(session_ids,calib_id,static_id,dynamic_trialNames,poseDetecto
             elif type(dynamic_ids) == list:
                 dynamic_ids_toProcess=dynamic_ids
         
-        for dID in dynamic_ids_toProcess:
-            try:
-                processTrial(session_id,
-                          dID,
-                          trial_type="dynamic",
-                          resolutionPoseDetection = resolutionPoseDetection,
-                          poseDetector = poseDetector,
-                          deleteLocalFolder = deleteLocalFolder,
-                          isDocker=isServer,
-                          hasWritePermissions = hasWritePermissions,
-                          use_existing_pose_pickle = use_existing_pose_pickle,
-                          batchProcess = True,
-                          cameras_to_use=cameras_to_use)
-                
-                statusData = {'status':'done'}
-                _ = makeRequestWithRetry('PATCH',
-                                         API_URL + "trials/{}/".format(dID),
-                                         data=statusData,
-                                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
-            except Exception as e:
-                print(e)
-                statusData = {'status':'error'}
-                _ = makeRequestWithRetry('PATCH',
-                                         API_URL + "trials/{}/".format(dID),
-                                         data=statusData,
-                                         headers = {"Authorization": "Token {}".format(API_TOKEN)})
+        jobs += getJobs(session_id, calib_id_toProcess, static_id_toProcess,
+                        dynamic_ids_toProcess,
+                        hasWritePermissions=hasWritePermissions)
+    
+    if ledgerPath is None:
+        ledgerPath = os.path.join(
+            getDataDirectory(isDocker=isServer), 'Data',
+            'batchReprocess_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    print('Ledger of the batch: ' + ledgerPath)
+    
+    # Worker processes read the token from the environment.
+    os.environ['API_TOKEN'] = API_TOKEN
+    settings = {'poseDetector': poseDetector,
+                'resolutionPoseDetection': resolutionPoseDetection,
+                'isDocker': isServer,
+                'use_existing_pose_pickle': use_existing_pose_pickle,
+                'cameras_to_use': cameras_to_use}
+    ledger = runBatch(jobs, ledgerPath, nWorkers=nWorkers, settings=settings,
+                      retryFailed=retryFailed,
+                      deleteLocalFolder=deleteLocalFolder)
+    print('Batch done: {}'.format(ledger.summary()))
+    
+    return ledger
 
 def runTestSession(pose='all',isDocker=True,maxNumTries=3):
     # We retry test sessions because different sometimes when different
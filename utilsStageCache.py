@@ -0,0 +1,154 @@
+"""Content-addressed cache of the outputs of pipeline stages.
+
+The key of a stage is a hash of everything its outputs depend on: input
+files (by content), camera parameters, settings, and the source of the code
+that runs the stage. Stage keys include the outputs of upstream stages, so a
+change upstream invalidates everything downstream. For each stage, a
+manifest with the key, the output files (and their hashes) and a few values
+needed downstream is saved; the stage is skipped when the key matches and
+its outputs are unchanged.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+
+_fileHashCache = {}
+
+# %%
+def hashFile(path):
+    # sha256 of the content of a file, memoized on path, mtime and size.
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _fileHashCache:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _fileHashCache[key] = h.hexdigest()
+
+    return _fileHashCache[key]
+
+# %%
+def _update(h, item):
+
+    if isinstance(item, dict):
+        h.update(b'{')
+        for k in sorted(item, key=str):
+            _update(h, str(k))
+            _update(h, item[k])
+        h.update(b'}')
+    elif isinstance(item, (list, tuple)):
+        h.update(b'[')
+        for i in item:
+            _update(h, i)
+        h.update(b']')
+    elif isinstance(item, np.ndarray):
+        h.update('{}{}'.format(item.dtype.str, item.shape).encode())
+        h.update(np.ascontiguousarray(item).tobytes())
+    elif isinstance(item, np.generic):
+        _update(h, item.item())
+    else:
+        h.update('{}:{!r};'.format(type(item).__name__, item).encode())
+
+def hashInputs(*items):
+    # Hash of (nested) dicts, lists, arrays and scalars.
+
+    h = hashlib.sha256()
+    for item in items:
+        _update(h, item)
+
+    return h.hexdigest()
+
+# %%
+def hashFiles(paths):
+    # Hashes of files, None for missing files.
+
+    return [hashFile(p) if os.path.isfile(p) else None for p in paths]
+
+# %%
+def getCodeVersion(moduleNames):
+    # Hash of the source of modules of this repository, eg ['utilsChecker'].
+
+    return hashInputs(hashFiles([os.path.join(baseDir, m + '.py')
+                                 for m in moduleNames]))
+
+# %%
+def listFiles(folder):
+    # Files in a folder and its subfolders, sorted.
+
+    paths = []
+    for root, _, files in os.walk(folder):
+        paths.extend(os.path.join(root, f) for f in files)
+
+    return sorted(paths)
+
+# %%
+class StageCache(object):
+    """Manifests of the stages of a trial, saved in cacheDir.
+
+    Output paths are saved relative to rootDir (eg the session folder), so
+    that the cache stays valid if the session folder is moved. With
+    enabled=False, get always misses and put does nothing.
+    """
+    def __init__(self, cacheDir, rootDir, prefix='', enabled=True):
+
+        self.cacheDir = cacheDir
+        self.rootDir = rootDir
+        self.prefix = prefix
+        self.enabled = enabled
+
+    def _manifestPath(self, stage):
+
+        return os.path.join(self.cacheDir, self.prefix + stage + '.json')
+
+    def getManifest(self, stage):
+
+        path = self._manifestPath(stage)
+        if not self.enabled or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def get(self, stage, key):
+        # Returns the values saved with the outputs of the stage if the key
+        # matches and the outputs are unchanged, None otherwise.
+
+        manifest = self.getManifest(stage)
+        if manifest is None or manifest['key'] != key:
+            return None
+        outputs = [os.path.join(self.rootDir, p) for p in manifest['outputs']]
+        if hashFiles(outputs) != manifest['outputHashes']:
+            return None
+
+        return manifest['data']
+
+    def isStale(self, stage, key):
+        # True if the stage was cached with a different key.
+
+        manifest = self.getManifest(stage)
+        return manifest is not None and manifest['key'] != key
+
+    def put(self, stage, key, outputs, data={}):
+        # Saves the manifest of a stage. outputs are absolute file paths,
+        # data is json-serializable.
+
+        if not self.enabled:
+            return
+        os.makedirs(self.cacheDir, exist_ok=True)
+        manifest = {
+            'key': key,
+            'outputs': [os.path.relpath(p, self.rootDir) for p in outputs],
+            'outputHashes': hashFiles(outputs),
+            'data': data}
+        path = self._manifestPath(stage)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,83 @@
+"""Reading and writing of TRC marker files.
+
+The numeric body is formatted with one format string per row and written in
+blocks, rather than value by value, and parsed as a plain float array with
+a C parser. Files are byte-identical to the ones written before by
+utils.numpy2TRC and utilsDataman.TRCFile.write.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Rows formatted per write call.
+blockSize = 5000
+
+# %%
+def writeTRCHeader(f, pathFileType, dataRate, cameraRate, numFrames,
+                   markerNames, units, origDataRate, origDataStartFrame,
+                   origNumFrames):
+
+    # Line 1.
+    f.write('PathFileType  4\t(X/Y/Z) %s\n' % pathFileType)
+
+    # Line 2.
+    f.write('DataRate\tCameraRate\tNumFrames\tNumMarkers\t'
+            'Units\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n')
+
+    # Line 3.
+    f.write('%.1f\t%.1f\t%i\t%i\t%s\t%.1f\t%i\t%i\n' % (
+        dataRate, cameraRate, numFrames, len(markerNames), units,
+        origDataRate, origDataStartFrame, origNumFrames))
+
+    # Line 4.
+    f.write('Frame#\tTime\t' + ''.join('%s\t\t\t' % name
+                                       for name in markerNames))
+
+    # Line 5.
+    f.write('\n\t\t' + ''.join('X%i\tY%i\tZ%i\t' % (i, i, i)
+                               for i in range(1, len(markerNames) + 1)))
+    f.write('\n')
+
+    # Line 6.
+    f.write('\n')
+
+# %%
+def writeTRCRows(f, time, data, timeFormat='%.8f', valueFormat='%.5f',
+                 trailingTab=True):
+    # Writes frame numbers (1-indexed, as in OpenSim), time and data
+    # (nFrames x 3*nMarkers). With trailingTab, each value is followed by a
+    # tab (numpy2TRC), otherwise preceded by one (TRCFile.write).
+
+    data = np.asarray(data)
+    nValues = data.shape[1] if data.ndim == 2 else 0
+    if trailingTab:
+        rowFormat = ('%i\t' + timeFormat + '\t' +
+                     (valueFormat + '\t') * nValues + '\n')
+    else:
+        rowFormat = ('%i\t' + timeFormat +
+                     ('\t' + valueFormat) * nValues + '\n')
+    rows = np.column_stack((np.arange(1, len(time) + 1), time,
+                            data.reshape(len(time), nValues)))
+    for start in range(0, rows.shape[0], blockSize):
+        block = rows[start:start+blockSize].tolist()
+        f.write(''.join([rowFormat % ((int(row[0]),) + tuple(row[1:]))
+                         for row in block]))
+
+# %%
+# np.loadtxt parses in C since numpy 1.23; with older versions, the parser of
+# pandas is much faster.
+_cLoadtxt = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+
+def readTRCData(fpath, nColumns, skiprows=5):
+    # Returns the first nColumns columns (frame number, time and markers)
+    # of the rows of a TRC file, as floats. Values are parsed exactly, as
+    # by np.loadtxt.
+
+    if _cLoadtxt:
+        return np.loadtxt(fpath, delimiter='\t', skiprows=skiprows,
+                          usecols=range(nColumns), ndmin=2)
+    data = pd.read_csv(fpath, sep='\t', header=None, skiprows=skiprows,
+                       usecols=range(nColumns), skip_blank_lines=True,
+                       float_precision='round_trip', dtype=np.float64)
+
+    return data.to_numpy()
@@ -0,0 +1,176 @@
+"""Frame access for videos.
+
+Metadata (duration, fps, frame count, size, rotation) is probed once per
+video and cached, and frames at several times or frame indices are read in a
+single decode pass. Decoded frames are cached so that callers that retry on
+the same frames (eg checkerboard detection with different upsample factors)
+do not decode the video again. The frame cache is bounded in number of frames
+and bytes, drops frames of videos that no longer exist, and is cleared for a
+session folder when the folder is deleted (clearVideoCache).
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import ffmpeg
+import numpy as np
+
+_metadataCache = {}
+_frameCache = OrderedDict()
+_frameCacheLock = threading.Lock()
+maxCachedFrames = 64
+maxCachedFrameBytes = 256 * 1024**2
+
+# %%
+def _getCacheKey(videoPath):
+
+    stat = os.stat(videoPath)
+    return (os.path.abspath(videoPath), stat.st_mtime_ns, stat.st_size)
+
+# %%
+def _getRotation(meta):
+
+    try:
+        rotation = meta['format']['tags']['com.apple.quicktime.video-orientation']
+    except:
+        # For AVI (after we rewrite video), no rotation paramter, so just using h and w.
+        # For now this is ok, we don't need leaning right/left for this, just need to know
+        # how to orient the pose estimation resolution parameters.
+        try:
+            if meta['format']['format_name'] == 'avi':
+                if meta['streams'][0]['height']>meta['streams'][0]['width']:
+                    rotation = 90
+                else:
+                    rotation = 0
+            else:
+                raise Exception('no rotation info')
+        except:
+            rotation = 90 # upright is 90, and intrinsics were captured in that orientation
+
+    return int(rotation)
+
+# %%
+def getVideoMetadata(videoPath):
+    # Returns a dict with duration (s), fps, nFrames, width, height and
+    # rotation. Probed once per video (invalidated if the file changes).
+
+    key = _getCacheKey(videoPath)
+    if key in _metadataCache:
+        return _metadataCache[key]
+
+    meta = ffmpeg.probe(videoPath)
+    videoStreams = [s for s in meta['streams'] if s['codec_type'] == 'video']
+    stream = videoStreams[0] if videoStreams else {}
+
+    duration = float(meta['format'].get('duration', stream.get('duration', 0)))
+    num, den = stream.get('avg_frame_rate', '0/0').split('/')
+    if float(den) == 0 or float(num) == 0:
+        num, den = stream.get('r_frame_rate', '0/1').split('/')
+    fps = float(num) / float(den) if float(den) != 0 else 0.
+    if 'nb_frames' in stream:
+        nFrames = int(stream['nb_frames'])
+    else:
+        nFrames = int(np.round(duration * fps))
+
+    metadata = {'duration': duration, 'fps': fps, 'nFrames': nFrames,
+                'width': stream.get('width'), 'height': stream.get('height'),
+                'rotation': _getRotation(meta)}
+    _metadataCache[key] = metadata
+
+    return metadata
+
+# %%
+def timesToFrameIndices(videoPath, times):
+
+    metadata = getVideoMetadata(videoPath)
+    frameIndices = np.round(np.asarray(times, dtype=float) *
+                            metadata['fps']).astype(int)
+
+    return np.clip(frameIndices, 0, max(metadata['nFrames'] - 1, 0))
+
+# %%
+def readVideoFrames(videoPath, times=None, frameIndices=None):
+    # Returns the BGR frames at the requested times (s) or frame indices, in
+    # the requested order. Frames that could not be decoded are None. All
+    # frames are read in a single sequential decode pass.
+
+    if frameIndices is None:
+        frameIndices = timesToFrameIndices(videoPath, times)
+    frameIndices = [int(i) for i in frameIndices]
+
+    key = _getCacheKey(videoPath)
+    frames = {}
+    with _frameCacheLock:
+        for idx in set(frameIndices):
+            if (key, idx) in _frameCache:
+                _frameCache.move_to_end((key, idx))
+                frames[idx] = _frameCache[(key, idx)]
+    toDecode = sorted(set(frameIndices) - set(frames))
+
+    if toDecode:
+        cap = cv2.VideoCapture(videoPath)
+        if hasattr(cv2, 'CAP_PROP_ORIENTATION_AUTO'):
+            cap.set(cv2.CAP_PROP_ORIENTATION_AUTO, 1)
+        iFrame = 0
+        for idx in toDecode:
+            ret = True
+            while iFrame < idx and ret:
+                ret = cap.grab()
+                iFrame += 1
+            if not ret:
+                break
+            ret, frame = cap.read()
+            iFrame += 1
+            if not ret:
+                break
+            frames[idx] = frame
+        cap.release()
+        with _frameCacheLock:
+            for idx in toDecode:
+                if idx in frames:
+                    _frameCache[(key, idx)] = frames[idx]
+            _pruneFrameCache()
+
+    return [frames.get(idx) for idx in frameIndices]
+
+# %%
+def _pruneFrameCache():
+    # Drops frames of videos that were deleted (their keys can not be hit
+    # again), then the least recently used frames beyond the limits. Call
+    # with _frameCacheLock held.
+
+    existing = {}
+    for key in list(_frameCache):
+        videoPath = key[0][0]
+        if videoPath not in existing:
+            existing[videoPath] = os.path.exists(videoPath)
+        if not existing[videoPath]:
+            del _frameCache[key]
+
+    nBytes = sum(frame.nbytes for frame in _frameCache.values())
+    while _frameCache and (len(_frameCache) > maxCachedFrames or
+                           nBytes > maxCachedFrameBytes):
+        _, frame = _frameCache.popitem(last=False)
+        nBytes -= frame.nbytes
+
+# %%
+def clearVideoCache(folder=None):
+    # Clears the caches, or only the entries of videos in folder (eg a session
+    # folder that is deleted).
+
+    if folder is None:
+        with _frameCacheLock:
+            _frameCache.clear()
+        _metadataCache.clear()
+        return
+
+    folder = os.path.join(os.path.abspath(folder), '')
+    with _frameCacheLock:
+        for key in list(_frameCache):
+            if key[0][0].startswith(folder):
+                del _frameCache[key]
+    for key in list(_metadataCache):
+        if key[0].startswith(folder):
+            _metadataCache.pop(key, None)
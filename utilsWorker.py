@@ -0,0 +1,298 @@
+"""Pipelined trial processing for app.py.
+
+Each trial goes through four stages: download, pose detection,
+post-processing (synchronization to OpenSim) and upload. Stages run in
+separate pools (I/O for download and upload, GPU for pose detection, CPU for
+post-processing), so that several trials can be in different stages at
+once. Trials of the same session share the session folder: each stage runs
+for one trial of the session at a time, in the order the trials were
+dequeued (see SessionSequence).
+"""
+
+import os
+import shutil
+import logging
+import threading
+import traceback
+from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import (getDataDirectory, postLocalClientInfo,
+                   postProcessedDuration, makeRequestWithRetry,
+                   writeToErrorLog)
+from utilsVideo import clearVideoCache
+
+# %% Default stages, based on the steps of utilsServer.processTrial.
+def downloadStage(trialJson, trial_type, isDocker):
+    from utilsServer import prepareTrial
+    return prepareTrial(trialJson["session"], trialJson["id"],
+                        trial_type=trial_type, isDocker=isDocker)
+
+def poseStage(trial):
+    from utilsServer import runTrial
+    runTrial(trial, poseDetectionOnly=True)
+
+def processStage(trial):
+    from utilsServer import runTrial
+    runTrial(trial)
+
+def uploadStage(trial):
+    from utilsServer import uploadTrial
+    uploadTrial(trial)
+
+# %%
+def getTrialType(trialJson):
+
+    trial_type = "dynamic"
+    if trialJson["name"] == "calibration":
+        trial_type = "calibration"
+    if trialJson["name"] == "neutral":
+        trialJson["name"] = "static"
+        trial_type = "static"
+
+    return trial_type
+
+# %%
+class SessionSequence(object):
+    """Orders the stages of the trials of a session.
+
+    Trials get a ticket in the order they are submitted. Each stage runs for
+    one trial of the session at a time, in ticket order, but different
+    stages overlap, eg pose detection of a trial while the previous trial is
+    post-processed. Barrier trials (calibration and static trials) replace
+    session files (camera parameters, scaled model), so the trials after
+    them are only downloaded once they are done.
+    """
+    stages = ['download', 'pose', 'process', 'done']
+
+    def __init__(self):
+
+        self.condition = threading.Condition()
+        self.nTickets = 0
+        self.barriers = []
+        self.turn = {stage: 0 for stage in self.stages}
+        self.finished = {stage: set() for stage in self.stages}
+
+    def newTicket(self, barrier=False):
+
+        with self.condition:
+            ticket = self.nTickets
+            self.nTickets += 1
+            if barrier:
+                self.barriers.append(ticket)
+            return ticket
+
+    def _isTurn(self, stage, ticket):
+
+        if self.turn[stage] != ticket:
+            return False
+        if stage == 'download':
+            barriers = [b for b in self.barriers if b < ticket]
+            if barriers and self.turn['done'] <= max(barriers):
+                return False
+        return True
+
+    @contextmanager
+    def stage(self, stage, ticket):
+        # Waits for the turn of the trial, and passes the turn to the next
+        # trial when the stage is done or failed.
+
+        with self.condition:
+            self.condition.wait_for(lambda: self._isTurn(stage, ticket))
+        try:
+            yield
+        finally:
+            self.finish(ticket, [stage])
+
+    def finish(self, ticket, stages=None):
+        # Passes the turn of the trial for the stages (default all stages),
+        # eg for the stages skipped after an error.
+
+        if stages is None:
+            stages = self.stages
+        with self.condition:
+            for stage in stages:
+                if ticket < self.turn[stage]:
+                    continue
+                self.finished[stage].add(ticket)
+                while self.turn[stage] in self.finished[stage]:
+                    self.finished[stage].remove(self.turn[stage])
+                    self.turn[stage] += 1
+            self.condition.notify_all()
+
+# %%
+class PipelinedWorker(object):
+    """Processes dequeued trials in a staged pipeline.
+
+    At most maxTrials trials are in flight; use hasCapacity before
+    dequeuing a new trial. The status of each trial is reported with the
+    same PATCH calls as the sequential worker (client info, done or error,
+    processed duration).
+    """
+    def __init__(self, apiUrl, apiToken, isDocker=True, maxTrials=3,
+                 nIOWorkers=2, nGPUWorkers=1, nCPUWorkers=1,
+                 deleteLocalFolder=True, errorLogPath=None,
+                 downloadFn=downloadStage, poseFn=poseStage,
+                 processFn=processStage, uploadFn=uploadStage):
+
+        self.apiUrl = apiUrl
+        self.apiToken = apiToken
+        self.isDocker = isDocker
+        self.maxTrials = maxTrials
+        self.deleteLocalFolder = deleteLocalFolder
+        self.errorLogPath = errorLogPath
+        self.downloadFn = downloadFn
+        self.poseFn = poseFn
+        self.processFn = processFn
+        self.uploadFn = uploadFn
+
+        self.ioPool = ThreadPoolExecutor(max_workers=nIOWorkers)
+        self.gpuPool = ThreadPoolExecutor(max_workers=nGPUWorkers)
+        self.cpuPool = ThreadPoolExecutor(max_workers=nCPUWorkers)
+        self.trialPool = ThreadPoolExecutor(max_workers=maxTrials)
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.inFlight = {}
+        self.sessions = {}
+        self.sessionCounts = {}
+
+    def hasCapacity(self):
+
+        with self.lock:
+            return len(self.inFlight) < self.maxTrials
+
+    def nInFlight(self):
+
+        with self.lock:
+            return len(self.inFlight)
+
+    def waitUntilIdle(self, timeout=None):
+
+        with self.idle:
+            return self.idle.wait_for(lambda: len(self.inFlight) == 0,
+                                      timeout=timeout)
+
+    def submit(self, trialJson, trial_type=None):
+        # Queues a dequeued trial (json from the API). Returns a future that
+        # resolves to 'done' or 'error'.
+
+        if trial_type is None:
+            trial_type = getTrialType(trialJson)
+        session_id = trialJson["session"]
+        with self.lock:
+            self.inFlight[trialJson["id"]] = 'queued'
+            if session_id not in self.sessions:
+                self.sessions[session_id] = SessionSequence()
+                self.sessionCounts[session_id] = 0
+            self.sessionCounts[session_id] += 1
+            sequence = self.sessions[session_id]
+            ticket = sequence.newTicket(
+                barrier=trial_type in ['calibration', 'static'])
+
+        return self.trialPool.submit(self._runTrial, trialJson, trial_type,
+                                     sequence, ticket)
+
+    def shutdown(self, wait=True):
+
+        self.trialPool.shutdown(wait=wait)
+        for pool in [self.ioPool, self.gpuPool, self.cpuPool]:
+            pool.shutdown(wait=wait)
+
+    def _setStage(self, trial_id, stage):
+
+        with self.lock:
+            self.inFlight[trial_id] = stage
+        logging.info("Trial {}: {}".format(trial_id, stage))
+
+    def _patchStatus(self, trial_url, status):
+
+        return makeRequestWithRetry('PATCH', trial_url,
+                                    data={"status": status},
+                                    headers={"Authorization": "Token {}".format(self.apiToken)})
+
+    def _logError(self, trialJson, e):
+
+        traceback.print_exc()
+        if self.errorLogPath is not None:
+            stack = traceback.format_exc()
+            writeToErrorLog(self.errorLogPath, trialJson["session"],
+                            trialJson["id"], e, stack)
+
+    def _runTrial(self, trialJson, trial_type, sequence, ticket):
+
+        trial_id = trialJson["id"]
+        session_id = trialJson["session"]
+        trial_url = "{}{}{}/".format(self.apiUrl, "trials/", trial_id)
+        status = 'error'
+
+        try:
+            # Post new client info to Trial and start timer for processing duration
+            postLocalClientInfo(trial_url)
+            process_start_time = datetime.now()
+
+            with sequence.stage('download', ticket):
+                self._setStage(trial_id, 'download')
+                trial = self.ioPool.submit(
+                    self.downloadFn, trialJson, trial_type,
+                    self.isDocker).result()
+            with sequence.stage('pose', ticket):
+                self._setStage(trial_id, 'pose')
+                self.gpuPool.submit(self.poseFn, trial).result()
+            with sequence.stage('process', ticket):
+                self._setStage(trial_id, 'process')
+                self.cpuPool.submit(self.processFn, trial).result()
+            self._setStage(trial_id, 'upload')
+            self.ioPool.submit(self.uploadFn, trial).result()
+
+            self._patchStatus(trial_url, 'done')
+            status = 'done'
+
+        except Exception as e:
+            try:
+                self._patchStatus(trial_url, 'error')
+                self._logError(trialJson, e)
+            except:
+                self._logError(trialJson, e)
+
+        finally:
+            # End process duration timer and post duration to database
+            try:
+                process_end_time = datetime.now()
+                postProcessedDuration(trial_url, process_end_time - process_start_time)
+            except Exception as e:
+                self._logError(trialJson, e)
+
+            # Clean session folder if no other trial of the session is
+            # queued. Trials of the session submitted meanwhile are
+            # downloaded once the folder is removed.
+            with self.lock:
+                lastOfSession = self.sessionCounts[session_id] == 1
+                cleanTicket = None
+                if lastOfSession and self.deleteLocalFolder:
+                    cleanTicket = sequence.newTicket(barrier=True)
+            sequence.finish(ticket)
+            if cleanTicket is not None:
+                try:
+                    session_path = os.path.join(
+                        getDataDirectory(isDocker=self.isDocker), 'Data',
+                        session_id)
+                    if os.path.isdir(session_path):
+                        shutil.rmtree(session_path)
+                        clearVideoCache(session_path)
+                        logging.info('deleting ' + session_path)
+                finally:
+                    sequence.finish(cleanTicket)
+
+            with self.idle:
+                del self.inFlight[trial_id]
+                self.sessionCounts[session_id] -= 1
+                if self.sessionCounts[session_id] == 0:
+                    self.sessions.pop(session_id)
+                    self.sessionCounts.pop(session_id)
+                self.idle.notify_all()
+
+        logging.info("Trial {}: {}".format(trial_id, status))
+
+        return status